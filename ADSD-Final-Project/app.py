@@ -1,242 +1,318 @@
-from flask import Flask, render_template, request, redirect, url_for
-import sqlite3
-from database import Database 
-from datetime import datetime 
+from flask import Flask, render_template, stream_template, request, redirect, url_for, abort, Response, stream_with_context
+import os
+import sys
+import click
+import bulk
+from cache import VehicleCache, backend_from_env
+from metrics import Metrics, slow_query_threshold
+from database import Database, WriteQueue
+from vehicles import (
+    Vehicles,
+    register_filters,
+    page_args,
+    is_streaming,
+    vehicle_params,
+    maintenance_params,
+    import_options,
+    export_options,
+    is_export,
+)
 
 
 app = Flask(__name__)
 
-# Format the date to a more readable format
-@app.template_filter('format_date')
-def format_date(value):
-    # Ensure value is a string before trying to format it
-    value = str(value)
-    
-    try:
-        # Try parsing it as a date in 'YYYY-MM-DD' format
-        return datetime.strptime(value, '%Y-%m-%d').strftime('%B %d, %Y')
-    except ValueError:
-        # If it doesn't match the format, return the value as is
-        return value
+# format_date and format_cost, shared with async_app.py
+register_filters(app)
 
-# Format the cost to two decimal places
-@app.template_filter('format_cost')
-def format_cost(value):
-    try:
-        # Try converting the value to a float, then format it
-        return f"${float(value):.2f}"
-    except (ValueError, TypeError):
-        # If the value cannot be converted to float, return it as-is (or handle the error)
-        return value
-
-# To initialize the database, will create tables if doesnt exist
-db = Database("database.db")
-
-# Database connection function
-def get_db_connection():
-    """Create and return a database connection"""
-    connection = sqlite3.connect("database.db", check_same_thread=False)
-    connection.row_factory = sqlite3.Row
-    return connection
-
-# List of vehicles
+# Route, query and template timings at /metrics. Set SLOW_QUERY_MS to log
+# statements that take at least that long.
+metrics = Metrics(slow_query_seconds=slow_query_threshold())
+metrics.init_app(app)
+
+# To initialize the database, will create tables if doesnt exist.
+# Vehicles borrows connections from its pool with "with db.connection()"
+db = Database("database.db", connection_factory=metrics.connection_class)
+
+# Cache in front of the vehicle and history lookups, every write below
+# invalidates the vehicle it touched. Set VEHICLE_CACHE_REDIS_URL to share
+# it between worker processes (needs the redis package).
+vehicle_cache = VehicleCache(backend_from_env())
+
+# Set MAINTENANCE_GROUP_COMMIT=1 to commit maintenance records from
+# concurrent requests in groups, one fsync per group instead of per record
+write_queue = WriteQueue(db) if os.environ.get("MAINTENANCE_GROUP_COMMIT") else None
+
+# What the routes do, shared with async_app.py
+vehicles = Vehicles(db, vehicle_cache, write_queue)
+
+# Connection pool metrics
+@app.route("/stats/pool")
+def pool_stats():
+    return vehicles.db.pool_stats()
+
+# Group commit metrics
+@app.route("/stats/writes")
+def write_stats():
+    if vehicles.write_queue is None:
+        return "Group commit is off", 404
+    return vehicles.write_queue.stats()
+
+# Vehicle cache metrics
+@app.route("/stats/cache")
+def cache_stats():
+    return vehicles.cache.stats()
+
+# Maintenance summary upkeep, run as "flask --app app rebuild-summaries"
+@app.cli.command("rebuild-summaries")
+def rebuild_summaries_command():
+    """Recompute every vehicle's maintenance count, total cost and last service date."""
+    updated = db.rebuild_summaries()
+    print(f"Rebuilt maintenance summaries for {updated} vehicles")
+
+@app.cli.command("verify-summaries")
+def verify_summaries_command():
+    """Report vehicles whose maintenance summary is out of sync, exit 1 if any."""
+    broken = db.verify_summaries()
+    for row in broken:
+        print(
+            f"vehicle {row['id']}: "
+            f"count {row['maintenance_count']} != {row['actual_count']}, "
+            f"total cost {row['total_cost']} != {row['actual_total_cost']}, "
+            f"last service {row['last_service_date']} != {row['actual_last_service_date']}"
+        )
+    if broken:
+        print(f"{len(broken)} vehicles out of sync, run rebuild-summaries to fix")
+        raise SystemExit(1)
+    print("All maintenance summaries are in sync")
+
+# Bulk load vehicles or maintenance records from a file, e.g.
+# "flask --app app import maintenance records.csv --batch-size 50000"
+@app.cli.command("import")
+@click.argument("kind", type=click.Choice(sorted(bulk.IMPORTERS)))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), help="Defaults to the file extension.")
+@click.option("--batch-size", default=bulk.BATCH_SIZE, show_default=True, help="Rows per transaction.")
+def import_command(kind, path, fmt, batch_size):
+    """Bulk load vehicles or maintenance records from a CSV or NDJSON file."""
+    fmt = fmt or bulk.detect_format(path)
+    with open(path, encoding="utf-8-sig", newline="") as stream:
+        # Only clears other processes' cache when it is shared
+        report = vehicles.import_file(kind, stream, fmt, batch_size)
+    for line, message in report.errors:
+        print(f"line {line}: {message}")
+    print(f"Imported {report.inserted} {kind}, rejected {report.rejected}")
+    if report.rejected:
+        raise SystemExit(1)
+
+# Stream an export to a file or stdout, e.g.
+# "flask --app app export maintenance_with_vehicles nightly.parquet --start 2024-01-01"
+@app.cli.command("export")
+@click.argument("dataset", type=click.Choice(sorted(bulk.EXPORTS)))
+@click.argument("path", default="-")
+@click.option("--format", "fmt", type=click.Choice(sorted(bulk.EXPORT_FORMATS)), help="Defaults to the file extension, or csv.")
+@click.option("--vehicle-id", type=int, help="Only this vehicle.")
+@click.option("--start", help="Earliest service date, YYYY-MM-DD.")
+@click.option("--end", help="Latest service date, YYYY-MM-DD.")
+def export_command(dataset, path, fmt, vehicle_id, start, end):
+    """Export vehicles or maintenance records as CSV, NDJSON or Parquet."""
+    if fmt is None:
+        extension = path.rsplit(".", 1)[-1].lower()
+        fmt = extension if extension in bulk.EXPORT_FORMATS else "csv"
+    binary = fmt == "parquet"
+    with click.open_file(path, "wb" if binary else "w", encoding=None if binary else "utf-8") as output:
+        for chunk in vehicles.export(dataset, fmt, vehicle_id, start, end):
+            output.write(chunk)
+
+# Render a template chunk by chunk while its rows are still being read, so
+# neither the result set nor the page is ever held in memory as a whole.
+# stream_template sends the render signals, so /metrics times the whole page
+def stream_page(template_name, **context):
+    chunks = stream_template(template_name, **context)
+    return Response(join_chunks(chunks), mimetype="text/html")
+
+# Group Jinja's many tiny pieces into fewer, larger writes
+def join_chunks(chunks, size=100):
+    buffer = []
+    for chunk in chunks:
+        buffer.append(chunk)
+        if len(buffer) >= size:
+            yield "".join(buffer)
+            buffer.clear()
+    if buffer:
+        yield "".join(buffer)
+
+# List of vehicles, one keyset page at a time
 @app.route("/")
 @app.route("/list")
 def list_vehicles():
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    
-    # Fetch vehicles with their maintenance count
-    cursor.execute("""
-        SELECT 
-            vehicles.id, 
-            vehicles.owner_name, 
-            vehicles.make, 
-            vehicles.model, 
-            vehicles.year,
-            COUNT(maintenance.id) as maintenance_count
-        FROM 
-            vehicles 
-        LEFT JOIN 
-            maintenance ON vehicles.id = maintenance.vehicle_id
-        GROUP BY 
-            vehicles.id
-    """)
-    vehicles = cursor.fetchall()
-    connection.close()
-    
-    return render_template("list.html", vehicles=vehicles)
+    if is_streaming(request.args):
+        return stream_page("list.html", vehicles=vehicles.iter_all())
+
+    cursor_token, limit = page_args(request.args)
+
+    # Fetch a page of vehicles with their maintenance summary
+    try:
+        rows, next_cursor, prev_cursor = vehicles.page(cursor_token, limit)
+    except ValueError:
+        abort(400, "Invalid page cursor")
+
+    return render_template(
+        "list.html",
+        vehicles=rows,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+        limit=limit
+    )
 
 # Create a new vehicle
 @app.route("/add", methods=['GET', 'POST'])
 def add_vehicle():
     if request.method == 'POST':
-        # Extract and validate form data
-        data = dict(request.form)
-        
-        try:
-            # Ensure year is an integer
-            data['year'] = int(data['year'])
-        except ValueError:
-            # Handle invalid year input
-            data['year'] = None
-        
-        connection = get_db_connection()
-        cursor = connection.cursor()
-        
-        # Parameterized insert to prevent SQL injection
-        cursor.execute("""
-            INSERT INTO vehicles (owner_name, make, model, year) 
-            VALUES (?, ?, ?, ?)
-        """, (
-            data['owner_name'], 
-            data['make'], 
-            data['model'], 
-            data['year']
-        ))
-        
-        connection.commit()
-        connection.close()
-        
+        vehicles.add(vehicle_params(request.form))
         return redirect(url_for('list_vehicles'))
-    
+
     return render_template("create.html")
 
 # Update vehicle details
 @app.route("/update/<int:vehicle_id>", methods=['GET', 'POST'])
 def update_vehicle(vehicle_id):
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    
     if request.method == 'GET':
         # Retrieve specific vehicle for update
-        cursor.execute("SELECT * FROM vehicles WHERE id = ?", (vehicle_id,))
-        vehicle = cursor.fetchone()
-        
+        vehicle = vehicles.get(vehicle_id)
+
         if vehicle is None:
-            connection.close()
             return "Vehicle not found", 404
-        
-        connection.close()
+
         return render_template("update.html", vehicle=vehicle)
-    
-    if request.method == 'POST':
-        data = dict(request.form)
-        
-        try:
-            data['year'] = int(data['year'])
-        except ValueError:
-            data['year'] = None
-        
-        # Parameterized update
-        cursor.execute("""
-            UPDATE vehicles 
-            SET owner_name=?, make=?, model=?, year=? 
-            WHERE id=?
-        """, (
-            data['owner_name'], 
-            data['make'], 
-            data['model'], 
-            data['year'], 
-            vehicle_id
-        ))
-        
-        connection.commit()
-        connection.close()
-        
-        return redirect(url_for('list_vehicles'))
 
-# Delete a vehicle
+    vehicles.update(vehicle_id, vehicle_params(request.form))
+    return redirect(url_for('list_vehicles'))
+
+# Delete a vehicle and its maintenance records
 @app.route("/delete/<int:vehicle_id>")
 def delete_vehicle(vehicle_id):
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    
-    try:
-        # Delete vehicle and its associated maintenance records
-        cursor.execute("DELETE FROM maintenance WHERE vehicle_id = ?", (vehicle_id,))
-        cursor.execute("DELETE FROM vehicles WHERE id = ?", (vehicle_id,))
-        connection.commit()
-    except sqlite3.Error as e:
-        # Basic error handling
-        print(f"An error occurred: {e}")
-    finally:
-        connection.close()
-    
+    vehicles.delete(vehicle_id)
     return redirect(url_for('list_vehicles'))
 
-# View maintenance history
+# View maintenance history, one keyset page at a time
 @app.route("/vehicle/<int:vehicle_id>/maintenance")
 def view_maintenance_history(vehicle_id):
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    
+    cursor_token, limit = page_args(request.args)
+
     # Fetch vehicle details
-    cursor.execute("SELECT * FROM vehicles WHERE id = ?", (vehicle_id,))
-    vehicle = cursor.fetchone()
-    
+    vehicle = vehicles.get(vehicle_id)
+
     if vehicle is None:
-        connection.close()
         return "Vehicle not found", 404
 
-    # Fetch maintenance records with sorting
-    cursor.execute("""
-        SELECT maintenance.id, vehicles.owner_name, vehicles.make, vehicles.model, maintenance.service_date, maintenance.description, maintenance.cost
-        FROM maintenance 
-        JOIN vehicles ON maintenance.vehicle_id = vehicles.id
-        WHERE maintenance.vehicle_id = ? 
-        ORDER BY maintenance.service_date DESC
-    """, (vehicle_id,))
-    maintenance_history = cursor.fetchall()
-    
-    connection.close()
-    
+    if is_streaming(request.args):
+        return stream_page(
+            "maintenance_history.html",
+            vehicle=vehicle,
+            maintenance=vehicles.iter_history(vehicle_id),
+            vehicle_id=vehicle_id
+        )
+
+    # Fetch a page of maintenance records, from the cache when unchanged
+    try:
+        page = vehicles.history_page(vehicle_id, cursor_token, limit)
+    except ValueError:
+        abort(400, "Invalid page cursor")
+
     return render_template(
-        "maintenance_history.html", 
-        vehicle=vehicle, 
-        maintenance=maintenance_history,
-        vehicle_id=vehicle_id
+        "maintenance_history.html",
+        vehicle=vehicle,
+        maintenance=page["rows"],
+        vehicle_id=vehicle_id,
+        next_cursor=page["next"],
+        prev_cursor=page["prev"],
+        limit=limit
+    )
+
+# Bulk import from an uploaded CSV or NDJSON file
+@app.route("/import", methods=['GET', 'POST'])
+def import_data():
+    if request.method == 'POST':
+        options = import_options(request.form, request.files)
+        if options is None:
+            return "Choose what to import and a file", 400
+
+        kind, upload, fmt, batch_size = options
+        try:
+            report = vehicles.import_file(kind, bulk.text_stream(upload.stream), fmt, batch_size)
+        except (ValueError, UnicodeDecodeError) as e:
+            return f"Could not read the file: {e}", 400
+
+        # Scripts posting files get the report as JSON
+        if request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json":
+            return report.as_dict()
+        return render_template("import.html", report=report, kind=kind)
+
+    return render_template("import.html")
+
+# Streamed export, e.g. /export/maintenance.csv?vehicle_id=3&start=2024-01-01
+@app.route("/export/<dataset>.<fmt>")
+def export_data(dataset, fmt):
+    if not is_export(dataset, fmt):
+        return "Unknown export", 404
+
+    try:
+        chunks = vehicles.export(dataset, fmt, **export_options(request.args))
+    except ValueError as e:
+        # Parquet without pyarrow installed
+        return str(e), 501
+
+    # No Content-Length, so the response goes out with chunked encoding
+    return Response(
+        stream_with_context(chunks),
+        mimetype=bulk.EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={dataset}.{fmt}"}
     )
 
 # Add maintenance record
 @app.route("/vehicle/<int:vehicle_id>/maintenance/add", methods=['GET', 'POST'])
 def add_maintenance_record(vehicle_id):
-    connection = get_db_connection()
-    cursor = connection.cursor()
-
     # Validate vehicle existence
-    cursor.execute("SELECT * FROM vehicles WHERE id = ?", (vehicle_id,))
-    if cursor.fetchone() is None:
-        connection.close()
+    if vehicles.get(vehicle_id) is None:
         return "Vehicle not found", 404
 
     if request.method == 'POST':
-        data = dict(request.form)
-        
-        try:
-            data['cost'] = float(data['cost'])
-        except ValueError:
-            data['cost'] = 0.0
-        
-        # Parameterized insert for maintenance record
-        cursor.execute("""
-            INSERT INTO maintenance 
-            (vehicle_id, service_date, description, cost) 
-            VALUES (?, ?, ?, ?)
-        """, (
-            vehicle_id, 
-            data['service_date'], 
-            data['description'], 
-            data['cost']
-        ))
-        
-        connection.commit()
-        connection.close()
-        
+        vehicles.add_maintenance(maintenance_params(vehicle_id, request.form))
         return redirect(url_for('view_maintenance_history', vehicle_id=vehicle_id))
-    
-    connection.close()
+
     return render_template("add_maintenance_record.html", vehicle_id=vehicle_id)
 
+def test_streamed_page_records_template_time():
+    print("test streamed_page_records_template_time")
+    global vehicles
+    from database import INSERT_VEHICLE_SQL, _test_database
+    saved = vehicles
+    vehicles = Vehicles(_test_database(connection_factory=metrics.connection_class), vehicle_cache)
+    vehicle_cache.clear()
+    try:
+        with vehicles.db.connection() as connection:
+            connection.executemany(INSERT_VEHICLE_SQL, [(f"owner {i}", "make", "model", 2000) for i in range(300)])
+            connection.commit()
+
+        def renders():
+            series = metrics.template_seconds.series.get(("list.html",))
+            return series[-1] if series else 0
+
+        before = renders()
+        response = app.test_client().get("/list?stream=1")
+        listing = response.get_data(as_text=True)
+        assert response.status_code == 200
+        assert all(f"owner {i}<" in listing for i in range(300))
+        assert renders() == before + 1
+    finally:
+        vehicles.db.close()
+        vehicles = saved
+        vehicle_cache.clear()
+
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        test_streamed_page_records_template_time()
+        print("done.")
+    else:
+        app.run(debug=True)
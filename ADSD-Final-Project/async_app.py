@@ -0,0 +1,396 @@
+# Async variant of app.py for serving many slow or idle clients from one
+# process, e.g. tablets polling a maintenance history page. Same routes and
+# templates, served with Quart on an ASGI server:
+#
+#     pip install quart hypercorn
+#     hypercorn async_app:app --bind 127.0.0.1:8000
+#
+# What each route does lives in vehicles.py, shared with app.py. SQLite
+# calls block, so those run on a thread pool with one thread per pooled
+# connection. The event loop only parses requests and renders templates, so
+# requests waiting on the database hold a coroutine instead of a worker.
+# loadtest.py compares this with app.py.
+import asyncio
+import contextvars
+import functools
+import itertools
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from quart import Quart, render_template, stream_template, request, redirect, url_for, abort, Response
+
+import bulk
+from cache import VehicleCache, backend_from_env
+from metrics import Metrics, slow_query_threshold
+from database import Database, WriteQueue, STREAM_BATCH_SIZE
+from vehicles import (
+    Vehicles,
+    register_filters,
+    page_args,
+    is_streaming,
+    vehicle_params,
+    maintenance_params,
+    import_options,
+    export_options,
+    is_export,
+)
+
+
+app = Quart(__name__)
+
+# format_date and format_cost, shared with app.py
+register_filters(app)
+
+# Route, query and template timings at /metrics, as in app.py
+metrics = Metrics(slow_query_seconds=slow_query_threshold())
+metrics.init_quart_app(app)
+
+db = Database("database.db", connection_factory=metrics.connection_class)
+vehicle_cache = VehicleCache(backend_from_env())
+
+# Set MAINTENANCE_GROUP_COMMIT=1 to commit maintenance records in groups,
+# requests wait on the group's commit without holding a database thread
+write_queue = WriteQueue(db) if os.environ.get("MAINTENANCE_GROUP_COMMIT") else None
+
+vehicles = Vehicles(db, vehicle_cache, write_queue)
+
+# One thread per pooled connection. A job on these threads holds at most one
+# connection and returns it before it ends, streamed pages and exports
+# included since they check one out per batch, so a job never waits for a
+# connection and a client that stops reading holds none
+db_executor = ThreadPoolExecutor(max_workers=db.pool_size, thread_name_prefix="db")
+
+
+# Run a blocking database or cache call without blocking the event loop. It
+# runs in a copy of the request's context, so its queries count towards the
+# request in /metrics
+async def run_db(function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, context.run, functools.partial(function, *args, **kwargs))
+
+# Read a blocking iterator in batches on the database threads
+async def iterate_in_thread(iterator, batch_size=STREAM_BATCH_SIZE):
+    while True:
+        batch = await run_db(lambda: list(itertools.islice(iterator, batch_size)))
+        if not batch:
+            return
+        for item in batch:
+            yield item
+
+# Render a template chunk by chunk as its rows arrive, like stream_page in
+# app.py. Jinja yields many tiny pieces and each would be its own send on the
+# event loop, so group them into fewer, larger writes
+async def stream_page(template_name, **context):
+    chunks = await stream_template(template_name, **context)
+    return Response(join_chunks(chunks), mimetype="text/html")
+
+async def join_chunks(chunks, size=100):
+    buffer = []
+    async for chunk in chunks:
+        buffer.append(chunk)
+        if len(buffer) >= size:
+            yield "".join(buffer)
+            buffer.clear()
+    if buffer:
+        yield "".join(buffer)
+
+
+# Connection pool metrics
+@app.route("/stats/pool")
+async def pool_stats():
+    return vehicles.db.pool_stats()
+
+# Group commit metrics
+@app.route("/stats/writes")
+async def write_stats():
+    if vehicles.write_queue is None:
+        return "Group commit is off", 404
+    return vehicles.write_queue.stats()
+
+# Vehicle cache metrics
+@app.route("/stats/cache")
+async def cache_stats():
+    return vehicles.cache.stats()
+
+# List of vehicles, one keyset page at a time
+@app.route("/")
+@app.route("/list")
+async def list_vehicles():
+    if is_streaming(request.args):
+        return await stream_page("list.html", vehicles=iterate_in_thread(vehicles.iter_all()))
+
+    cursor_token, limit = page_args(request.args)
+    try:
+        rows, next_cursor, prev_cursor = await run_db(vehicles.page, cursor_token, limit)
+    except ValueError:
+        abort(400, "Invalid page cursor")
+
+    return await render_template(
+        "list.html",
+        vehicles=rows,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+        limit=limit
+    )
+
+# Create a new vehicle
+@app.route("/add", methods=['GET', 'POST'])
+async def add_vehicle():
+    if request.method == 'POST':
+        await run_db(vehicles.add, vehicle_params(await request.form))
+        return redirect(url_for('list_vehicles'))
+
+    return await render_template("create.html")
+
+# Update vehicle details
+@app.route("/update/<int:vehicle_id>", methods=['GET', 'POST'])
+async def update_vehicle(vehicle_id):
+    if request.method == 'GET':
+        vehicle = await run_db(vehicles.get, vehicle_id)
+        if vehicle is None:
+            return "Vehicle not found", 404
+        return await render_template("update.html", vehicle=vehicle)
+
+    await run_db(vehicles.update, vehicle_id, vehicle_params(await request.form))
+    return redirect(url_for('list_vehicles'))
+
+# Delete a vehicle and its maintenance records
+@app.route("/delete/<int:vehicle_id>")
+async def delete_vehicle(vehicle_id):
+    await run_db(vehicles.delete, vehicle_id)
+    return redirect(url_for('list_vehicles'))
+
+# View maintenance history, one keyset page at a time
+@app.route("/vehicle/<int:vehicle_id>/maintenance")
+async def view_maintenance_history(vehicle_id):
+    cursor_token, limit = page_args(request.args)
+
+    vehicle = await run_db(vehicles.get, vehicle_id)
+    if vehicle is None:
+        return "Vehicle not found", 404
+
+    if is_streaming(request.args):
+        return await stream_page(
+            "maintenance_history.html",
+            vehicle=vehicle,
+            maintenance=iterate_in_thread(vehicles.iter_history(vehicle_id)),
+            vehicle_id=vehicle_id
+        )
+
+    try:
+        page = await run_db(vehicles.history_page, vehicle_id, cursor_token, limit)
+    except ValueError:
+        abort(400, "Invalid page cursor")
+
+    return await render_template(
+        "maintenance_history.html",
+        vehicle=vehicle,
+        maintenance=page["rows"],
+        vehicle_id=vehicle_id,
+        next_cursor=page["next"],
+        prev_cursor=page["prev"],
+        limit=limit
+    )
+
+# Bulk import from an uploaded CSV or NDJSON file
+@app.route("/import", methods=['GET', 'POST'])
+async def import_data():
+    if request.method == 'POST':
+        options = import_options(await request.form, await request.files)
+        if options is None:
+            return "Choose what to import and a file", 400
+
+        kind, upload, fmt, batch_size = options
+        try:
+            report = await run_db(vehicles.import_file, kind, bulk.text_stream(upload.stream), fmt, batch_size)
+        except (ValueError, UnicodeDecodeError) as e:
+            return f"Could not read the file: {e}", 400
+
+        if request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json":
+            return report.as_dict()
+        return await render_template("import.html", report=report, kind=kind)
+
+    return await render_template("import.html")
+
+# Streamed export, e.g. /export/maintenance.csv?vehicle_id=3&start=2024-01-01
+@app.route("/export/<dataset>.<fmt>")
+async def export_data(dataset, fmt):
+    if not is_export(dataset, fmt):
+        return "Unknown export", 404
+
+    try:
+        chunks = vehicles.export(dataset, fmt, **export_options(request.args))
+    except ValueError as e:
+        return str(e), 501
+
+    return Response(
+        iterate_in_thread(chunks, batch_size=1),
+        mimetype=bulk.EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={dataset}.{fmt}"}
+    )
+
+# Add maintenance record
+@app.route("/vehicle/<int:vehicle_id>/maintenance/add", methods=['GET', 'POST'])
+async def add_maintenance_record(vehicle_id):
+    if await run_db(vehicles.get, vehicle_id) is None:
+        return "Vehicle not found", 404
+
+    if request.method == 'POST':
+        params = maintenance_params(vehicle_id, await request.form)
+        if vehicles.write_queue is not None:
+            # Wait for the group's commit on the loop, not on a database thread
+            await asyncio.wrap_future(vehicles.submit_maintenance(params))
+            await run_db(vehicles.maintenance_added, vehicle_id)
+        else:
+            await run_db(vehicles.add_maintenance, params)
+        return redirect(url_for('view_maintenance_history', vehicle_id=vehicle_id))
+
+    return await render_template("add_maintenance_record.html", vehicle_id=vehicle_id)
+
+@app.after_serving
+async def shutdown():
+    if write_queue is not None:
+        write_queue.close()
+    db_executor.shutdown(wait=True)
+    db.close()
+
+
+async def _asgi_get(path, paused=None, resume=None, pause_after=20000):
+    """
+    GET a path straight through the ASGI app, returns (status, body).
+
+    With paused and resume the client stops reading once pause_after bytes
+    of the body have arrived, sets paused, and reads on only after resume is
+    set, the way a tablet on a weak connection leaves the server waiting.
+    """
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "http",
+        "method": "GET", "path": path, "raw_path": path.encode(), "query_string": query.encode(),
+        "root_path": "", "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 80), "extensions": {},
+    }
+    requested = False
+    status = None
+    body = bytearray()
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # The client never disconnects
+        await asyncio.Future()
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            body.extend(message.get("body", b""))
+            if paused is not None and not paused.is_set() and len(body) >= pause_after:
+                paused.set()
+                await resume.wait()
+
+    await app(scope, receive, send)
+    return status, bytes(body)
+
+def _insert_test_rows(vehicle_count, record_count):
+    from database import INSERT_VEHICLE_SQL, INSERT_MAINTENANCE_SQL
+    with vehicles.db.connection() as connection:
+        connection.executemany(INSERT_VEHICLE_SQL, [(f"owner {i}", "make", "model", 2000) for i in range(vehicle_count)])
+        connection.executemany(INSERT_MAINTENANCE_SQL, [
+            (1, f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}", f"job {i}", 10.0) for i in range(record_count)
+        ])
+        connection.commit()
+
+def _run_on_test_database(test, **kwargs):
+    """Run the coroutine function test against a throwaway database"""
+    global vehicles, db_executor
+    from database import _test_database
+    saved = vehicles, db_executor
+    test_db = _test_database(connection_factory=metrics.connection_class, **kwargs)
+    vehicles = Vehicles(test_db, vehicle_cache)
+    db_executor = ThreadPoolExecutor(max_workers=test_db.pool_size, thread_name_prefix="db")
+    vehicle_cache.clear()
+    try:
+        asyncio.run(test())
+    finally:
+        db_executor.shutdown(wait=True)
+        test_db.close()
+        vehicles, db_executor = saved
+        vehicle_cache.clear()
+
+async def _slow_streams_and_a_request():
+    vehicle_count, record_count = 2000, 1500
+    _insert_test_rows(vehicle_count, record_count)
+
+    # More clients than pooled connections stop reading part way through
+    # streamed pages and an export
+    resume = asyncio.Event()
+    paused = [asyncio.Event() for _ in range(3)]
+    streams = [
+        asyncio.create_task(_asgi_get("/list?stream=1", paused[0], resume)),
+        asyncio.create_task(_asgi_get("/vehicle/1/maintenance?stream=1", paused[1], resume)),
+        asyncio.create_task(_asgi_get("/export/maintenance.csv?vehicle_id=1", paused[2], resume)),
+    ]
+    await asyncio.wait_for(asyncio.gather(*(event.wait() for event in paused)), 10)
+
+    # Every pooled connection is free for the requests behind them
+    assert vehicles.db.pool_stats()["in_use"] == 0
+    status, body = await asyncio.wait_for(_asgi_get("/update/2"), 10)
+    assert status == 200 and b"owner 1" in body
+    status, body = await asyncio.wait_for(_asgi_get("/list?limit=5"), 10)
+    assert status == 200 and b"owner 4" in body
+
+    resume.set()
+    (list_status, listing), (history_status, history), (export_status, export) = \
+        await asyncio.wait_for(asyncio.gather(*streams), 30)
+    assert list_status == history_status == export_status == 200
+    assert all(f"owner {i}<".encode() in listing for i in range(vehicle_count))
+    assert all(f"job {i}<".encode() in history for i in range(record_count))
+    assert len(export.splitlines()) == record_count + 1
+    assert vehicles.db.pool_stats()["in_use"] == 0
+
+def test_slow_streams_leave_connections_free():
+    print("test slow_streams_leave_connections_free")
+    _run_on_test_database(_slow_streams_and_a_request, pool_size=2, checkout_timeout=1)
+
+async def _requests_are_measured():
+    _insert_test_rows(300, 0)
+
+    def totals(histogram, labels):
+        series = histogram.series.get(labels)
+        return (series[-1], series[-2]) if series else (0, 0)
+
+    update = ("/update/<int:vehicle_id>", "GET")
+    requests, queries = totals(metrics.request_queries, update)
+    renders, _ = totals(metrics.template_seconds, ("list.html",))
+
+    status, _ = await _asgi_get("/update/1")
+    assert status == 200
+    status, listing = await _asgi_get("/list?stream=1")
+    assert status == 200 and b"owner 299<" in listing
+
+    # The vehicle lookup ran on a database thread and still counts
+    after_requests, after_queries = totals(metrics.request_queries, update)
+    assert after_requests == requests + 1 and after_queries > queries
+    assert totals(metrics.template_seconds, ("list.html",))[0] == renders + 1
+    status, text = await _asgi_get("/metrics")
+    assert status == 200
+    assert b'http_request_duration_seconds_count{route="/update/<int:vehicle_id>",method="GET",status="200"}' in text
+
+def test_requests_are_measured():
+    print("test requests_are_measured")
+    _run_on_test_database(_requests_are_measured)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        test_slow_streams_leave_connections_free()
+        test_requests_are_measured()
+        print("done.")
+    else:
+        app.run(debug=True)
@@ -0,0 +1,134 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from database import Database, WriteQueue, VEHICLE_PAGE_SQL, PAGE_SIZE, INSERT_MAINTENANCE_SQL
+
+# Storage profiles to compare, the first one is what SQLite does by default
+PROFILES = {
+    "rollback journal": {"journal_mode": "DELETE", "synchronous": "FULL", "cache_size": None,
+                         "mmap_size": None, "temp_store": None},
+    "wal (default)": {},
+}
+
+
+def seed(db, vehicles, records_per_vehicle):
+    with db.connection() as connection:
+        connection.executemany(
+            "INSERT INTO vehicles (owner_name, make, model, year) VALUES (?, ?, ?, ?)",
+            ((f"Owner {i}", "Make", "Model", 2000 + i % 25) for i in range(vehicles))
+        )
+        connection.executemany(
+            "INSERT INTO maintenance (vehicle_id, service_date, description, cost) VALUES (?, ?, ?, ?)",
+            ((i % vehicles + 1, "2024-01-01", "Oil change", 49.99)
+             for i in range(vehicles * records_per_vehicle))
+        )
+        connection.commit()
+
+
+def run(pragmas, readers=4, seconds=3.0, vehicles=500, records_per_vehicle=10):
+    """Return (reads/s, writes/s, lock errors) with one writer committing constantly"""
+    directory = tempfile.mkdtemp()
+    db = Database(os.path.join(directory, "bench.db"), pool_size=readers + 1, pragmas=pragmas)
+    seed(db, vehicles, records_per_vehicle)
+
+    stop = threading.Event()
+    counts = {"reads": 0, "writes": 0, "locked": 0}
+    counts_lock = threading.Lock()
+
+    def count(name):
+        with counts_lock:
+            counts[name] += 1
+
+    def reader():
+        while not stop.is_set():
+            try:
+                with db.connection() as connection:
+                    connection.execute(VEHICLE_PAGE_SQL["first"], (PAGE_SIZE,)).fetchall()
+                count("reads")
+            except Exception as e:
+                if "locked" not in str(e):
+                    raise
+                count("locked")
+
+    def writer():
+        while not stop.is_set():
+            try:
+                with db.connection() as connection:
+                    connection.execute(
+                        "INSERT INTO maintenance (vehicle_id, service_date, description, cost) VALUES (?, ?, ?, ?)",
+                        (1, "2024-06-01", "Tire rotation", 25.0)
+                    )
+                    connection.commit()
+                count("writes")
+            except Exception as e:
+                if "locked" not in str(e):
+                    raise
+                count("locked")
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    db.close()
+
+    return counts["reads"] / seconds, counts["writes"] / seconds, counts["locked"]
+
+
+def run_inserts(group_commit, writers=32, seconds=3.0):
+    """Return (durable inserts/s, average wait per insert) with writers posting constantly"""
+    directory = tempfile.mkdtemp()
+    # synchronous=FULL either way, so every acknowledged insert is on disk
+    db = Database(os.path.join(directory, "bench.db"), pool_size=writers, pragmas={"synchronous": "FULL"})
+    seed(db, 1, 0)
+    queue = WriteQueue(db) if group_commit else None
+
+    stop = threading.Event()
+    waits = []
+    waits_lock = threading.Lock()
+    params = (1, "2024-06-01", "Tire rotation", 25.0)
+
+    def writer():
+        while not stop.is_set():
+            start = time.perf_counter()
+            if queue is not None:
+                queue.execute(INSERT_MAINTENANCE_SQL, params)
+            else:
+                with db.connection() as connection:
+                    connection.execute(INSERT_MAINTENANCE_SQL, params)
+                    connection.commit()
+            with waits_lock:
+                waits.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    if queue is not None:
+        queue.close()
+    db.close()
+
+    return len(waits) / seconds, sum(waits) / len(waits)
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    print(f"{'profile':<20}{'reads/s':>12}{'writes/s':>12}{'locked':>10}")
+    for name, pragmas in PROFILES.items():
+        reads, writes, locked = run(pragmas, seconds=seconds)
+        print(f"{name:<20}{reads:>12.1f}{writes:>12.1f}{locked:>10}")
+
+    print()
+    print(f"{'maintenance inserts':<20}{'inserts/s':>12}{'avg ms':>12}")
+    for name, group_commit in (("commit per insert", False), ("group commit", True)):
+        inserts, wait = run_inserts(group_commit, seconds=seconds)
+        print(f"{name:<20}{inserts:>12.1f}{wait * 1000:>12.2f}")
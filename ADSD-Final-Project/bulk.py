@@ -0,0 +1,533 @@
+import csv
+import io
+import json
+import os
+import sqlite3
+
+from database import (
+    INSERT_MAINTENANCE_SQL,
+    STREAM_BATCH_SIZE,
+    SUMMARY_ADD_SQL,
+    SUMMARY_INSERT_TRIGGER_SQL,
+    parse_cost,
+    parse_year,
+)
+
+# Rows committed per transaction, and how many row errors a report keeps
+BATCH_SIZE = 10000
+MAX_REPORTED_ERRORS = 1000
+
+FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+# Vehicles may carry their own id so maintenance files can refer to them
+IMPORT_VEHICLE_SQL = """
+    INSERT INTO vehicles (id, owner_name, make, model, year)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def detect_format(filename, default="csv"):
+    """Pick csv or ndjson from a file name's extension"""
+    extension = os.path.splitext(filename or "")[1].lower()
+    return FORMATS.get(extension, default)
+
+
+def read_records(stream, fmt):
+    """
+    Yield (line number, record) pairs from a CSV or NDJSON text stream.
+
+    Records are dicts. A line that can't be parsed yields a ValueError in
+    place of the record so the caller can report it and carry on.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == "ndjson":
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f"invalid JSON: {e}")
+                continue
+            if not isinstance(record, dict):
+                yield line_number, ValueError("expected a JSON object")
+                continue
+            yield line_number, record
+    else:
+        raise ValueError(f"Unknown import format: {fmt}")
+
+
+def text_stream(binary):
+    """Wrap an uploaded binary file so it can be read line by line as text"""
+    return io.TextIOWrapper(binary, encoding="utf-8-sig", newline="")
+
+
+def _required(record, fields):
+    missing = [field for field in fields if record.get(field) in (None, "")]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+
+
+def _integer(record, field):
+    try:
+        return int(record[field])
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} is not an integer: {record[field]!r}")
+
+
+def vehicle_params(record):
+    """INSERT parameters for one vehicle record, coerced like the /add form"""
+    _required(record, ["owner_name", "make", "model"])
+    vehicle_id = None
+    if record.get("id") not in (None, ""):
+        vehicle_id = _integer(record, "id")
+    return (
+        vehicle_id,
+        record["owner_name"],
+        record["make"],
+        record["model"],
+        parse_year(record.get("year"))
+    )
+
+
+def maintenance_params(record):
+    """INSERT parameters for one maintenance record, coerced like the add record form"""
+    _required(record, ["vehicle_id", "service_date", "description"])
+    return (
+        _integer(record, "vehicle_id"),
+        record["service_date"],
+        record["description"],
+        parse_cost(record.get("cost"))
+    )
+
+
+# What each kind of import reads and writes
+IMPORTERS = {
+    "vehicles": (vehicle_params, IMPORT_VEHICLE_SQL),
+    "maintenance": (maintenance_params, INSERT_MAINTENANCE_SQL),
+}
+
+
+class ImportReport:
+    """Counts of loaded and rejected rows, with the first errors by line"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def as_dict(self):
+        return {"inserted": self.inserted, "rejected": self.rejected, "errors": self.errors}
+
+
+def _existing_vehicle_ids(connection, vehicle_ids):
+    vehicle_ids = list(vehicle_ids)
+    found = set()
+    # Stay well below SQLite's limit on bound parameters
+    for start in range(0, len(vehicle_ids), 500):
+        chunk = vehicle_ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = connection.execute(f"SELECT id FROM vehicles WHERE id IN ({placeholders})", chunk)
+        found.update(row[0] for row in rows)
+    return found
+
+
+def _summary_changes(batch):
+    # Count, cost and newest date added per vehicle, as SUMMARY_ADD_SQL params
+    changes = {}
+    for _, (vehicle_id, service_date, _, cost) in batch:
+        count, total, newest = changes.get(vehicle_id, (0, 0.0, service_date))
+        changes[vehicle_id] = (count + 1, total + cost, max(newest, service_date))
+    for vehicle_id, (count, total, newest) in changes.items():
+        yield count, total, newest, newest, vehicle_id
+
+
+def _load_batch(connection, kind, sql, batch, report):
+    if kind == "maintenance":
+        known = _existing_vehicle_ids(connection, {params[0] for _, params in batch})
+        kept = []
+        for line, params in batch:
+            if params[0] in known:
+                kept.append((line, params))
+            else:
+                report.reject(line, f"vehicle {params[0]} does not exist")
+        batch = kept
+
+    try:
+        connection.execute("BEGIN")
+        if kind == "maintenance":
+            # The per row summary trigger is the slowest part of a large load,
+            # so inside this transaction it is swapped for one update per
+            # vehicle. DDL is transactional, other connections never see the
+            # trigger missing and a rollback puts it back.
+            connection.execute("DROP TRIGGER maintenance_summary_insert")
+            connection.executemany(sql, (params for _, params in batch))
+            connection.executemany(SUMMARY_ADD_SQL, _summary_changes(batch))
+            connection.execute(SUMMARY_INSERT_TRIGGER_SQL)
+        else:
+            connection.executemany(sql, (params for _, params in batch))
+        connection.commit()
+        report.inserted += len(batch)
+        return
+    except sqlite3.IntegrityError:
+        connection.rollback()
+
+    # Something in the batch clashed (e.g. a duplicate vehicle id), redo it
+    # row by row so only the offending rows are rejected
+    for line, params in batch:
+        try:
+            connection.execute(sql, params)
+            report.inserted += 1
+        except sqlite3.IntegrityError as e:
+            report.reject(line, str(e))
+    connection.commit()
+
+
+def import_records(db, kind, stream, fmt="csv", batch_size=BATCH_SIZE):
+    """
+    Load vehicles or maintenance records from a CSV or NDJSON text stream.
+
+    The stream is read lazily and written with executemany, one transaction
+    per batch_size rows. Rows that fail validation are skipped and reported
+    by line number. Returns an ImportReport.
+    """
+    convert, sql = IMPORTERS[kind]
+    report = ImportReport()
+
+    with db.connection() as connection:
+        batch = []
+        for line, record in read_records(stream, fmt):
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                batch.append((line, convert(record)))
+            except ValueError as e:
+                report.reject(line, str(e))
+                continue
+
+            if len(batch) >= batch_size:
+                _load_batch(connection, kind, sql, batch, report)
+                batch = []
+
+        if batch:
+            _load_batch(connection, kind, sql, batch, report)
+
+    return report
+
+
+# What can be exported: the columns with their types, the query, and the
+# column the start/end date filters apply to
+EXPORTS = {
+    "vehicles": (
+        [("id", "int"), ("owner_name", "text"), ("make", "text"), ("model", "text"),
+         ("year", "int"), ("maintenance_count", "int"), ("total_cost", "float"),
+         ("last_service_date", "text")],
+        """
+        SELECT id, owner_name, make, model, year, maintenance_count, total_cost, last_service_date
+        FROM vehicles
+        """,
+        "vehicles.id",
+        "vehicles.last_service_date",
+    ),
+    "maintenance": (
+        [("id", "int"), ("vehicle_id", "int"), ("service_date", "text"),
+         ("description", "text"), ("cost", "float")],
+        """
+        SELECT id, vehicle_id, service_date, description, cost
+        FROM maintenance
+        """,
+        "maintenance.vehicle_id",
+        "maintenance.service_date",
+    ),
+    "maintenance_with_vehicles": (
+        [("id", "int"), ("vehicle_id", "int"), ("owner_name", "text"), ("make", "text"),
+         ("model", "text"), ("year", "int"), ("service_date", "text"),
+         ("description", "text"), ("cost", "float")],
+        """
+        SELECT maintenance.id, maintenance.vehicle_id, vehicles.owner_name, vehicles.make,
+               vehicles.model, vehicles.year, maintenance.service_date,
+               maintenance.description, maintenance.cost
+        FROM maintenance
+        JOIN vehicles ON vehicles.id = maintenance.vehicle_id
+        """,
+        "maintenance.vehicle_id",
+        "maintenance.service_date",
+    ),
+}
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def export_query(dataset, vehicle_id=None, start=None, end=None, after_id=False):
+    """
+    SQL and parameters for one export, optionally for one vehicle and a date
+    range. With after_id the SQL also takes the id to carry on after as its
+    last parameter, for reading the export in keyset batches.
+    """
+    _, sql, vehicle_column, date_column = EXPORTS[dataset]
+    # id order is rowid order, so this never needs a sort over the full table
+    id_column = "vehicles.id" if dataset == "vehicles" else "maintenance.id"
+    conditions, params = [], []
+    if vehicle_id is not None:
+        conditions.append(f"{vehicle_column} = ?")
+        params.append(vehicle_id)
+    if start:
+        conditions.append(f"{date_column} >= ?")
+        params.append(start)
+    if end:
+        conditions.append(f"{date_column} <= ?")
+        params.append(end)
+    if after_id:
+        conditions.append(f"{id_column} > ?")
+    if conditions:
+        sql += "WHERE " + " AND ".join(conditions) + "\n"
+    return sql + f"ORDER BY {id_column}", params
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_chunks(columns, rows, batch_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in _batches(rows, batch_size):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(columns, rows, batch_size):
+    for batch in _batches(rows, batch_size):
+        yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in batch)
+
+
+class _DrainedOutput(io.RawIOBase):
+    # Parquet writes column offsets using tell(), so the position has to
+    # keep counting even though written bytes are handed out and dropped
+    def __init__(self):
+        self.pending = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.pending.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.pending)
+        self.pending = []
+        return data
+
+
+def _pyarrow():
+    # pyarrow is only needed for Parquet, so it is imported on first use
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Parquet export needs the pyarrow package installed")
+    return pyarrow
+
+
+def parquet_chunks(column_types, rows, batch_size):
+    pyarrow = _pyarrow()
+    arrow_types = {"int": pyarrow.int64(), "float": pyarrow.float64(), "text": pyarrow.string()}
+    schema = pyarrow.schema([(name, arrow_types[kind]) for name, kind in column_types])
+    output = _DrainedOutput()
+    writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(output, mode="w"), schema)
+    # Each batch becomes one row group, flushed to the client as it is written
+    for batch in _batches(rows, batch_size):
+        columns = list(zip(*batch))
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=schema.field(i).type) for i, column in enumerate(columns)],
+            schema=schema
+        ))
+        yield output.drain()
+    writer.close()
+    yield output.drain()
+
+
+def export_records(db, dataset, fmt, vehicle_id=None, start=None, end=None, batch_size=STREAM_BATCH_SIZE):
+    """
+    Yield an export of vehicles or maintenance records chunk by chunk.
+
+    Rows come from Database.iter_keyset in batches by id and each batch is
+    encoded and handed on before the next is read, so memory stays flat
+    whatever the table size, and no connection is held while the client
+    reads. CSV and NDJSON chunks are text, Parquet is bytes.
+    """
+    if dataset not in EXPORTS:
+        raise ValueError(f"Unknown export: {dataset}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    if fmt == "parquet":
+        # Checked now rather than when the first chunk is asked for
+        _pyarrow()
+
+    column_types = EXPORTS[dataset][0]
+    columns = [name for name, _ in column_types]
+    sql, params = export_query(dataset, vehicle_id, start, end)
+    queries = {
+        "first": sql + " LIMIT ?",
+        "next": export_query(dataset, vehicle_id, start, end, after_id=True)[0] + " LIMIT ?",
+    }
+    # Plain tuples are smaller than sqlite3.Row and all the writers need
+    rows = (tuple(row) for row in db.iter_keyset(queries, params, ["id"], batch_size))
+
+    if fmt == "csv":
+        return csv_chunks(columns, rows, batch_size)
+    if fmt == "ndjson":
+        return ndjson_chunks(columns, rows, batch_size)
+    return parquet_chunks(column_types, rows, batch_size)
+
+
+def test_import_vehicles_and_maintenance():
+    print("test import_vehicles_and_maintenance")
+    from database import _test_database
+    db = _test_database()
+    vehicles = io.StringIO(
+        "id,owner_name,make,model,year\n"
+        "10,Ann,Ford,Focus,2012\n"
+        "11,Bob,Honda,Civic,not a year\n"
+        ",Cat,Kia,Rio,2020\n"
+        "12,,Audi,A4,2018\n"
+    )
+    report = import_records(db, "vehicles", vehicles, "csv", batch_size=2)
+    assert report.inserted == 3
+    assert report.errors == [(5, "missing owner_name")]
+
+    maintenance = io.StringIO(
+        '{"vehicle_id": 10, "service_date": "2024-01-01", "description": "oil", "cost": "45.5"}\n'
+        '{"vehicle_id": 11, "service_date": "2024-02-01", "description": "tires", "cost": "n/a"}\n'
+        '\n'
+        '{"vehicle_id": 99, "service_date": "2024-02-01", "description": "ghost", "cost": 1}\n'
+        'not json\n'
+        '{"vehicle_id": "x", "service_date": "2024-02-01", "description": "bad id"}\n'
+    )
+    report = import_records(db, "maintenance", maintenance, "ndjson")
+    assert report.inserted == 2
+    assert [line for line, _ in report.errors] == [5, 6, 4]
+
+    with db.connection() as connection:
+        rows = connection.execute("SELECT id, year, maintenance_count, total_cost FROM vehicles ORDER BY id").fetchall()
+    assert [tuple(row) for row in rows] == [(10, 2012, 1, 45.5), (11, None, 1, 0.0), (12, 2020, 0, 0.0)]
+
+def test_import_duplicate_ids():
+    print("test import_duplicate_ids")
+    from database import _test_database
+    db = _test_database()
+    vehicles = io.StringIO(
+        "id,owner_name,make,model,year\n"
+        "1,Ann,Ford,Focus,2012\n"
+        "1,Bob,Honda,Civic,2013\n"
+        "2,Cat,Kia,Rio,2020\n"
+    )
+    report = import_records(db, "vehicles", vehicles, "csv")
+    assert report.inserted == 2
+    assert report.rejected == 1
+    assert report.errors[0][0] == 3
+
+
+def _export_test_database():
+    from database import _test_database
+    db = _test_database()
+    import_records(db, "vehicles", io.StringIO(
+        "id,owner_name,make,model,year\n1,Ann,Ford,Focus,2012\n2,Bob,Honda,Civic,2013\n"
+    ), "csv")
+    import_records(db, "maintenance", io.StringIO(
+        "vehicle_id,service_date,description,cost\n"
+        "1,2024-01-01,oil,40\n"
+        "2,2024-02-01,\"brakes, front\",150.5\n"
+        "1,2024-03-01,tires,300\n"
+    ), "csv")
+    return db
+
+def test_export_csv_and_ndjson():
+    print("test export_csv_and_ndjson")
+    db = _export_test_database()
+    exported = "".join(export_records(db, "maintenance", "csv", batch_size=2))
+    assert exported == "".join(export_records(db, "maintenance", "csv", batch_size=1))
+    assert exported.splitlines() == [
+        "id,vehicle_id,service_date,description,cost",
+        "1,1,2024-01-01,oil,40.0",
+        '2,2,2024-02-01,"brakes, front",150.5',
+        "3,1,2024-03-01,tires,300.0",
+    ]
+    # Read back through the importer, what we write we can load again
+    assert [record["description"] for _, record in read_records(io.StringIO(exported), "csv")] == \
+        ["oil", "brakes, front", "tires"]
+
+    exported = "".join(export_records(db, "maintenance_with_vehicles", "ndjson", vehicle_id=1, start="2024-02-01"))
+    records = [json.loads(line) for line in exported.splitlines()]
+    assert records == [{"id": 3, "vehicle_id": 1, "owner_name": "Ann", "make": "Ford", "model": "Focus",
+                        "year": 2012, "service_date": "2024-03-01", "description": "tires", "cost": 300.0}]
+
+    # Nothing to export still gives a CSV header
+    assert "".join(export_records(db, "vehicles", "csv", vehicle_id=99)) == \
+        "id,owner_name,make,model,year,maintenance_count,total_cost,last_service_date\r\n"
+    assert db.pool_stats()["in_use"] == 0
+
+def test_export_parquet():
+    print("test export_parquet")
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        print("  skipped, pyarrow is not installed")
+        return
+    db = _export_test_database()
+    exported = b"".join(export_records(db, "maintenance", "parquet", batch_size=2))
+    table = pyarrow.parquet.read_table(io.BytesIO(exported))
+    assert table.num_rows == 3
+    assert table.column("cost").to_pylist() == [40.0, 150.5, 300.0]
+    assert pyarrow.parquet.ParquetFile(io.BytesIO(exported)).num_row_groups == 2
+
+def test_export_plans():
+    print("test export_plans")
+    db = _export_test_database()
+    for dataset in EXPORTS:
+        sql, params = export_query(dataset, vehicle_id=1, start="2024-01-01")
+        plan = " ".join(db.explain(sql, params))
+        assert "SCAN" not in plan, f"{dataset} for one vehicle scans: {plan}"
+        sql, params = export_query(dataset, vehicle_id=1, start="2024-01-01", after_id=True)
+        plan = " ".join(db.explain(sql, params + [1]))
+        assert "SCAN" not in plan, f"{dataset} batches for one vehicle scan: {plan}"
+
+
+if __name__ == "__main__":
+    test_import_vehicles_and_maintenance()
+    test_import_duplicate_ids()
+    test_export_csv_and_ndjson()
+    test_export_parquet()
+    test_export_plans()
+    print("done.")
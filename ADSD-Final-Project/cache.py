@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Returned by cache backends for keys they don't hold
+MISSING = object()
+
+
+class LRUCache:
+    """In-process cache with a size bound and a time to live per entry"""
+
+    def __init__(self, maxsize=10000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires at, value), oldest first
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "local",
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class SharedCache:
+    """
+    Cache kept in a store shared by every worker process.
+
+    The client only needs redis-py's get, set(ex=) and delete, so a
+    redis.Redis instance works, and so does LocalStore for tests. Values
+    are stored as JSON.
+    """
+
+    def __init__(self, client, ttl=30, prefix="adsd:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return MISSING
+        return json.loads(value)
+
+    def set(self, key, value):
+        # Shared stores expire in whole seconds
+        self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(self.ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def stats(self):
+        return {"backend": "shared"}
+
+
+class LocalStore:
+    """Stand-in for a redis client, holding values in this process"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._values.get(key, (None, None))
+            if expires is not None and expires < time.monotonic():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            expires = time.monotonic() + ex if ex else None
+            self._values[key] = (value.encode() if isinstance(value, str) else value, expires)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+
+def backend_from_env():
+    """A SharedCache on VEHICLE_CACHE_REDIS_URL when it is set, else an LRUCache"""
+    url = os.environ.get("VEHICLE_CACHE_REDIS_URL")
+    if url:
+        import redis
+        return SharedCache(redis.Redis.from_url(url))
+    return LRUCache(maxsize=10000, ttl=30)
+
+
+class VehicleCache:
+    """
+    Read-through cache of vehicle rows and maintenance history pages.
+
+    Every entry for a vehicle is stored under that vehicle's generation
+    token, so invalidate() drops the row and all of its history pages at
+    once by handing out a new token. A reader that raced a writer can only
+    store what it read under the retired token, where nobody looks again.
+    clear() does the same for every vehicle with a cache-wide epoch token.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats_lock = threading.Lock()
+        self._stats = {"vehicle_hits": 0, "vehicle_misses": 0, "history_hits": 0, "history_misses": 0}
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _token(self, key):
+        token = self.backend.get(key)
+        if token is MISSING:
+            # First use, or evicted: start over with a token no entry has
+            token = uuid.uuid4().hex
+            self.backend.set(key, token)
+        return token
+
+    def _generation(self, vehicle_id):
+        epoch = self._token("epoch")
+        return epoch + ":" + self._token(f"generation:{epoch}:{vehicle_id}")
+
+    def _read_through(self, kind, key, load):
+        value = self.backend.get(key)
+        if value is not MISSING:
+            self._count(f"{kind}_hits")
+            return value
+        self._count(f"{kind}_misses")
+        value = load()
+        self.backend.set(key, value)
+        return value
+
+    def vehicle(self, vehicle_id, load):
+        """The vehicle as a dict, or None when it doesn't exist; load() on a miss"""
+        key = f"vehicle:{vehicle_id}:{self._generation(vehicle_id)}"
+        return self._read_through("vehicle", key, load)
+
+    def history(self, vehicle_id, page, load):
+        """One page of a vehicle's history; page identifies it, e.g. (cursor, limit)"""
+        page_key = ":".join(str(part) for part in page)
+        key = f"history:{vehicle_id}:{self._generation(vehicle_id)}:{page_key}"
+        return self._read_through("history", key, load)
+
+    def invalidate(self, vehicle_id):
+        """Forget everything cached for a vehicle after it or its history changed"""
+        epoch = self._token("epoch")
+        self.backend.set(f"generation:{epoch}:{vehicle_id}", uuid.uuid4().hex)
+
+    def clear(self):
+        """Forget everything, e.g. after a bulk import touched many vehicles"""
+        self.backend.set("epoch", uuid.uuid4().hex)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        for kind in ("vehicle", "history"):
+            lookups = stats[f"{kind}_hits"] + stats[f"{kind}_misses"]
+            stats[f"{kind}_hit_ratio"] = stats[f"{kind}_hits"] / lookups if lookups else 0.0
+        stats.update(self.backend.stats())
+        return stats
+
+
+def test_lru_cache():
+    print("test lru_cache")
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a is now the most recently used
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
+
+    cache = LRUCache(ttl=0)
+    cache.set("a", 1)
+    assert cache.get("a") is MISSING
+    assert cache.stats()["expirations"] == 1
+
+def test_vehicle_cache_invalidation():
+    for backend in (LRUCache(), SharedCache(LocalStore())):
+        print(f"test vehicle_cache_invalidation {backend.stats()['backend']}")
+        cache = VehicleCache(backend)
+        loads = []
+
+        def load(value):
+            loads.append(value)
+            return value
+
+        assert cache.vehicle(1, lambda: load({"id": 1, "make": "Ford"})) == {"id": 1, "make": "Ford"}
+        assert cache.vehicle(1, lambda: load({"id": 1, "make": "Kia"})) == {"id": 1, "make": "Ford"}
+        assert cache.history(1, (None, 50), lambda: load({"rows": [1]})) == {"rows": [1]}
+        assert cache.history(1, (None, 50), lambda: load({"rows": [2]})) == {"rows": [1]}
+        # Missing vehicles are remembered too, until one is added with that id
+        assert cache.vehicle(2, lambda: load(None)) is None
+        assert cache.vehicle(2, lambda: load({"id": 2})) is None
+        assert len(loads) == 3
+
+        cache.invalidate(1)
+        cache.invalidate(2)
+        assert cache.vehicle(1, lambda: load({"id": 1, "make": "Kia"})) == {"id": 1, "make": "Kia"}
+        assert cache.history(1, (None, 50), lambda: load({"rows": [2]})) == {"rows": [2]}
+        assert cache.vehicle(2, lambda: load({"id": 2})) == {"id": 2}
+
+        stats = cache.stats()
+        assert (stats["vehicle_hits"], stats["vehicle_misses"]) == (2, 4)
+        assert (stats["history_hits"], stats["history_misses"]) == (1, 2)
+
+def test_vehicle_cache_survives_eviction():
+    print("test vehicle_cache_survives_eviction")
+    backend = LRUCache()
+    cache = VehicleCache(backend)
+    cache.vehicle(1, lambda: {"id": 1, "make": "Ford"})
+    # Losing the tokens must never bring back an old entry
+    backend.delete("generation:" + backend.get("epoch") + ":1")
+    assert cache.vehicle(1, lambda: {"id": 1, "make": "Kia"}) == {"id": 1, "make": "Kia"}
+    backend.delete("epoch")
+    assert cache.vehicle(1, lambda: {"id": 1, "make": "VW"}) == {"id": 1, "make": "VW"}
+
+def test_vehicle_cache_clear():
+    print("test vehicle_cache_clear")
+    cache = VehicleCache(LRUCache())
+    cache.vehicle(1, lambda: {"id": 1})
+    cache.history(2, (None, 50), lambda: {"rows": [1]})
+    cache.clear()
+    assert cache.vehicle(1, lambda: None) is None
+    assert cache.history(2, (None, 50), lambda: {"rows": []}) == {"rows": []}
+
+
+if __name__ == "__main__":
+    test_lru_cache()
+    test_vehicle_cache_invalidation()
+    test_vehicle_cache_survives_eviction()
+    test_vehicle_cache_clear()
+    print("done.")
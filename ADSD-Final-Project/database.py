@@ -1,17 +1,572 @@
+import base64
+import json
 import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+# Storage profile applied to every connection the pool opens. WAL lets
+# readers keep going while a writer commits, busy_timeout makes writers from
+# other processes wait instead of failing with "database is locked".
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",    # durable in WAL mode, fsync only on checkpoint
+    "cache_size": -16000,       # negative means KiB, about 16 MB per connection
+    "mmap_size": 268435456,     # 256 MB
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,       # milliseconds
+}
+
+
+# Recompute every vehicle's summary from the maintenance table
+REBUILD_SUMMARIES_SQL = """
+    UPDATE vehicles
+    SET maintenance_count = (
+            SELECT COUNT(*) FROM maintenance WHERE vehicle_id = vehicles.id
+        ),
+        total_cost = (
+            SELECT COALESCE(SUM(cost), 0) FROM maintenance WHERE vehicle_id = vehicles.id
+        ),
+        last_service_date = (
+            SELECT MAX(service_date) FROM maintenance WHERE vehicle_id = vehicles.id
+        )
+"""
+
+# Keeps a vehicle's summary current as maintenance rows are added
+SUMMARY_INSERT_TRIGGER_SQL = """
+    CREATE TRIGGER IF NOT EXISTS maintenance_summary_insert
+    AFTER INSERT ON maintenance
+    BEGIN
+        UPDATE vehicles
+        SET maintenance_count = maintenance_count + 1,
+            total_cost = total_cost + NEW.cost,
+            last_service_date = MAX(COALESCE(last_service_date, NEW.service_date), NEW.service_date)
+        WHERE id = NEW.vehicle_id;
+    END
+"""
+
+# The same change applied for many inserted rows at once:
+# (added count, added cost, newest date, newest date, vehicle id)
+SUMMARY_ADD_SQL = """
+    UPDATE vehicles
+    SET maintenance_count = maintenance_count + ?,
+        total_cost = total_cost + ?,
+        last_service_date = MAX(COALESCE(last_service_date, ?), ?)
+    WHERE id = ?
+"""
+
+# Schema changes applied in order on top of the base tables. The position in
+# this list is the schema version kept in PRAGMA user_version, so existing
+# database files pick up new entries the next time the app starts.
+MIGRATIONS = [
+    # 1: history lookup by vehicle sorted by date, and deletes by vehicle
+    [
+        """
+        CREATE INDEX IF NOT EXISTS idx_maintenance_vehicle_date
+            ON maintenance (vehicle_id, service_date)
+        """,
+    ],
+    # 2: per vehicle maintenance summary, so the list never has to join and
+    # group maintenance. Triggers keep it in sync with every write path.
+    [
+        "ALTER TABLE vehicles ADD COLUMN maintenance_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE vehicles ADD COLUMN total_cost REAL NOT NULL DEFAULT 0",
+        SUMMARY_INSERT_TRIGGER_SQL,
+        """
+        CREATE TRIGGER IF NOT EXISTS maintenance_summary_delete
+        AFTER DELETE ON maintenance
+        BEGIN
+            UPDATE vehicles
+            SET maintenance_count = maintenance_count - 1,
+                total_cost = total_cost - OLD.cost,
+                last_service_date = (
+                    SELECT MAX(service_date) FROM maintenance WHERE vehicle_id = OLD.vehicle_id
+                )
+            WHERE id = OLD.vehicle_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS maintenance_summary_update
+        AFTER UPDATE OF vehicle_id, service_date, cost ON maintenance
+        BEGIN
+            UPDATE vehicles
+            SET maintenance_count = maintenance_count - 1,
+                total_cost = total_cost - OLD.cost,
+                last_service_date = (
+                    SELECT MAX(service_date) FROM maintenance WHERE vehicle_id = OLD.vehicle_id
+                )
+            WHERE id = OLD.vehicle_id;
+            UPDATE vehicles
+            SET maintenance_count = maintenance_count + 1,
+                total_cost = total_cost + NEW.cost,
+                last_service_date = (
+                    SELECT MAX(service_date) FROM maintenance WHERE vehicle_id = NEW.vehicle_id
+                )
+            WHERE id = NEW.vehicle_id;
+        END
+        """,
+        # Existing rows start out with the right numbers
+        REBUILD_SUMMARIES_SQL,
+    ],
+]
+
+# Vehicles whose stored summary disagrees with the maintenance table
+VERIFY_SUMMARIES_SQL = """
+    SELECT 
+        vehicles.id,
+        vehicles.maintenance_count,
+        vehicles.total_cost,
+        vehicles.last_service_date,
+        COUNT(maintenance.id) AS actual_count,
+        COALESCE(SUM(maintenance.cost), 0) AS actual_total_cost,
+        MAX(maintenance.service_date) AS actual_last_service_date
+    FROM 
+        vehicles
+    LEFT JOIN 
+        maintenance ON maintenance.vehicle_id = vehicles.id
+    GROUP BY 
+        vehicles.id
+    HAVING 
+        vehicles.maintenance_count != actual_count
+        OR ABS(vehicles.total_cost - actual_total_cost) > 0.005
+        OR vehicles.last_service_date IS NOT actual_last_service_date
+"""
+
+# Queries used by the routes in app.py, kept together here so that
+# test_query_plans can check every one of them against the schema
+LIST_VEHICLES_SQL = """
+    SELECT 
+        id, 
+        owner_name, 
+        make, 
+        model, 
+        year,
+        maintenance_count,
+        total_cost,
+        last_service_date
+    FROM 
+        vehicles 
+    {where}
+    ORDER BY
+        id {order}
+"""
+
+# Every vehicle in list order, the rows the streaming list page reads in
+# keyset batches through Database.iter_keyset
+ALL_VEHICLES_SQL = LIST_VEHICLES_SQL.format(where="", order="")
+
+# Keyset pages of the vehicle list, ordered by vehicles.id
+VEHICLE_PAGE_SQL = {
+    "first": LIST_VEHICLES_SQL.format(where="", order="") + "LIMIT ?",
+    "next": LIST_VEHICLES_SQL.format(where="WHERE id > ?", order="") + "LIMIT ?",
+    "prev": LIST_VEHICLES_SQL.format(where="WHERE id < ?", order="DESC") + "LIMIT ?",
+}
+
+GET_VEHICLE_SQL = "SELECT * FROM vehicles WHERE id = ?"
+
+INSERT_VEHICLE_SQL = """
+    INSERT INTO vehicles (owner_name, make, model, year) 
+    VALUES (?, ?, ?, ?)
+"""
+
+UPDATE_VEHICLE_SQL = """
+    UPDATE vehicles 
+    SET owner_name=?, make=?, model=?, year=? 
+    WHERE id=?
+"""
+
+DELETE_VEHICLE_MAINTENANCE_SQL = "DELETE FROM maintenance WHERE vehicle_id = ?"
+
+DELETE_VEHICLE_SQL = "DELETE FROM vehicles WHERE id = ?"
+
+MAINTENANCE_HISTORY_SQL = """
+    SELECT maintenance.id, vehicles.owner_name, vehicles.make, vehicles.model, maintenance.service_date, maintenance.description, maintenance.cost
+    FROM maintenance 
+    JOIN vehicles ON maintenance.vehicle_id = vehicles.id
+    WHERE maintenance.vehicle_id = ? {where}
+    ORDER BY maintenance.service_date {order}, maintenance.id {order}
+"""
+
+# Full history of one vehicle, the rows the streaming history page reads
+# in keyset batches through Database.iter_keyset
+ALL_MAINTENANCE_SQL = MAINTENANCE_HISTORY_SQL.format(where="", order="DESC")
+
+# Keyset pages of one vehicle's history, newest first by (service_date, id)
+MAINTENANCE_PAGE_SQL = {
+    "first": MAINTENANCE_HISTORY_SQL.format(where="", order="DESC") + "LIMIT ?",
+    "next": MAINTENANCE_HISTORY_SQL.format(
+        where="AND (maintenance.service_date, maintenance.id) < (?, ?)", order="DESC") + "LIMIT ?",
+    "prev": MAINTENANCE_HISTORY_SQL.format(
+        where="AND (maintenance.service_date, maintenance.id) > (?, ?)", order="ASC") + "LIMIT ?",
+}
+
+INSERT_MAINTENANCE_SQL = """
+    INSERT INTO maintenance 
+    (vehicle_id, service_date, description, cost) 
+    VALUES (?, ?, ?, ?)
+"""
+
+# Every route query with sample parameters, and the tables it may read in
+# full. The first vehicle page has no key to seek to, so it walks vehicles
+# from the start but stops after LIMIT rows, and the streamed list reads
+# every vehicle by design; anything else that turns into a SCAN is a
+# missing index.
+ROUTE_QUERIES = {
+    "all_vehicles": (ALL_VEHICLES_SQL, (), {"vehicles"}),
+    "all_maintenance": (ALL_MAINTENANCE_SQL, (1,), set()),
+    "vehicle_page_first": (VEHICLE_PAGE_SQL["first"], (50,), {"vehicles"}),
+    "vehicle_page_next": (VEHICLE_PAGE_SQL["next"], (1, 50), set()),
+    "vehicle_page_prev": (VEHICLE_PAGE_SQL["prev"], (100, 50), set()),
+    "get_vehicle": (GET_VEHICLE_SQL, (1,), set()),
+    "insert_vehicle": (INSERT_VEHICLE_SQL, ("owner", "make", "model", 2000), set()),
+    "update_vehicle": (UPDATE_VEHICLE_SQL, ("owner", "make", "model", 2000, 1), set()),
+    "delete_vehicle_maintenance": (DELETE_VEHICLE_MAINTENANCE_SQL, (1,), set()),
+    "delete_vehicle": (DELETE_VEHICLE_SQL, (1,), set()),
+    "maintenance_page_first": (MAINTENANCE_PAGE_SQL["first"], (1, 50), set()),
+    "maintenance_page_next": (MAINTENANCE_PAGE_SQL["next"], (1, "2024-01-01", 1, 50), set()),
+    "maintenance_page_prev": (MAINTENANCE_PAGE_SQL["prev"], (1, "2024-01-01", 1, 50), set()),
+    "insert_maintenance": (INSERT_MAINTENANCE_SQL, (1, "2024-01-01", "oil", 1.0), set()),
+}
+
+# Page size limits for the paginated listings
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Rows pulled from SQLite per fetchmany call when streaming a result
+STREAM_BATCH_SIZE = 500
+
+
+def parse_year(value):
+    """Coerce a submitted year the way the vehicle forms do, None when invalid"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_cost(value):
+    """Coerce a submitted cost the way the maintenance form does, 0.0 when invalid"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def page_size(value):
+    """Clamp a requested page size, falling back to PAGE_SIZE when invalid"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def encode_cursor(direction, key):
+    """Turn a page direction and the key of the boundary row into a URL token"""
+    raw = json.dumps([direction] + list(key), separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor, raises ValueError for tokens we didn't make"""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        direction, *key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError(f"Invalid page cursor: {token!r}")
+    if direction not in ("next", "prev"):
+        raise ValueError(f"Invalid page cursor: {token!r}")
+    return direction, key
+
+
+def keyset_page(connection, queries, params, key_columns, cursor=None, limit=PAGE_SIZE):
+    """
+    Fetch one page with the "first"/"next"/"prev" queries of a keyset.
+
+    Returns (rows, next_cursor, prev_cursor). One extra row is fetched to
+    know whether another page follows, so no COUNT(*) is ever needed.
+    """
+    def key_of(row):
+        return [row[column] for column in key_columns]
+
+    if cursor is None:
+        direction, key = "first", []
+    else:
+        direction, key = decode_cursor(cursor)
+        if len(key) != len(key_columns):
+            raise ValueError(f"Invalid page cursor: {cursor!r}")
+
+    rows = connection.execute(queries[direction], (*params, *key, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if direction == "prev":
+        # Fetched walking backwards, put the page back in display order
+        rows.reverse()
+        next_cursor = encode_cursor("next", key_of(rows[-1])) if rows else None
+        prev_cursor = encode_cursor("prev", key_of(rows[0])) if has_more else None
+    else:
+        next_cursor = encode_cursor("next", key_of(rows[-1])) if has_more else None
+        if direction == "next":
+            prev_cursor = encode_cursor("prev", key_of(rows[0]) if rows else key)
+        else:
+            prev_cursor = None
+
+    return rows, next_cursor, prev_cursor
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free in time"""
+
 
 class Database:
-    def __init__(self, db_path):
+    def __init__(self, db_path, pool_size=8, idle_timeout=300, checkout_timeout=30,
+                 pragmas=None, checkpoint_interval=60, connection_factory=sqlite3.Connection):
         self.db_path = db_path
+        self.connection_factory = connection_factory
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+
+        # Caller overrides win over the defaults, None drops a setting
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        self.pragmas.update(pragmas or {})
+        self.pragmas = {name: value for name, value in self.pragmas.items() if value is not None}
+        self.checkpoint_interval = checkpoint_interval
+        self._last_checkpoint = time.monotonic()
+
+        # Connection pool state, everything below is guarded by _lock
+        self._lock = threading.Condition()
+        self._idle = []  # (connection, time it was returned), most recent last
+        self._open = 0   # connections currently open, idle or checked out
+        self._stats = {
+            "checkouts": 0,
+            "in_use": 0,
+            "created": 0,
+            "discarded": 0,
+            "timeouts": 0,
+            "wait_time": 0.0,
+            "max_wait_time": 0.0,
+        }
+
         self.init_db()
 
     def _connect(self):
-        return sqlite3.connect(self.db_path)
+        connection = sqlite3.connect(self.db_path, check_same_thread=False,
+                                     factory=self.connection_factory)
+        connection.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            connection.execute(f"PRAGMA {name} = {value}")
+        return connection
+
+    def storage_profile(self):
+        """Return the settings a pooled connection is actually running with"""
+        with self.connection() as connection:
+            return {
+                name: connection.execute(f"PRAGMA {name}").fetchone()[0]
+                for name in self.pragmas
+            }
+
+    def checkpoint(self, mode="PASSIVE"):
+        """Copy the WAL back into the database file, returns (busy, log, checkpointed)"""
+        with self.connection() as connection:
+            return tuple(connection.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+
+    def _checkpoint_due(self):
+        if str(self.pragmas.get("journal_mode", "")).upper() != "WAL" or not self.checkpoint_interval:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_checkpoint < self.checkpoint_interval:
+                return False
+            self._last_checkpoint = now
+            return True
+
+    def _is_healthy(self, connection):
+        try:
+            connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _close_expired(self):
+        # Idle list is ordered oldest first, so stop at the first fresh one
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] < cutoff:
+            connection, _ = self._idle.pop(0)
+            connection.close()
+            self._open -= 1
+            self._stats["discarded"] += 1
+
+    def _checkout(self):
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        connection = None
+
+        with self._lock:
+            while True:
+                self._close_expired()
+                if self._idle:
+                    connection, _ = self._idle.pop()
+                    break
+                if self._open < self.pool_size:
+                    # Reserve a slot, the connection is opened outside the lock
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"No database connection free after {self.checkout_timeout}s"
+                    )
+                self._lock.wait(remaining)
+
+            waited = time.monotonic() - start
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            self._stats["wait_time"] += waited
+            self._stats["max_wait_time"] = max(self._stats["max_wait_time"], waited)
+
+        # Replace connections that went bad while sitting in the pool
+        if connection is not None and not self._is_healthy(connection):
+            connection.close()
+            connection = None
+            with self._lock:
+                self._stats["discarded"] += 1
+
+        if connection is None:
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                    self._stats["in_use"] -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self._stats["created"] += 1
+
+        return connection
+
+    def _checkin(self, connection):
+        # Never hand the next borrower a half-finished transaction
+        reusable = True
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+            # Keep the WAL from growing without bound between automatic
+            # checkpoints, PASSIVE never blocks readers or writers
+            elif self._checkpoint_due():
+                connection.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        except sqlite3.Error:
+            reusable = False
+
+        with self._lock:
+            self._stats["in_use"] -= 1
+            if reusable and self._open <= self.pool_size:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                connection.close()
+                self._open -= 1
+                self._stats["discarded"] += 1
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection for the duration of a with block"""
+        connection = self._checkout()
+        try:
+            yield connection
+        finally:
+            self._checkin(connection)
+
+    def iter_query(self, sql, params=(), batch_size=STREAM_BATCH_SIZE):
+        """
+        Yield the rows of a query lazily, batch_size rows at a time.
+
+        The pooled connection stays checked out until the generator is
+        exhausted or closed, so only one batch is ever held in memory.
+        """
+        with self.connection() as connection:
+            cursor = connection.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+
+    def iter_keyset(self, queries, params, key_columns, batch_size=STREAM_BATCH_SIZE):
+        """
+        Yield every row of a keyset's "first" and "next" queries, batch_size
+        rows at a time, for streaming to clients that may read slowly.
+
+        Unlike iter_query, a connection is only checked out while a batch is
+        fetched, so a reader that stalls between batches holds none. The
+        batches are separate reads: rows committed while the stream runs
+        show up if they sort after the batches already sent.
+        """
+        cursor = None
+        while True:
+            with self.connection() as connection:
+                rows, cursor, _ = keyset_page(connection, queries, params, key_columns, cursor, batch_size)
+            yield from rows
+            if cursor is None:
+                return
+
+    def pool_stats(self):
+        """Return a snapshot of the pool metrics"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["open"] = self._open
+            stats["idle"] = len(self._idle)
+            stats["pool_size"] = self.pool_size
+        if stats["checkouts"]:
+            stats["avg_wait_time"] = stats["wait_time"] / stats["checkouts"]
+        else:
+            stats["avg_wait_time"] = 0.0
+        return stats
+
+    def close(self):
+        """Close every idle connection, checked out ones are closed on return"""
+        with self._lock:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                connection.close()
+                self._open -= 1
+
+    def explain(self, sql, params=()):
+        """Return the EXPLAIN QUERY PLAN detail lines for a query"""
+        with self.connection() as connection:
+            rows = connection.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        return [row["detail"] for row in rows]
+
+    def rebuild_summaries(self):
+        """Recompute maintenance_count, total_cost and last_service_date for every vehicle"""
+        with self.connection() as connection:
+            updated = connection.execute(REBUILD_SUMMARIES_SQL).rowcount
+            connection.commit()
+        return updated
+
+    def verify_summaries(self):
+        """Return the vehicles whose stored summary is out of sync, empty when all is well"""
+        with self.connection() as connection:
+            return [dict(row) for row in connection.execute(VERIFY_SUMMARIES_SQL)]
+
+    def schema_version(self):
+        with self.connection() as connection:
+            return connection.execute("PRAGMA user_version").fetchone()[0]
 
     def init_db(self):
-        with self._connect() as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
 
+            # Take the write lock up front so workers starting at the same
+            # time don't both apply the same migration
+            cursor.execute("BEGIN IMMEDIATE")
+
             # Vehicles table
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS vehicles (
@@ -35,4 +590,633 @@ class Database:
                     FOREIGN KEY (vehicle_id) REFERENCES vehicles(id)
                 )
             """)
+
+            # Bring older database files up to date
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(f"PRAGMA user_version = {number}")
             conn.commit()
+
+
+class WriteQueue:
+    """
+    Group commit for small writes from many request threads.
+
+    Writes queued with submit() are run by one writer thread, as many as
+    have arrived (up to max_batch, waiting at most max_delay for more) in a
+    single transaction, so the whole group shares one commit. The writer's
+    connection runs with synchronous=FULL, so the commit fsyncs, and a
+    write's future only resolves once its group is on disk. Each write gets
+    its own savepoint: one that fails is rolled back and reported to its
+    submitter without taking the rest of the group with it.
+    """
+
+    def __init__(self, db, max_batch=256, max_delay=0.002, synchronous="FULL"):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._connection = db._connect()
+        self._connection.execute(f"PRAGMA synchronous = {synchronous}")
+
+        # Pending writes, guarded by _lock: (sql, params, future)
+        self._lock = threading.Condition()
+        self._pending = deque()
+        self._closed = False
+        self._stats = {"batches": 0, "writes": 0, "failed": 0, "largest_batch": 0}
+
+        self._thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, sql, params=()):
+        """Queue a write, the future resolves to its lastrowid once committed"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("write queue is closed")
+            self._pending.append((sql, params, future))
+            self._lock.notify()
+        return future
+
+    def execute(self, sql, params=(), timeout=None):
+        """Queue a write and wait until it is durable, returns its lastrowid"""
+        return self.submit(sql, params).result(timeout)
+
+    def _next_batch(self):
+        with self._lock:
+            while not self._pending and not self._closed:
+                self._lock.wait()
+            # Give writes arriving right behind the first one a chance to join
+            deadline = time.monotonic() + self.max_delay
+            while len(self._pending) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            count = min(self.max_batch, len(self._pending))
+            return [self._pending.popleft() for _ in range(count)]
+
+    def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    # Only empty once closed and drained
+                    break
+                self._write(batch)
+        except Exception as e:
+            # _write reports its own errors, so this is a bug in the queue.
+            # Stop taking writes rather than leave submitters waiting forever
+            self._abort(e, batch)
+        finally:
+            self._connection.close()
+
+    def _abort(self, error, batch):
+        # Fail the batch being written and everything still queued
+        with self._lock:
+            self._closed = True
+            futures = [future for _, _, future in batch] + [future for _, _, future in self._pending]
+            self._pending.clear()
+        for future in futures:
+            if not future.done() and (future.running() or future.set_running_or_notify_cancel()):
+                future.set_exception(error)
+
+    def _write(self, batch):
+        connection = self._connection
+        results = []
+        started = 0  # futures in batch already moved out of pending
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for sql, params, future in batch:
+                started += 1
+                if not future.set_running_or_notify_cancel():
+                    continue
+                results.append((future, None, None))
+                connection.execute("SAVEPOINT queued_write")
+                try:
+                    cursor = connection.execute(sql, params)
+                except sqlite3.Error as e:
+                    connection.execute("ROLLBACK TO queued_write")
+                    results[-1] = (future, None, e)
+                else:
+                    results[-1] = (future, cursor.lastrowid, None)
+                connection.execute("RELEASE queued_write")
+            connection.commit()
+        except Exception as e:
+            # Nothing in the group was committed, so every write in it fails
+            try:
+                if connection.in_transaction:
+                    connection.rollback()
+            except sqlite3.Error:
+                pass
+            results = [(future, None, e) for future, _, _ in results]
+            results += [(future, None, e) for _, _, future in batch[started:]
+                        if future.set_running_or_notify_cancel()]
+
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["writes"] += len(results)
+            self._stats["failed"] += sum(1 for _, _, error in results if error is not None)
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+        for future, rowid, error in results:
+            if error is None:
+                future.set_result(rowid)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        stats["avg_batch"] = stats["writes"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+    def close(self):
+        """Commit everything already queued, then stop the writer"""
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._thread.join()
+
+
+def _test_database(**kwargs):
+    # Tests run against a throwaway file so database.db is never touched
+    import os
+    import tempfile
+    directory = tempfile.mkdtemp()
+    return Database(os.path.join(directory, "test.db"), **kwargs)
+
+def test_pool_reuses_connections():
+    print("test pool_reuses_connections")
+    db = _test_database(pool_size=2)
+    with db.connection() as first:
+        pass
+    with db.connection() as second:
+        assert second is first
+    stats = db.pool_stats()
+    assert stats["created"] == 1
+    assert stats["in_use"] == 0
+    assert stats["idle"] == 1
+
+def test_pool_is_bounded():
+    print("test pool_is_bounded")
+    db = _test_database(pool_size=1, checkout_timeout=0.05)
+    with db.connection():
+        try:
+            with db.connection():
+                pass
+            assert False, "second checkout should have timed out"
+        except PoolTimeout:
+            pass
+    assert db.pool_stats()["timeouts"] == 1
+    assert db.pool_stats()["open"] == 1
+
+def test_pool_waits_for_return():
+    print("test pool_waits_for_return")
+    db = _test_database(pool_size=1, checkout_timeout=5)
+    borrowed = threading.Event()
+
+    def hold():
+        with db.connection():
+            borrowed.set()
+            time.sleep(0.05)
+
+    worker = threading.Thread(target=hold)
+    worker.start()
+    borrowed.wait()
+    with db.connection() as connection:
+        assert connection.execute("SELECT 1").fetchone()[0] == 1
+    worker.join()
+    assert db.pool_stats()["max_wait_time"] > 0
+
+def test_pool_rolls_back_on_return():
+    print("test pool_rolls_back_on_return")
+    db = _test_database(pool_size=1)
+    with db.connection() as connection:
+        connection.execute("INSERT INTO vehicles (owner_name, make, model, year) VALUES ('a', 'b', 'c', 2000)")
+    with db.connection() as connection:
+        count = connection.execute("SELECT COUNT(*) FROM vehicles").fetchone()[0]
+    assert count == 0
+
+def test_pool_replaces_broken_connections():
+    print("test pool_replaces_broken_connections")
+    db = _test_database(pool_size=1)
+    with db.connection() as connection:
+        connection.close()
+    with db.connection() as connection:
+        assert connection.execute("SELECT 1").fetchone()[0] == 1
+    assert db.pool_stats()["discarded"] == 1
+    assert db.pool_stats()["created"] == 2
+
+def test_storage_profile():
+    print("test storage_profile")
+    db = _test_database(pragmas={"synchronous": "FULL", "cache_size": -2000})
+    profile = db.storage_profile()
+    assert profile["journal_mode"] == "wal"
+    assert profile["synchronous"] == 2
+    assert profile["cache_size"] == -2000
+    assert profile["temp_store"] == 2
+    assert profile["busy_timeout"] == 5000
+
+def _read_during_exclusive_write(db):
+    # Count vehicles on one pooled connection while another holds an
+    # uncommitted write under an EXCLUSIVE lock
+    with db.connection() as writer:
+        writer.execute("BEGIN EXCLUSIVE")
+        writer.execute("INSERT INTO vehicles (owner_name, make, model, year) VALUES ('a', 'b', 'c', 2000)")
+        assert writer.in_transaction
+        try:
+            with db.connection() as reader:
+                assert reader is not writer
+                return reader.execute("SELECT COUNT(*) FROM vehicles").fetchone()[0]
+        finally:
+            writer.rollback()
+
+def test_reads_during_write():
+    print("test reads_during_write")
+    db = _test_database(pool_size=2, pragmas={"busy_timeout": 0})
+    assert db.storage_profile()["journal_mode"] == "wal"
+    with db.connection() as connection:
+        assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    # With WAL a reader sees the last committed state instead of blocking
+    assert _read_during_exclusive_write(db) == 0
+
+    # The same read fails on a rollback journal, so the WAL is what lets it run
+    db = _test_database(pool_size=2, pragmas={"journal_mode": "DELETE", "busy_timeout": 0})
+    assert db.storage_profile()["journal_mode"] == "delete"
+    try:
+        _read_during_exclusive_write(db)
+    except sqlite3.OperationalError as e:
+        assert "locked" in str(e)
+    else:
+        assert False, "a rollback journal should lock readers out"
+
+def test_periodic_checkpoint():
+    print("test periodic_checkpoint")
+    db = _test_database(checkpoint_interval=0.01)
+    time.sleep(0.02)
+    assert db._checkpoint_due()
+    assert not db._checkpoint_due()
+    busy, log, checkpointed = db.checkpoint("TRUNCATE")
+    assert busy == 0
+
+def test_migrations():
+    print("test migrations")
+    db = _test_database()
+    assert db.schema_version() == len(MIGRATIONS)
+    # Running init_db again on an up to date file is a no-op
+    db.init_db()
+    assert db.schema_version() == len(MIGRATIONS)
+    with db.connection() as connection:
+        indexes = [row["name"] for row in connection.execute("PRAGMA index_list(maintenance)")]
+    assert "idx_maintenance_vehicle_date" in indexes
+
+def test_migrations_upgrade_old_files():
+    print("test migrations_upgrade_old_files")
+    import os
+    import tempfile
+    # A database.db written before any migration existed
+    path = os.path.join(tempfile.mkdtemp(), "old.db")
+    old = sqlite3.connect(path)
+    old.executescript("""
+        CREATE TABLE vehicles (id INTEGER PRIMARY KEY AUTOINCREMENT, owner_name TEXT NOT NULL,
+            make TEXT NOT NULL, model TEXT NOT NULL, year INTEGER, last_service_date TEXT);
+        CREATE TABLE maintenance (id INTEGER PRIMARY KEY AUTOINCREMENT, vehicle_id INTEGER NOT NULL,
+            service_date TEXT NOT NULL, description TEXT NOT NULL, cost REAL NOT NULL,
+            FOREIGN KEY (vehicle_id) REFERENCES vehicles(id));
+        INSERT INTO vehicles (owner_name, make, model, year) VALUES ('owner', 'make', 'model', 2000);
+        INSERT INTO maintenance (vehicle_id, service_date, description, cost) VALUES (1, '2024-01-01', 'oil', 40.0);
+        INSERT INTO maintenance (vehicle_id, service_date, description, cost) VALUES (1, '2024-05-01', 'tires', 300.0);
+    """)
+    old.close()
+
+    db = Database(path)
+    assert db.schema_version() == len(MIGRATIONS)
+    assert "idx_maintenance_vehicle_date" in db.explain(MAINTENANCE_PAGE_SQL["first"], (1, 50))[-1]
+    with db.connection() as connection:
+        vehicle = connection.execute(GET_VEHICLE_SQL, (1,)).fetchone()
+    assert (vehicle["maintenance_count"], vehicle["total_cost"], vehicle["last_service_date"]) == (2, 340.0, "2024-05-01")
+
+def test_query_plans():
+    print("test query_plans")
+    db = _test_database()
+    for name, (sql, params, allowed_scans) in ROUTE_QUERIES.items():
+        for detail in db.explain(sql, params):
+            # Plans read "SCAN vehicles" or "SCAN maintenance USING ..."
+            if detail.startswith("SCAN "):
+                table = detail.split()[1]
+                assert table in allowed_scans, f"{name} scans {table}: {detail}"
+            assert "TEMP B-TREE" not in detail, f"{name} sorts in memory: {detail}"
+
+def test_vehicle_pages():
+    print("test vehicle_pages")
+    db = _test_database()
+    with db.connection() as connection:
+        connection.executemany(INSERT_VEHICLE_SQL, [(f"owner {i}", "make", "model", 2000) for i in range(7)])
+        connection.commit()
+
+        # Walk forward, every vehicle exactly once in id order
+        seen, pages, cursor = [], 0, None
+        while True:
+            rows, next_cursor, prev_cursor = keyset_page(connection, VEHICLE_PAGE_SQL, (), ["id"], cursor, 3)
+            assert (prev_cursor is None) == (cursor is None)
+            seen += [row["id"] for row in rows]
+            pages += 1
+            if next_cursor is None:
+                break
+            cursor = next_cursor
+        assert seen == list(range(1, 8))
+        assert pages == 3
+
+        # And back again from the last page
+        rows, next_cursor, prev_cursor = keyset_page(connection, VEHICLE_PAGE_SQL, (), ["id"], prev_cursor, 3)
+        assert [row["id"] for row in rows] == [4, 5, 6]
+        rows, next_cursor, prev_cursor = keyset_page(connection, VEHICLE_PAGE_SQL, (), ["id"], prev_cursor, 3)
+        assert [row["id"] for row in rows] == [1, 2, 3]
+        assert prev_cursor is None
+
+def test_maintenance_pages():
+    print("test maintenance_pages")
+    db = _test_database()
+    with db.connection() as connection:
+        connection.execute(INSERT_VEHICLE_SQL, ("owner", "make", "model", 2000))
+        # Several records share a date, so the id has to break ties
+        dates = ["2024-01-01", "2024-02-01", "2024-02-01", "2024-02-01", "2023-12-01"]
+        connection.executemany(INSERT_MAINTENANCE_SQL, [(1, date, "work", 1.0) for date in dates])
+        connection.commit()
+
+        expected = [(row["service_date"], row["id"]) for row in connection.execute(
+            "SELECT service_date, id FROM maintenance ORDER BY service_date DESC, id DESC")]
+        seen, cursor = [], None
+        while True:
+            rows, cursor, _ = keyset_page(
+                connection, MAINTENANCE_PAGE_SQL, (1,), ["service_date", "id"], cursor, 2
+            )
+            seen += [(row["service_date"], row["id"]) for row in rows]
+            if cursor is None:
+                break
+        assert seen == expected
+
+def test_page_arguments():
+    print("test page_arguments")
+    assert page_size(None) == PAGE_SIZE
+    assert page_size("abc") == PAGE_SIZE
+    assert page_size("0") == 1
+    assert page_size(str(MAX_PAGE_SIZE + 1)) == MAX_PAGE_SIZE
+    assert decode_cursor(encode_cursor("next", ["2024-01-01", 5])) == ("next", ["2024-01-01", 5])
+    for token in ["garbage", encode_cursor("sideways", [1])]:
+        try:
+            decode_cursor(token)
+            assert False, "cursor should have been rejected"
+        except ValueError:
+            pass
+
+def test_summaries_follow_writes():
+    print("test summaries_follow_writes")
+    db = _test_database()
+    with db.connection() as connection:
+        connection.execute(INSERT_VEHICLE_SQL, ("owner", "make", "model", 2000))
+        connection.execute(INSERT_VEHICLE_SQL, ("other", "make", "model", 2001))
+        connection.executemany(INSERT_MAINTENANCE_SQL, [
+            (1, "2024-01-01", "oil", 40.0),
+            (1, "2024-03-01", "tires", 300.0),
+            (2, "2024-02-01", "brakes", 150.0),
+        ])
+        connection.commit()
+        vehicle = connection.execute(GET_VEHICLE_SQL, (1,)).fetchone()
+        assert vehicle["maintenance_count"] == 2
+        assert vehicle["total_cost"] == 340.0
+        assert vehicle["last_service_date"] == "2024-03-01"
+
+        # Deleting the newest record falls back to the previous date
+        connection.execute("DELETE FROM maintenance WHERE description = 'tires'")
+        # Moving a record to another vehicle updates both
+        connection.execute("UPDATE maintenance SET vehicle_id = 1 WHERE description = 'brakes'")
+        connection.commit()
+        first = connection.execute(GET_VEHICLE_SQL, (1,)).fetchone()
+        second = connection.execute(GET_VEHICLE_SQL, (2,)).fetchone()
+        assert (first["maintenance_count"], first["total_cost"], first["last_service_date"]) == (2, 190.0, "2024-02-01")
+        assert (second["maintenance_count"], second["total_cost"], second["last_service_date"]) == (0, 0.0, None)
+
+        connection.execute(DELETE_VEHICLE_MAINTENANCE_SQL, (1,))
+        connection.commit()
+        first = connection.execute(GET_VEHICLE_SQL, (1,)).fetchone()
+        assert (first["maintenance_count"], first["total_cost"], first["last_service_date"]) == (0, 0.0, None)
+    assert db.verify_summaries() == []
+
+def test_rebuild_summaries():
+    print("test rebuild_summaries")
+    db = _test_database()
+    with db.connection() as connection:
+        connection.execute(INSERT_VEHICLE_SQL, ("owner", "make", "model", 2000))
+        connection.execute(INSERT_MAINTENANCE_SQL, (1, "2024-01-01", "oil", 40.0))
+        # Simulate drift, e.g. rows written before the triggers existed
+        connection.execute("UPDATE vehicles SET maintenance_count = 7, last_service_date = NULL")
+        connection.commit()
+    broken = db.verify_summaries()
+    assert [row["id"] for row in broken] == [1]
+    assert broken[0]["actual_count"] == 1
+    assert db.rebuild_summaries() == 1
+    assert db.verify_summaries() == []
+
+def test_iter_query():
+    print("test iter_query")
+    db = _test_database(pool_size=1)
+    with db.connection() as connection:
+        connection.executemany(INSERT_VEHICLE_SQL, [(f"owner {i}", "make", "model", 2000) for i in range(10)])
+        connection.commit()
+
+    rows = db.iter_query(ALL_VEHICLES_SQL, batch_size=3)
+    assert db.pool_stats()["in_use"] == 0  # nothing runs until the first row is asked for
+    assert next(rows)["id"] == 1
+    assert db.pool_stats()["in_use"] == 1
+    assert [row["id"] for row in rows] == list(range(2, 11))
+    assert db.pool_stats()["in_use"] == 0
+
+    # A reader that stops early, like a client disconnecting, returns the connection too
+    rows = db.iter_query(ALL_VEHICLES_SQL, batch_size=3)
+    next(rows)
+    rows.close()
+    assert db.pool_stats()["in_use"] == 0
+
+def test_iter_keyset():
+    print("test iter_keyset")
+    db = _test_database(pool_size=1)
+    with db.connection() as connection:
+        connection.executemany(INSERT_VEHICLE_SQL, [(f"owner {i}", "make", "model", 2000) for i in range(10)])
+        connection.executemany(INSERT_MAINTENANCE_SQL, [(1, f"2024-01-{i % 3 + 1:02d}", "oil", 1.0) for i in range(7)])
+        connection.commit()
+
+    rows = db.iter_keyset(VEHICLE_PAGE_SQL, (), ["id"], batch_size=3)
+    assert next(rows)["id"] == 1
+    # Between rows the connection is back in the pool, even mid-batch
+    assert db.pool_stats()["in_use"] == 0
+    with db.connection() as connection:
+        connection.execute(INSERT_VEHICLE_SQL, ("late", "make", "model", 2000))
+        connection.commit()
+    assert [row["id"] for row in rows] == list(range(2, 12))
+
+    # Same rows in the same order as the one query the sync app streams
+    with db.connection() as connection:
+        expected = [tuple(row) for row in connection.execute(ALL_MAINTENANCE_SQL, (1,))]
+    for batch_size in (1, 2, 7, 50):
+        history = db.iter_keyset(MAINTENANCE_PAGE_SQL, (1,), ["service_date", "id"], batch_size)
+        assert [tuple(row) for row in history] == expected
+    assert list(db.iter_keyset(MAINTENANCE_PAGE_SQL, (99,), ["service_date", "id"])) == []
+    assert db.pool_stats()["in_use"] == 0
+
+def test_pool_closes_idle_connections():
+    print("test pool_closes_idle_connections")
+    db = _test_database(idle_timeout=0)
+    with db.connection() as first:
+        pass
+    with db.connection() as second:
+        assert second is not first
+    assert db.pool_stats()["open"] == 1
+
+
+def test_write_queue_groups_commits():
+    print("test write_queue_groups_commits")
+    db = _test_database()
+    with db.connection() as connection:
+        connection.execute(INSERT_VEHICLE_SQL, ("Owner", "Make", "Model", 2020))
+        connection.commit()
+
+    queue = WriteQueue(db, max_delay=0.05)
+    writers = 40
+    barrier = threading.Barrier(writers)
+    ids = []
+
+    def write(i):
+        barrier.wait()
+        ids.append(queue.execute(INSERT_MAINTENANCE_SQL, (1, f"2024-01-{i % 28 + 1:02d}", "Oil", 10.0)))
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = queue.stats()
+    assert sorted(ids) == list(range(1, writers + 1))
+    assert stats["writes"] == writers
+    assert stats["batches"] < writers
+    # Each write was acknowledged after its commit, and the triggers ran
+    with db.connection() as connection:
+        vehicle = connection.execute(GET_VEHICLE_SQL, (1,)).fetchone()
+    assert vehicle["maintenance_count"] == writers
+    assert vehicle["total_cost"] == writers * 10.0
+    assert db.verify_summaries() == []
+    queue.close()
+
+def test_write_queue_isolates_failures():
+    print("test write_queue_isolates_failures")
+    db = _test_database()
+    queue = WriteQueue(db, max_delay=0.05)
+    good = queue.submit(INSERT_VEHICLE_SQL, ("Owner", "Make", "Model", 2020))
+    bad = queue.submit(INSERT_VEHICLE_SQL, (None, "Make", "Model", 2020))
+    also_good = queue.submit(INSERT_VEHICLE_SQL, ("Other", "Make", "Model", 2021))
+    assert good.result() == 1
+    assert also_good.result() == 2
+    try:
+        bad.result()
+        assert False, "NOT NULL violation was not reported"
+    except sqlite3.IntegrityError:
+        pass
+    assert queue.stats()["batches"] == 1
+
+    # close() commits what is still queued
+    last = queue.submit(INSERT_VEHICLE_SQL, ("Last", "Make", "Model", 2022))
+    queue.close()
+    assert last.result() == 3
+    try:
+        queue.submit(INSERT_VEHICLE_SQL, ("Late", "Make", "Model", 2022))
+        assert False, "closed queue accepted a write"
+    except RuntimeError:
+        pass
+    with db.connection() as connection:
+        assert connection.execute("SELECT COUNT(*) FROM vehicles").fetchone()[0] == 3
+
+class _FailingConnection(sqlite3.Connection):
+    """A connection whose statements starting with fail_on raise error"""
+    fail_on = None
+    error = None
+
+    def execute(self, sql, *args):
+        if self.fail_on and sql.startswith(self.fail_on):
+            raise self.error
+        return super().execute(sql, *args)
+
+def test_write_queue_survives_batch_errors():
+    print("test write_queue_survives_batch_errors")
+    db = _test_database(connection_factory=_FailingConnection)
+    queue = WriteQueue(db, max_delay=0.05)
+    # Between starting a write and recording it, then outside sqlite3 altogether
+    for fail_on, error in [("SAVEPOINT", sqlite3.OperationalError("disk I/O error")),
+                           ("RELEASE", ValueError("not a database error"))]:
+        queue._connection.fail_on, queue._connection.error = fail_on, error
+        futures = [queue.submit(INSERT_VEHICLE_SQL, (f"Owner {i}", "Make", "Model", 2020)) for i in range(3)]
+        for future in futures:
+            try:
+                future.result(timeout=5)
+                assert False, "write in a failed group was reported as committed"
+            except type(error) as e:
+                assert e is error
+        queue._connection.fail_on = None
+        assert queue._thread.is_alive()
+        assert queue.execute(INSERT_VEHICLE_SQL, ("After", "Make", "Model", 2020), timeout=5)
+
+    with db.connection() as connection:
+        assert [row[0] for row in connection.execute("SELECT owner_name FROM vehicles")] == ["After", "After"]
+    queue.close()
+
+def test_write_queue_fails_pending_when_writer_dies():
+    print("test write_queue_fails_pending_when_writer_dies")
+    db = _test_database()
+    queue = WriteQueue(db, max_delay=0.05)
+    crash = RuntimeError("writer bug")
+
+    def broken_write(batch):
+        raise crash
+
+    queue._write = broken_write
+    futures = [queue.submit(INSERT_VEHICLE_SQL, ("Owner", "Make", "Model", 2020)) for _ in range(3)]
+    queue._thread.join(5)
+    assert not queue._thread.is_alive()
+    for future in futures:
+        assert future.exception(timeout=5) is crash
+    try:
+        queue.submit(INSERT_VEHICLE_SQL, ("Late", "Make", "Model", 2020))
+        assert False, "dead queue accepted a write"
+    except RuntimeError:
+        pass
+
+
+if __name__ == "__main__":
+    test_pool_reuses_connections()
+    test_pool_is_bounded()
+    test_pool_waits_for_return()
+    test_pool_rolls_back_on_return()
+    test_pool_replaces_broken_connections()
+    test_pool_closes_idle_connections()
+    test_storage_profile()
+    test_reads_during_write()
+    test_periodic_checkpoint()
+    test_migrations()
+    test_migrations_upgrade_old_files()
+    test_query_plans()
+    test_vehicle_pages()
+    test_maintenance_pages()
+    test_page_arguments()
+    test_summaries_follow_writes()
+    test_rebuild_summaries()
+    test_iter_query()
+    test_iter_keyset()
+    test_write_queue_groups_commits()
+    test_write_queue_isolates_failures()
+    test_write_queue_survives_batch_errors()
+    test_write_queue_fails_pending_when_writer_dies()
+    print("done.")
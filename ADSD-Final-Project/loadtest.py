@@ -0,0 +1,124 @@
+# Load test for comparing app.py and async_app.py under many concurrent
+# clients. Start both, then point this at each of them:
+#
+#     flask --app app run --with-threads --port 5000
+#     hypercorn async_app:app --bind 127.0.0.1:8000
+#     python loadtest.py http://127.0.0.1:5000 http://127.0.0.1:8000 \
+#         --path /vehicle/1/maintenance --concurrency 200 --seconds 10
+#
+# Every client keeps one HTTP/1.1 connection open and sends its next request
+# as soon as the last response is read, like a tablet polling a page.
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+async def read_response(reader):
+    """Read one response, returns (status, keep the connection)"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    version, status = status_line.decode("latin-1").split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        # No length given, the body ends with the connection
+        await reader.read()
+        return int(status), False
+
+    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    return int(status), keep_alive
+
+
+async def client(host, port, paths, deadline, latencies, errors):
+    reader = writer = None
+    turn = 0
+    while time.monotonic() < deadline:
+        path = paths[turn % len(paths)]
+        turn += 1
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode())
+            await writer.drain()
+            status, keep_alive = await read_response(reader)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            errors["connection"] += 1
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.01)
+            continue
+        latencies.append(time.perf_counter() - start)
+        if status >= 400:
+            errors["status"] += 1
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run(url, paths, concurrency=100, seconds=10.0):
+    """Return throughput and latency percentiles for one server"""
+    parts = urlsplit(url)
+    latencies = []
+    errors = {"connection": 0, "status": 0}
+    deadline = time.monotonic() + seconds
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client(parts.hostname, parts.port or 80, paths, deadline, latencies, errors)
+        for _ in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else 0.0,
+        "connection_errors": errors["connection"],
+        "error_responses": errors["status"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare servers under concurrent polling")
+    parser.add_argument("urls", nargs="+", help="base URL of each server, e.g. http://127.0.0.1:5000")
+    parser.add_argument("--path", action="append", dest="paths",
+                        help="path to request, repeat to rotate through several (default /list)")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    print(f"{'server':<28}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for url in args.urls:
+        result = asyncio.run(run(url, args.paths or ["/list"], args.concurrency, args.seconds))
+        errors = result["connection_errors"] + result["error_responses"]
+        print(f"{url:<28}{result['requests_per_second']:>10.1f}"
+              f"{result['p50'] * 1000:>10.1f}{result['p95'] * 1000:>10.1f}"
+              f"{result['p99'] * 1000:>10.1f}{result['max'] * 1000:>10.1f}{errors:>8}")
@@ -0,0 +1,278 @@
+# What the routes of app.py and async_app.py do, without the web framework.
+# Both apps parse the request, call in here and render the result, so the
+# validation, pagination and cache invalidation behind a route live in one
+# place. Every Vehicles method blocks, async_app.py runs them on its
+# database threads.
+import sqlite3
+from datetime import datetime
+
+import bulk
+from database import (
+    VEHICLE_PAGE_SQL,
+    GET_VEHICLE_SQL,
+    INSERT_VEHICLE_SQL,
+    UPDATE_VEHICLE_SQL,
+    DELETE_VEHICLE_MAINTENANCE_SQL,
+    DELETE_VEHICLE_SQL,
+    MAINTENANCE_PAGE_SQL,
+    INSERT_MAINTENANCE_SQL,
+    keyset_page,
+    page_size,
+    parse_year,
+    parse_cost,
+)
+
+
+# Format the date to a more readable format
+def format_date(value):
+    # Ensure value is a string before trying to format it
+    value = str(value)
+
+    try:
+        # Try parsing it as a date in 'YYYY-MM-DD' format
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%B %d, %Y')
+    except ValueError:
+        # If it doesn't match the format, return the value as is
+        return value
+
+# Format the cost to two decimal places
+def format_cost(value):
+    try:
+        # Try converting the value to a float, then format it
+        return f"${float(value):.2f}"
+    except (ValueError, TypeError):
+        # If the value cannot be converted to float, return it as-is
+        return value
+
+def register_filters(app):
+    """The templates' filters, on a Flask or a Quart app"""
+    app.add_template_filter(format_date, "format_date")
+    app.add_template_filter(format_cost, "format_cost")
+
+
+# Request parsing, args and form are the request's MultiDicts, which Flask
+# and Quart share
+
+# Read the ?cursor= and ?limit= arguments of a paginated listing
+def page_args(args):
+    return args.get("cursor"), page_size(args.get("limit"))
+
+# Listings render every row in one streamed response when asked with ?stream=1
+def is_streaming(args):
+    return args.get("stream") in ("1", "true", "yes")
+
+def vehicle_params(form):
+    """(owner_name, make, model, year) from the add and update forms"""
+    # Ensure year is an integer, invalid input is stored as no year
+    return form['owner_name'], form['make'], form['model'], parse_year(form['year'])
+
+def maintenance_params(vehicle_id, form):
+    """(vehicle_id, service_date, description, cost) from the add form"""
+    return vehicle_id, form['service_date'], form['description'], parse_cost(form['cost'])
+
+def import_options(form, files):
+    """(kind, upload, format, batch size) of an import form, None when it
+    is missing what to import or the file"""
+    upload = files.get("file")
+    kind = form.get("kind")
+    if upload is None or kind not in bulk.IMPORTERS:
+        return None
+    fmt = form.get("format") or bulk.detect_format(upload.filename)
+    batch_size = form.get("batch_size", type=int) or bulk.BATCH_SIZE
+    return kind, upload, fmt, batch_size
+
+def export_options(args):
+    """Keyword arguments of Vehicles.export from /export's query string"""
+    return {
+        "vehicle_id": args.get("vehicle_id", type=int),
+        "start": args.get("start"),
+        "end": args.get("end"),
+    }
+
+def is_export(dataset, fmt):
+    return dataset in bulk.EXPORTS and fmt in bulk.EXPORT_FORMATS
+
+
+class Vehicles:
+    """
+    Vehicle and maintenance reads and writes for the routes, with the cache
+    in front of the lookups. Every write invalidates the vehicle it touched,
+    and maintenance records go through write_queue when there is one.
+    """
+
+    def __init__(self, db, cache, write_queue=None):
+        self.db = db
+        self.cache = cache
+        self.write_queue = write_queue
+
+    # Vehicle row as a plain dict, or None, so it can be cached
+    def _load(self, vehicle_id):
+        with self.db.connection() as connection:
+            vehicle = connection.execute(GET_VEHICLE_SQL, (vehicle_id,)).fetchone()
+        return dict(vehicle) if vehicle else None
+
+    def get(self, vehicle_id):
+        return self.cache.vehicle(vehicle_id, lambda: self._load(vehicle_id))
+
+    def page(self, cursor_token, limit):
+        """One keyset page of vehicles with their maintenance summary, as
+        (rows, next cursor, previous cursor). ValueError for a bad cursor."""
+        with self.db.connection() as connection:
+            return keyset_page(connection, VEHICLE_PAGE_SQL, (), ["id"], cursor_token, limit)
+
+    # One page of a vehicle's history, newest first, so it can be cached
+    def _load_history(self, vehicle_id, cursor_token, limit):
+        with self.db.connection() as connection:
+            rows, next_cursor, prev_cursor = keyset_page(
+                connection, MAINTENANCE_PAGE_SQL, (vehicle_id,),
+                ["service_date", "id"], cursor_token, limit
+            )
+        return {"rows": [dict(row) for row in rows], "next": next_cursor, "prev": prev_cursor}
+
+    def history_page(self, vehicle_id, cursor_token, limit):
+        """A page of maintenance records, from the cache when unchanged.
+        ValueError for a bad cursor."""
+        return self.cache.history(
+            vehicle_id, (cursor_token, limit),
+            lambda: self._load_history(vehicle_id, cursor_token, limit)
+        )
+
+    def iter_all(self):
+        """Every vehicle, read a batch at a time for streamed pages"""
+        return self.db.iter_keyset(VEHICLE_PAGE_SQL, (), ["id"])
+
+    def iter_history(self, vehicle_id):
+        """A vehicle's whole history, read a batch at a time"""
+        return self.db.iter_keyset(MAINTENANCE_PAGE_SQL, (vehicle_id,), ["service_date", "id"])
+
+    def _write(self, sql, params):
+        with self.db.connection() as connection:
+            # Parameterized to prevent SQL injection
+            cursor = connection.execute(sql, params)
+            connection.commit()
+        return cursor.lastrowid
+
+    def add(self, params):
+        """Insert a vehicle, returns its id"""
+        vehicle_id = self._write(INSERT_VEHICLE_SQL, params)
+        # The new id may be cached as "not found"
+        self.cache.invalidate(vehicle_id)
+        return vehicle_id
+
+    def update(self, vehicle_id, params):
+        self._write(UPDATE_VEHICLE_SQL, (*params, vehicle_id))
+        self.cache.invalidate(vehicle_id)
+
+    def delete(self, vehicle_id):
+        """Delete a vehicle and its maintenance records"""
+        with self.db.connection() as connection:
+            try:
+                connection.execute(DELETE_VEHICLE_MAINTENANCE_SQL, (vehicle_id,))
+                connection.execute(DELETE_VEHICLE_SQL, (vehicle_id,))
+                connection.commit()
+            except sqlite3.Error as e:
+                # Basic error handling, the pool rolls back the failed transaction
+                print(f"An error occurred: {e}")
+        self.cache.invalidate(vehicle_id)
+
+    def add_maintenance(self, params):
+        """Insert a maintenance record, returns once it is committed"""
+        if self.write_queue is not None:
+            # Returns once the group holding this record is committed
+            self.write_queue.execute(INSERT_MAINTENANCE_SQL, params)
+        else:
+            self._write(INSERT_MAINTENANCE_SQL, params)
+        self.maintenance_added(params[0])
+
+    def submit_maintenance(self, params):
+        """Queue a maintenance record for group commit, returns a Future.
+        Call maintenance_added once it is done."""
+        return self.write_queue.submit(INSERT_MAINTENANCE_SQL, params)
+
+    def maintenance_added(self, vehicle_id):
+        # History and the vehicle's maintenance summary both changed
+        self.cache.invalidate(vehicle_id)
+
+    def import_file(self, kind, stream, fmt, batch_size):
+        """Bulk load an uploaded file, returns the import report"""
+        try:
+            return bulk.import_records(self.db, kind, stream, fmt, batch_size)
+        finally:
+            # Any number of vehicles may have changed
+            self.cache.clear()
+
+    def export(self, dataset, fmt, vehicle_id=None, start=None, end=None):
+        """Chunks of an export, ValueError when fmt can't be written here"""
+        return bulk.export_records(self.db, dataset, fmt, vehicle_id, start, end)
+
+
+def _test_vehicles(**kwargs):
+    from cache import LRUCache, VehicleCache
+    from database import _test_database
+    return Vehicles(_test_database(), VehicleCache(LRUCache()), **kwargs)
+
+def test_writes_invalidate_the_cache():
+    print("test writes_invalidate_the_cache")
+    vehicles = _test_vehicles()
+    vehicle_id = vehicles.add(("Ann", "Ford", "Focus", 2012))
+    assert vehicles.get(vehicle_id)["owner_name"] == "Ann"
+    assert vehicles.get(vehicle_id + 1) is None
+
+    vehicles.update(vehicle_id, ("Bea", "Ford", "Focus", 2012))
+    assert vehicles.get(vehicle_id)["owner_name"] == "Bea"
+
+    assert vehicles.history_page(vehicle_id, None, 10)["rows"] == []
+    vehicles.add_maintenance((vehicle_id, "2024-05-01", "Oil change", 40.0))
+    page = vehicles.history_page(vehicle_id, None, 10)
+    assert [row["description"] for row in page["rows"]] == ["Oil change"]
+    assert vehicles.get(vehicle_id)["maintenance_count"] == 1
+
+    vehicles.delete(vehicle_id)
+    assert vehicles.get(vehicle_id) is None
+    assert vehicles.history_page(vehicle_id, None, 10)["rows"] == []
+
+def test_pages_and_streams_agree():
+    print("test pages_and_streams_agree")
+    vehicles = _test_vehicles()
+    for i in range(7):
+        vehicles.add((f"owner {i}", "make", "model", 2000))
+    paged = []
+    cursor_token = None
+    while True:
+        rows, cursor_token, _ = vehicles.page(cursor_token, 3)
+        paged.extend(row["owner_name"] for row in rows)
+        if cursor_token is None:
+            break
+    assert paged == [f"owner {i}" for i in range(7)]
+    assert [row["owner_name"] for row in vehicles.iter_all()] == paged
+
+    try:
+        vehicles.page("not a cursor", 3)
+    except ValueError:
+        pass
+    else:
+        assert False, "bad cursor accepted"
+
+def test_request_parsing():
+    print("test request_parsing")
+    from werkzeug.datastructures import FileStorage, MultiDict
+    form = MultiDict({"owner_name": "Ann", "make": "Ford", "model": "Focus", "year": "soon"})
+    assert vehicle_params(form) == ("Ann", "Ford", "Focus", None)
+    assert maintenance_params(3, MultiDict({"service_date": "2024-05-01", "description": "Tyres", "cost": "12.5"})) \
+        == (3, "2024-05-01", "Tyres", 12.5)
+    assert is_streaming(MultiDict({"stream": "1"})) and not is_streaming(MultiDict())
+
+    upload = FileStorage(filename="records.ndjson")
+    assert import_options(MultiDict({"kind": "maintenance"}), MultiDict()) is None
+    assert import_options(MultiDict({"kind": "pets"}), MultiDict({"file": upload})) is None
+    kind, _, fmt, batch_size = import_options(MultiDict({"kind": "maintenance"}), MultiDict({"file": upload}))
+    assert (kind, fmt, batch_size) == ("maintenance", "ndjson", bulk.BATCH_SIZE)
+    assert export_options(MultiDict({"vehicle_id": "4", "start": "2024-01-01"})) \
+        == {"vehicle_id": 4, "start": "2024-01-01", "end": None}
+
+
+if __name__ == "__main__":
+    test_writes_invalidate_the_cache()
+    test_pages_and_streams_agree()
+    test_request_parsing()
+    print("done.")
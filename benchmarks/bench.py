@@ -0,0 +1,409 @@
+# Benchmark suite for the CRUD apps. Each app runs in its own process
+# against a copy of its folder holding a synthetic dataset, so the topics'
+# same-named modules (database, metrics, ...) never meet:
+#
+#     python benchmarks/bench.py --scale 1k --scale 10k
+#     python benchmarks/bench.py --app topic-08-representation --http
+#     python benchmarks/bench.py --scale 1k --save-baseline
+#     python benchmarks/bench.py --scale 1k --check     # exit 1 on regression
+#
+# --check fails on routes with no baseline too. Baselines are scaled by a
+# calibration request timed on both machines, see CALIBRATION_ROWS.
+#
+# Routes are driven through Flask's test client, and with --http also over
+# a real socket by the asyncio load generator in ADSD-Final-Project.
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from datasets import BUILDERS, GENERATOR_VERSION, SCALES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(HERE, "data")
+BASELINES = os.path.join(HERE, "baselines.json")
+
+# (method, path, form), {names} are filled in from the dataset's ids
+PET_ROUTES = [
+    ("GET", "/list", None),
+    ("GET", "/kind/list", None),
+    ("GET", "/update/{pet_id}", None),
+    ("POST", "/create", {"name": "Bench", "age": "3", "kind_id": "{kind_id}", "owner": "Bench"}),
+]
+VEHICLE_ROUTES = [
+    ("GET", "/list", None),
+    ("GET", "/vehicle/{vehicle_id}/maintenance", None),
+    ("GET", "/update/{vehicle_id}", None),
+    ("POST", "/vehicle/{vehicle_id}/maintenance/add",
+     {"service_date": "2024-06-01", "description": "Bench", "cost": "10"}),
+]
+
+# folder -> (dataset, routes). topic-10 is left out, it needs an Atlas cluster.
+APPS = {
+    "topic-04-foreign-keys": ("pets", PET_ROUTES),
+    "topic-05-peewee-orm": ("peewee", PET_ROUTES),
+    "topic-06-dataset": ("pets", PET_ROUTES),
+    "topic-07-abstraction": ("pets", PET_ROUTES),
+    "topic-08-representation": ("pets", PET_ROUTES),
+    "topic-09-mongo": ("mongita", PET_ROUTES),
+    "ADSD-Final-Project": ("vehicles", VEHICLE_ROUTES),
+}
+
+# A run is a regression when a route's throughput or median latency is this
+# much worse than its baseline (0.5 means half as slow again), and its median
+# at least MIN_SLOWDOWN_MS slower. Tails are recorded but not checked, on a
+# busy machine p95 of a sub-millisecond route jitters several fold.
+TOLERANCE = 0.5
+MIN_SLOWDOWN_MS = 1.0
+
+# Baselines come from whatever machine recorded them, so right before each
+# route the worker times a fixed Flask + SQLite + Jinja request and results
+# are scaled by how much slower or faster that ran than at baseline time
+CALIBRATION_ROWS = 200
+CALIBRATION_REQUESTS = 100
+
+
+def dataset(name, scale):
+    """Build a dataset once and keep it under benchmarks/data for later runs"""
+    builder, target = BUILDERS[name]
+    directory = os.path.join(DATA_DIR, f"{name}-{scale}-v{GENERATOR_VERSION}")
+    ids_path = os.path.join(directory, "ids.json")
+    if not os.path.exists(ids_path):
+        os.makedirs(directory, exist_ok=True)
+        started = time.perf_counter()
+        ids = builder(os.path.join(directory, target), SCALES[scale])
+        print(f"built {name} {scale} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        with open(ids_path, "w") as output:
+            json.dump(ids, output)
+    with open(ids_path) as source:
+        return os.path.join(directory, target), json.load(source)
+
+
+def prepare(app, scale):
+    """Copy an app and its dataset into a scratch folder, returns (scratch, folder, home, ids)"""
+    name, _ = APPS[app]
+    source, ids = dataset(name, scale)
+    scratch = tempfile.mkdtemp(prefix=f"bench-{app}-")
+    folder = os.path.join(scratch, app)
+    shutil.copytree(os.path.join(ROOT, app), folder,
+                    ignore=shutil.ignore_patterns("*.db", "*.db-shm", "*.db-wal", "__pycache__"))
+    # Mongita keeps its data in ~/.mongita, so the worker gets its own home
+    home = os.path.join(scratch, "home")
+    os.makedirs(home)
+    if os.path.isdir(source):
+        shutil.copytree(source, os.path.join(home, os.path.basename(source)))
+    else:
+        shutil.copy(source, os.path.join(folder, os.path.basename(source)))
+    return scratch, folder, home, ids
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def fill(value, ids):
+    if isinstance(value, dict):
+        return {key: fill(item, ids) for key, item in value.items()}
+    return value.format(**ids)
+
+
+def measure(client, method, path, form, requests, seconds):
+    """Latencies of up to requests calls, stopping early after seconds"""
+    send = client.post if method == "POST" else client.get
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+    while len(latencies) < requests and (not latencies or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        response = send(path, data=form)
+        response.get_data()
+        latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            errors += 1
+    return latencies, errors
+
+
+def calibration_app():
+    """A Flask app whose one route reads and renders CALIBRATION_ROWS rows"""
+    import sqlite3
+    from flask import Flask, render_template_string
+
+    connection = sqlite3.connect(":memory:", check_same_thread=False)
+    connection.execute("CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT, price REAL)")
+    connection.executemany("INSERT INTO item (name, price) VALUES (?, ?)",
+                           [(f"item {i}", i * 1.5) for i in range(CALIBRATION_ROWS)])
+    app = Flask("calibration")
+
+    @app.route("/")
+    def items():
+        rows = connection.execute("SELECT id, name, price FROM item ORDER BY name").fetchall()
+        return render_template_string(
+            "<table>{% for id, name, price in rows %}"
+            "<tr><td>{{ id }}</td><td>{{ name }}</td><td>{{ '%.2f' % price }}</td></tr>"
+            "{% endfor %}</table>", rows=rows)
+
+    return app.test_client()
+
+
+def calibrate(client):
+    """Median milliseconds of the calibration request"""
+    client.get("/").get_data()
+    latencies, _ = measure(client, "GET", "/", None, CALIBRATION_REQUESTS, 1.0)
+    return statistics.median(latencies) * 1000
+
+
+def peak_memory(client, method, path, form, requests=3):
+    """Largest Python heap growth while serving one request, in KiB"""
+    import tracemalloc
+
+    send = client.post if method == "POST" else client.get
+    peak = 0
+    for _ in range(requests):
+        tracemalloc.start()
+        send(path, data=form).get_data()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return peak / 1024
+
+
+def http_load(flask_app, paths, concurrency, seconds):
+    """Drive GET routes over a socket with the load generator from loadtest.py"""
+    import asyncio
+    import threading
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    sys.path.insert(0, os.path.join(ROOT, "ADSD-Final-Project"))
+    import loadtest
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, flask_app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        return asyncio.run(loadtest.run(url, paths, concurrency, seconds))
+    finally:
+        server.shutdown()
+
+
+def worker(app, ids, options):
+    """Runs in the app's scratch folder, returns its results"""
+    import resource
+
+    sys.path.insert(0, os.getcwd())
+    try:
+        import app as module
+    except ImportError as e:
+        return {"skipped": str(e)}
+
+    flask_app = module.app
+    client = flask_app.test_client()
+    calibration = calibration_app()
+    _, routes = APPS[app]
+    results = {}
+    for method, route, form in routes:
+        path = fill(route, ids)
+        form = fill(form, ids) if form else None
+        send = client.post if method == "POST" else client.get
+        send(path, data=form).get_data()  # warm up caches and imports
+
+        calibration_ms = calibrate(calibration)
+        latencies, errors = measure(client, method, path, form, options["requests"], options["seconds"])
+        total = sum(latencies)
+        latencies.sort()
+        # Keyed by the route, not the path, so baselines survive new datasets
+        results[f"{method} {route}"] = {
+            "requests": len(latencies),
+            "requests_per_second": len(latencies) / total if total else 0.0,
+            "mean_ms": statistics.mean(latencies) * 1000,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "peak_kib": peak_memory(client, method, path, form),
+            "errors": errors,
+            "calibration_ms": calibration_ms,
+        }
+
+    if options["http"]:
+        paths = [fill(path, ids) for method, path, _ in routes if method == "GET"]
+        results["http"] = http_load(flask_app, paths, options["concurrency"], options["seconds"])
+    results["max_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def run_app(app, scale, options):
+    try:
+        scratch, folder, home, ids = prepare(app, scale)
+    except ImportError as e:
+        # The dataset needs a package that isn't installed, e.g. mongita
+        return {"skipped": str(e)}
+    output = os.path.join(scratch, "results.json")
+    env = dict(os.environ, HOME=home, BENCH_OPTIONS=json.dumps(options))
+    try:
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", app, json.dumps(ids), output],
+            cwd=folder, env=env, check=True,
+            stdout=subprocess.DEVNULL if not options["verbose"] else None
+        )
+        with open(output) as source:
+            return json.load(source)
+    except subprocess.CalledProcessError as e:
+        return {"failed": f"worker exited with {e.returncode}"}
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def normalized(result, baseline):
+    """A result's throughput and median as if run at the baseline machine's
+    speed, going by the two calibration times"""
+    speed = result["calibration_ms"] / baseline["calibration_ms"]
+    return result["requests_per_second"] * speed, result["p50_ms"] / speed
+
+
+def compare(results, baselines, tolerance=TOLERANCE):
+    """(key, message) for each route slower than its baseline by more than
+    tolerance, once both are scaled to the same machine speed"""
+    regressions = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if baseline is None or "calibration_ms" not in baseline:
+            continue
+        requests_per_second, p50_ms = normalized(result, baseline)
+        if requests_per_second * (1 + tolerance) < baseline["requests_per_second"]:
+            regressions.append((key, f"{key}: {requests_per_second:.1f} req/s normalized, "
+                                     f"baseline {baseline['requests_per_second']:.1f}"))
+        slowest = max(baseline["p50_ms"] * (1 + tolerance), baseline["p50_ms"] + MIN_SLOWDOWN_MS)
+        if p50_ms > slowest:
+            regressions.append((key, f"{key}: p50 {p50_ms:.2f} ms normalized, baseline {baseline['p50_ms']:.2f}"))
+    return regressions
+
+
+def unchecked(everything, results, baselines):
+    """Why each app or route could not be checked: it didn't run, or it has
+    no baseline to compare with"""
+    problems = [f"{key}: {runs.get('skipped') or runs.get('failed')}"
+                for key, runs in everything.items() if "skipped" in runs or "failed" in runs]
+    problems += [f"{key}: no baseline, record one with --save-baseline"
+                 for key in results if "calibration_ms" not in baselines.get(key, {})]
+    return problems
+
+
+def best_of(first, second):
+    """Each route's run with the better calibrated throughput"""
+    best = dict(first)
+    for key, result in second.items():
+        if key in best:
+            current = best[key]
+            if (result["requests_per_second"] * result["calibration_ms"]
+                    > current["requests_per_second"] * current["calibration_ms"]):
+                best[key] = result
+    return best
+
+
+def measured_routes(app, scale, results):
+    return {
+        f"{app} {scale} {route}": result for route, result in results.items()
+        if isinstance(result, dict) and "p95_ms" in result
+    }
+
+
+def report(app, scale, results):
+    if "skipped" in results or "failed" in results:
+        print(f"{app:<26}{scale:>5}  {results.get('skipped') or results.get('failed')}")
+        return
+    for route, result in results.items():
+        if route in ("http", "max_rss_kib"):
+            continue
+        print(f"{app:<26}{scale:>5}  {route:<38}{result['requests_per_second']:>9.1f}"
+              f"{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+              f"{result['peak_kib']:>10.0f}")
+    if "http" in results:
+        http = results["http"]
+        print(f"{app:<26}{scale:>5}  {'HTTP GET, all routes':<38}{http['requests_per_second']:>9.1f}"
+              f"{http['p50'] * 1000:>9.2f}{http['p95'] * 1000:>9.2f}{http['p99'] * 1000:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CRUD apps on synthetic data")
+    parser.add_argument("--app", action="append", dest="apps", choices=sorted(APPS),
+                        help="app folder to run, repeatable (default all)")
+    parser.add_argument("--scale", action="append", dest="scales", choices=list(SCALES),
+                        help="dataset size, repeatable (default 1k)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route at most")
+    parser.add_argument("--seconds", type=float, default=2.0, help="time per route at most")
+    parser.add_argument("--http", action="store_true", help="also load the GET routes over HTTP")
+    parser.add_argument("--concurrency", type=int, default=50, help="HTTP clients with --http")
+    parser.add_argument("--save-baseline", action="store_true", help="record these results as the baseline")
+    parser.add_argument("--check", action="store_true", help="exit 1 when a route regressed")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--json", help="also write all results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the apps' own output")
+    args = parser.parse_args()
+
+    options = {key: getattr(args, key) for key in ("requests", "seconds", "http", "concurrency", "verbose")}
+    flat = {}
+    everything = {}
+    print(f"{'app':<26}{'scale':>5}  {'route':<38}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'peak KiB':>10}")
+    for scale in args.scales or ["1k"]:
+        for app in args.apps or list(APPS):
+            results = run_app(app, scale, options)
+            everything[f"{app} {scale}"] = results
+            report(app, scale, results)
+            flat.update(measured_routes(app, scale, results))
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(everything, output, indent=2)
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as source:
+            baselines = json.load(source)
+
+    if args.save_baseline:
+        for key, result in flat.items():
+            baselines[key] = {name: round(result[name], 3)
+                              for name in ("requests_per_second", "p50_ms", "p95_ms", "calibration_ms")}
+        with open(BASELINES, "w") as output:
+            json.dump(dict(sorted(baselines.items())), output, indent=2)
+            output.write("\n")
+
+    if args.check:
+        regressions = compare(flat, baselines, args.tolerance)
+        # A route is only a regression if a second run is slow too, one
+        # run on a busy machine can stall for a whole route
+        rerun = sorted({(app, scale) for scale in args.scales or ["1k"] for app in args.apps or list(APPS)
+                        for key, _ in regressions if key.startswith(f"{app} {scale} ")})
+        for app, scale in rerun:
+            print(f"{app} {scale}: slower than its baseline, running it again")
+            flat = best_of(flat, measured_routes(app, scale, run_app(app, scale, options)))
+        if rerun:
+            regressions = compare(flat, baselines, args.tolerance)
+        for _, regression in regressions:
+            print("REGRESSION", regression)
+        # A route that can't be compared fails the check too, else a missing
+        # baseline or a broken app would pass it silently
+        problems = unchecked(everything, flat, baselines)
+        for problem in problems:
+            print("UNCHECKED", problem)
+        if regressions or problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--worker":
+        _, _, app, ids, output = sys.argv
+        results = worker(app, json.loads(ids), json.loads(os.environ["BENCH_OPTIONS"]))
+        with open(output, "w") as destination:
+            json.dump(results, destination)
+    else:
+        main()
@@ -0,0 +1,398 @@
+import itertools
+import multiprocessing
+import os
+import random
+import sqlite3
+
+# Named dataset sizes, the number of pets or maintenance records
+SCALES = {
+    "1k": 1_000,
+    "10k": 10_000,
+    "100k": 100_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+}
+
+# Bumped whenever the same seed starts producing different rows, so cached
+# datasets are rebuilt
+GENERATOR_VERSION = 2
+
+# Rows are generated and written in chunks of this many. Every chunk has its
+# own random stream, so the rows don't depend on how many workers made them.
+CHUNK_SIZE = 50_000
+
+# Zipf exponent for how children spread over parents: 0 is uniform, around
+# 1 a few vehicles own most of the maintenance and most pets are dogs
+DEFAULT_SKEW = 1.0
+
+KINDS = [("Dog", "Dog food", "Bark"), ("Cat", "Cat food", "Meow"), ("Fish", "Fish flakes", "Blub")]
+NAMES = ["Suzy", "Sandy", "Dorothy", "Heidi", "Max", "Bella", "Charlie", "Luna", "Rocky", "Daisy"]
+OWNERS = ["Greg", "Steve", "Elizabeth", "David", "Maria", "James", "Linda", "Ahmed", "Wei", "Olga"]
+MAKES = [("Toyota", "Corolla"), ("Ford", "F-150"), ("Honda", "Civic"), ("Tesla", "Model 3"), ("Kia", "Soul")]
+SERVICES = [("Oil change", 49.99), ("Tire rotation", 25.0), ("Brake pads", 180.0), ("Inspection", 35.0)]
+
+# The pets schema of topic-04, 06, 07 and 08 (create_db.sql)
+PETS_SCHEMA = """
+    CREATE TABLE kind (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind_name TEXT NOT NULL,
+        food TEXT NOT NULL,
+        noise TEXT NOT NULL
+    );
+    CREATE TABLE pets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        age INTEGER NOT NULL CHECK (age >= 0),
+        kind_id INTEGER NOT NULL,
+        owner TEXT NOT NULL,
+        FOREIGN KEY (kind_id) REFERENCES kind(id)
+            ON DELETE RESTRICT
+            ON UPDATE CASCADE
+    );
+"""
+
+# The tables peewee creates for the Pet and Kind models of topic-05
+PEEWEE_SCHEMA = """
+    CREATE TABLE kind (
+        id INTEGER NOT NULL PRIMARY KEY,
+        kind_name VARCHAR(255) NOT NULL,
+        food VARCHAR(255) NOT NULL,
+        noise VARCHAR(255) NOT NULL
+    );
+    CREATE TABLE pet (
+        id INTEGER NOT NULL PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        age INTEGER NOT NULL,
+        owner VARCHAR(255) NOT NULL,
+        kind_id INTEGER NOT NULL,
+        FOREIGN KEY (kind_id) REFERENCES kind (id)
+    );
+    CREATE INDEX pet_kind_id ON pet (kind_id);
+"""
+
+# The base tables of the vehicle app, its migrations run when it starts
+VEHICLES_SCHEMA = """
+    CREATE TABLE vehicles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_name TEXT NOT NULL,
+        make TEXT NOT NULL,
+        model TEXT NOT NULL,
+        year INTEGER,
+        last_service_date TEXT
+    );
+    CREATE TABLE maintenance (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        vehicle_id INTEGER NOT NULL,
+        service_date TEXT NOT NULL,
+        description TEXT NOT NULL,
+        cost REAL NOT NULL,
+        FOREIGN KEY (vehicle_id) REFERENCES vehicles(id)
+    );
+"""
+
+# dataset -> (parent table, child table). Rows are tuples starting with their id.
+DATASETS = {
+    "pets": ("kind", "pets"),
+    "vehicles": ("vehicles", "maintenance"),
+}
+
+# SQLite layout -> (schema, table name for each generated table, column lists)
+SQLITE_LAYOUTS = {
+    "pets": (PETS_SCHEMA, {
+        "kind": "INSERT INTO kind (id, kind_name, food, noise) VALUES (?, ?, ?, ?)",
+        "pets": "INSERT INTO pets (id, name, age, kind_id, owner) VALUES (?, ?, ?, ?, ?)",
+    }),
+    "peewee": (PEEWEE_SCHEMA, {
+        "kind": "INSERT INTO kind (id, kind_name, food, noise) VALUES (?, ?, ?, ?)",
+        "pets": "INSERT INTO pet (id, name, age, kind_id, owner) VALUES (?, ?, ?, ?, ?)",
+    }),
+    "vehicles": (VEHICLES_SCHEMA, {
+        "vehicles": "INSERT INTO vehicles (id, owner_name, make, model, year) VALUES (?, ?, ?, ?, ?)",
+        "maintenance": "INSERT INTO maintenance (id, vehicle_id, service_date, description, cost) "
+                       "VALUES (?, ?, ?, ?, ?)",
+    }),
+}
+
+# Document layout of each generated table in Mongo and Mongita, the pets
+# collections are the ones topic-09 and topic-10 read
+MONGO_LAYOUTS = {
+    "kind": ("pets_db", "kind_collection", ("kind_name", "food", "noise")),
+    "pets": ("pets_db", "pet_collection", ("name", "age", "kind_id", "owner")),
+    "vehicles": ("vehicles_db", "vehicle_collection", ("owner_name", "make", "model", "year")),
+    "maintenance": ("vehicles_db", "maintenance_collection", ("vehicle_id", "service_date", "description", "cost")),
+}
+
+
+def parent_count(dataset, rows):
+    """Kinds or vehicles generated for rows pets or maintenance records"""
+    if dataset == "pets":
+        return max(len(KINDS), rows // 1000)
+    return max(1, rows // 10)
+
+
+class Spec:
+    """Everything a worker needs to generate any chunk of a dataset"""
+
+    def __init__(self, dataset, rows, seed=0, skew=DEFAULT_SKEW):
+        if dataset not in DATASETS:
+            raise ValueError(f"Unknown dataset {dataset!r}")
+        self.dataset = dataset
+        self.rows = rows
+        self.seed = seed
+        self.skew = skew
+        self.parents = parent_count(dataset, rows)
+        self._ranked = None
+        self._cum_weights = None
+
+    def prepare(self):
+        """Build the sampling tables, once per process"""
+        if self._ranked is not None:
+            return
+        # Parent ids from most to least popular, scattered over the id range
+        # so the busiest rows aren't simply the first ones. Kinds keep their
+        # natural order, so Dog stays the most common.
+        self._ranked = list(range(1, self.parents + 1))
+        if self.dataset == "vehicles":
+            random.Random(f"{self.seed}:ranking").shuffle(self._ranked)
+        weights = (1.0 / rank ** self.skew for rank in range(1, self.parents + 1))
+        self._cum_weights = list(itertools.accumulate(weights))
+
+    def hottest(self):
+        """Id of the parent with the most children"""
+        self.prepare()
+        return self._ranked[0]
+
+    def parents_for(self, rng, count):
+        ranks = rng.choices(range(self.parents), cum_weights=self._cum_weights, k=count)
+        return [self._ranked[rank] for rank in ranks]
+
+    def tasks(self):
+        """(table, first id, row count) for every chunk, in write order"""
+        parent, child = DATASETS[self.dataset]
+        for table, total in ((parent, self.parents), (child, self.rows)):
+            for start in range(0, total, CHUNK_SIZE):
+                yield table, start + 1, min(CHUNK_SIZE, total - start)
+
+
+def generate_chunk(spec, table, first, count):
+    """Rows first..first+count-1 of a table, the same for the same spec every time"""
+    spec.prepare()
+    rng = random.Random(f"{spec.seed}:{table}:{first}")
+    ids = range(first, first + count)
+    if table == "kind":
+        rows = []
+        for id in ids:
+            name, food, noise = KINDS[(id - 1) % len(KINDS)]
+            rows.append((id, name if id <= len(KINDS) else f"{name} {id}", food, noise))
+        return rows
+    if table == "pets":
+        kinds = spec.parents_for(rng, count)
+        return [(id, rng.choice(NAMES), rng.randrange(20), kind, rng.choice(OWNERS))
+                for id, kind in zip(ids, kinds)]
+    if table == "vehicles":
+        rows = []
+        for id in ids:
+            make, model = rng.choice(MAKES)
+            rows.append((id, rng.choice(OWNERS), make, model, rng.randrange(1995, 2026)))
+        return rows
+    vehicles = spec.parents_for(rng, count)
+    rows = []
+    for id, vehicle in zip(ids, vehicles):
+        description, cost = rng.choice(SERVICES)
+        date = f"{rng.randrange(2015, 2026)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"
+        rows.append((id, vehicle, date, description, cost))
+    return rows
+
+
+# Worker processes get the spec once and then only chunk coordinates
+_worker_spec = None
+
+def _init_worker(spec):
+    global _worker_spec
+    _worker_spec = spec
+    spec.prepare()
+
+def _worker_chunk(task):
+    table, first, count = task
+    return table, generate_chunk(_worker_spec, table, first, count)
+
+
+def generate(spec, workers=None):
+    """
+    Yield (table, rows) chunks of a dataset, parents first and in id order.
+
+    Chunks are generated on workers processes (default one per core) while
+    the caller writes earlier ones.
+    """
+    workers = workers or os.cpu_count() or 1
+    tasks = list(spec.tasks())
+    if workers == 1 or len(tasks) == 1:
+        for table, first, count in tasks:
+            yield table, generate_chunk(spec, table, first, count)
+        return
+    with multiprocessing.get_context().Pool(workers, initializer=_init_worker, initargs=(spec,)) as pool:
+        yield from pool.imap(_worker_chunk, tasks)
+
+
+def write_sqlite(path, chunks, layout):
+    """Write generated chunks into a new SQLite file with the given layout"""
+    schema, inserts = SQLITE_LAYOUTS[layout]
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    # A file being created from scratch needs no crash safety
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.executescript(schema)
+    with connection:
+        for table, rows in chunks:
+            connection.executemany(inserts[table], rows)
+    connection.close()
+
+
+def object_id(table, id):
+    """Stable ObjectId for a generated row, so pets can point at kinds without a lookup"""
+    from bson.objectid import ObjectId
+
+    tag = list(MONGO_LAYOUTS).index(table) + 1
+    return ObjectId(f"{tag:02x}{id:022x}")
+
+
+def document(table, row):
+    _, _, fields = MONGO_LAYOUTS[table]
+    values = dict(zip(fields, row[1:]))
+    if table == "kind" or table == "pets":
+        # The pets apps use ObjectIds throughout
+        if table == "pets":
+            values["kind_id"] = object_id("kind", values["kind_id"])
+        return {"_id": object_id(table, row[0]), **values}
+    return {"_id": row[0], **values}
+
+
+def write_mongo(client, chunks):
+    """Write generated chunks with insert_many through a Mongo or Mongita client"""
+    dropped = set()
+    for table, rows in chunks:
+        database, collection, _ = MONGO_LAYOUTS[table]
+        if (database, collection) not in dropped:
+            client[database].drop_collection(collection)
+            dropped.add((database, collection))
+        client[database][collection].insert_many([document(table, row) for row in rows])
+
+
+def open_mongo(uri):
+    """A client for mongodb:// URIs, or an in-memory stand-in for mongomock://"""
+    if uri.startswith("mongomock://"):
+        import mongomock
+        return mongomock.MongoClient()
+    import pymongo
+    return pymongo.MongoClient(uri)
+
+
+def summary(spec):
+    """Row counts and the ids benchmarks point their routes at"""
+    hottest = spec.hottest()
+    if spec.dataset == "pets":
+        return {"kinds": spec.parents, "pets": spec.rows, "pet_id": 1, "kind_id": hottest}
+    return {"vehicles": spec.parents, "maintenance": spec.rows, "vehicle_id": hottest}
+
+
+# Builders the benchmark suite caches datasets with: (path, rows, seed)
+
+def build_pets(path, scale, seed=0, workers=None):
+    """pets.db for the sqlite3 and dataset variants"""
+    spec = Spec("pets", scale, seed)
+    write_sqlite(path, generate(spec, workers), "pets")
+    return summary(spec)
+
+def build_peewee_pets(path, scale, seed=0, workers=None):
+    """pets.db with the table names the peewee models use"""
+    spec = Spec("pets", scale, seed)
+    write_sqlite(path, generate(spec, workers), "peewee")
+    return summary(spec)
+
+def build_vehicles(path, scale, seed=0, workers=None):
+    """database.db for the vehicle app, scale is the number of maintenance records"""
+    spec = Spec("vehicles", scale, seed)
+    write_sqlite(path, generate(spec, workers), "vehicles")
+    return summary(spec)
+
+def build_mongita_pets(directory, scale, seed=0, workers=None):
+    """The Mongita pets_db of topic-09 under directory, which becomes the app's ~/.mongita"""
+    from mongita import MongitaClientDisk
+
+    spec = Spec("pets", scale, seed)
+    write_mongo(MongitaClientDisk(directory), generate(spec, workers))
+    ids = summary(spec)
+    ids["pet_id"] = str(object_id("pets", ids["pet_id"]))
+    ids["kind_id"] = str(object_id("kind", ids["kind_id"]))
+    return ids
+
+
+# name -> (builder, file or directory it writes)
+BUILDERS = {
+    "pets": (build_pets, "pets.db"),
+    "peewee": (build_peewee_pets, "pets.db"),
+    "vehicles": (build_vehicles, "database.db"),
+    "mongita": (build_mongita_pets, ".mongita"),
+}
+
+
+def test_same_rows_for_any_worker_count():
+    print("test same_rows_for_any_worker_count")
+    global CHUNK_SIZE
+    saved, CHUNK_SIZE = CHUNK_SIZE, 1000
+    try:
+        spec = Spec("vehicles", 5000, seed=7)
+        serial = list(generate(spec, workers=1))
+        parallel = list(generate(Spec("vehicles", 5000, seed=7), workers=2))
+        assert serial == parallel
+        assert [table for table, _ in serial] == ["vehicles"] + ["maintenance"] * 5
+        assert serial != list(generate(Spec("vehicles", 5000, seed=8), workers=1))
+    finally:
+        CHUNK_SIZE = saved
+
+def test_zipf_skew():
+    print("test zipf_skew")
+    counts = {}
+    spec = Spec("vehicles", 20000, seed=1, skew=1.0)
+    for table, rows in generate(spec, workers=1):
+        if table == "maintenance":
+            for row in rows:
+                counts[row[1]] = counts.get(row[1], 0) + 1
+    ordered = sorted(counts.values(), reverse=True)
+    # Harmonic weights over 2000 vehicles: the busiest gets about 12% of
+    # the records, the top tenth well over half
+    assert max(counts, key=counts.get) == spec.hottest()
+    assert 0.10 < ordered[0] / 20000 < 0.15
+    assert sum(ordered[:200]) / 20000 > 0.6
+
+    uniform = {}
+    for table, rows in generate(Spec("vehicles", 20000, seed=1, skew=0), workers=1):
+        if table == "maintenance":
+            for row in rows:
+                uniform[row[1]] = uniform.get(row[1], 0) + 1
+    assert max(uniform.values()) < 30
+
+def test_write_sqlite():
+    print("test write_sqlite")
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "pets.db")
+    ids = build_peewee_pets(path, 5000, seed=3, workers=1)
+    assert ids == {"kinds": 5, "pets": 5000, "pet_id": 1, "kind_id": 1}
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT COUNT(*) FROM pet").fetchone()[0] == 5000
+    dogs = connection.execute("SELECT COUNT(*) FROM pet WHERE kind_id = 1").fetchone()[0]
+    assert dogs > 5000 * 0.35
+    # Every pet points at a kind that exists
+    assert connection.execute(
+        "SELECT COUNT(*) FROM pet LEFT JOIN kind ON kind.id = pet.kind_id WHERE kind.id IS NULL"
+    ).fetchone()[0] == 0
+    connection.close()
+
+
+if __name__ == "__main__":
+    test_same_rows_for_any_worker_count()
+    test_zipf_skew()
+    test_write_sqlite()
+    print("done.")
@@ -0,0 +1,50 @@
+# Generate a synthetic pets or vehicles dataset at any size:
+#
+#     python benchmarks/generate.py vehicles 10000000 --sqlite database.db
+#     python benchmarks/generate.py pets 1000000 --sqlite pets.db --layout peewee
+#     python benchmarks/generate.py pets 1000000 --mongita ~/.mongita
+#     python benchmarks/generate.py vehicles 100000 --mongo mongodb://localhost:27017
+#
+# The same dataset, rows, --seed and --skew always give the same data.
+import argparse
+import json
+import sys
+import time
+
+from datasets import DATASETS, DEFAULT_SKEW, SQLITE_LAYOUTS, Spec, generate, open_mongo, summary, write_mongo, write_sqlite
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset")
+    parser.add_argument("dataset", choices=sorted(DATASETS))
+    parser.add_argument("rows", type=int, help="number of pets or maintenance records")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skew", type=float, default=DEFAULT_SKEW,
+                        help="Zipf exponent of children per parent, 0 for uniform")
+    parser.add_argument("--workers", type=int, help="generating processes (default one per core)")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--sqlite", metavar="PATH", help="write a new SQLite file")
+    target.add_argument("--mongita", metavar="DIR", help="write to a Mongita disk store")
+    target.add_argument("--mongo", metavar="URI", help="write to MongoDB, or mongomock:// to try it out")
+    parser.add_argument("--layout", choices=sorted(SQLITE_LAYOUTS),
+                        help="SQLite tables to write (default the dataset's own)")
+    args = parser.parse_args()
+
+    spec = Spec(args.dataset, args.rows, args.seed, args.skew)
+    chunks = generate(spec, args.workers)
+    started = time.perf_counter()
+    if args.sqlite:
+        write_sqlite(args.sqlite, chunks, args.layout or args.dataset)
+    elif args.mongita:
+        from mongita import MongitaClientDisk
+        write_mongo(MongitaClientDisk(args.mongita), chunks)
+    else:
+        write_mongo(open_mongo(args.mongo), chunks)
+    elapsed = time.perf_counter() - started
+
+    print(json.dumps(summary(spec)))
+    print(f"{spec.parents + spec.rows} rows in {elapsed:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,23 @@
 from flask import Flask, render_template, request, redirect, url_for
 import sqlite3
+from connections import ConnectionPool
+from metrics import Metrics, slow_query_threshold
 
 app = Flask(__name__)
-connection = sqlite3.connect("pets.db", check_same_thread=False)
-connection.execute("PRAGMA foreign_keys = 1")
+
+# Route, query and template timings at /metrics
+metrics = Metrics(slow_query_seconds=slow_query_threshold())
+metrics.init_app(app)
+
+# Each request gets a connection of its own, returned when the request ends
+connections = ConnectionPool("pets.db", factory=metrics.connection_class)
+connections.init_app(app)
 
 # List of pets, showing related kind information
 @app.route("/")
 @app.route("/list")
 def get_list():
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("""
         SELECT pets.id, pets.name, pets.age, pets.owner, kind.kind_name, kind.food, kind.noise 
@@ -21,6 +30,7 @@ def get_list():
 # Create a new pet with a dropdown to select kind
 @app.route("/create", methods=['GET', 'POST'])
 def get_post_create():
+    connection = connections.current()
     cursor = connection.cursor()
     
     if request.method == 'GET':
@@ -45,6 +55,7 @@ def get_post_create():
 # Update an existing pet, allows kind to be changed
 @app.route("/update/<id>", methods=['GET', 'POST'])
 def get_update(id):
+    connection = connections.current()
     cursor = connection.cursor()
     
     if request.method == 'GET':
@@ -76,6 +87,7 @@ def get_update(id):
 # Delete a pet
 @app.route("/delete/<id>")
 def get_delete(id):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("DELETE FROM pets WHERE id = ?", (id,))
     connection.commit()
@@ -84,6 +96,7 @@ def get_delete(id):
 # List of kinds
 @app.route("/kind/list")
 def list_kinds():
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("SELECT * FROM kind")
     kinds = cursor.fetchall()
@@ -94,6 +107,7 @@ def list_kinds():
 def create_kind():
     if request.method == 'POST':
         data = dict(request.form)
+        connection = connections.current()
         cursor = connection.cursor()
         cursor.execute("INSERT INTO kind (kind_name, food, noise) VALUES (?, ?, ?)", 
                        (data["kind_name"], data["food"], data["noise"]))
@@ -104,6 +118,7 @@ def create_kind():
 # Update an existing kind
 @app.route("/kind/update/<id>", methods=['GET', 'POST'])
 def update_kind(id):
+    connection = connections.current()
     cursor = connection.cursor()
     
     if request.method == 'POST':
@@ -125,6 +140,7 @@ def update_kind(id):
 # Delete a kind, with integrity error handling
 @app.route("/kind/delete/<id>")
 def delete_kind(id):
+    connection = connections.current()
     cursor = connection.cursor()
     try:
         cursor.execute("DELETE FROM kind WHERE id = ?", (id,))
@@ -1,8 +1,32 @@
+import os
+
 from flask import Flask, render_template, request, redirect, url_for
 from peewee import *
-
-# Initialize database connection
-db = SqliteDatabase('pets.db')
+from playhouse.pool import PooledSqliteDatabase
+
+# Applied to every connection the pool opens. SQLite only enforces foreign
+# keys when asked, which delete_kind relies on
+PRAGMAS = {
+    "foreign_keys": 1,
+    "journal_mode": "wal",      # readers don't wait for a writer
+    "synchronous": "normal",    # durable in WAL mode, fsync only on checkpoint
+    "cache_size": -16000,       # negative means KiB, about 16 MB per connection
+    "busy_timeout": 5000,       # milliseconds
+}
+
+# Each request checks a connection out of the pool and returns it when done.
+# PETS_DB_MAX_CONNECTIONS bounds the pool, a request waits up to
+# PETS_DB_WAIT_TIMEOUT seconds for a free one, and connections idle for longer
+# than PETS_DB_STALE_TIMEOUT seconds are closed instead of reused. A pooled
+# connection is used by one thread at a time but not always the same one
+db = PooledSqliteDatabase(
+    'pets.db',
+    max_connections=int(os.environ.get("PETS_DB_MAX_CONNECTIONS", 8)),
+    stale_timeout=int(os.environ.get("PETS_DB_STALE_TIMEOUT", 300)),
+    timeout=int(os.environ.get("PETS_DB_WAIT_TIMEOUT", 10)),
+    pragmas=PRAGMAS,
+    check_same_thread=False,
+)
 
 # Define models
 class Kind(Model):
@@ -23,16 +47,27 @@ class Pet(Model):
         database = db
 
 # Create tables if they don't exist
-db.connect()
-db.create_tables([Pet, Kind])
+with db.connection_context():
+    db.create_tables([Pet, Kind])
 
 app = Flask(__name__)
 
-# List of pets, showing related kind information
+@app.before_request
+def open_connection():
+    db.connect(reuse_if_open=True)
+
+# Hands the connection back to the pool, even if the view raised
+@app.teardown_request
+def close_connection(exc):
+    if not db.is_closed():
+        db.close()
+
+# List of pets, showing related kind information. Selecting the Kind columns
+# with the join fills in pet.kind, otherwise each row would query its kind
 @app.route("/")
 @app.route("/list")
 def get_list():
-    pets = Pet.select().join(Kind)
+    pets = Pet.select(Pet, Kind).join(Kind).order_by(Pet.id)
     return render_template("list.html", pets=pets)
 
 # Create a new pet with a dropdown to select kind
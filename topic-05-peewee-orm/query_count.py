@@ -0,0 +1,130 @@
+import contextlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Most queries each view may run, however many pets and kinds there are
+VIEW_QUERY_LIMITS = {
+    "/list": 1,
+    "/create": 1,
+    "/update/{pet_id}": 2,
+    "/kind/list": 1,
+    "/kind/update/{kind_id}": 1,
+}
+
+
+class QueryCounter:
+    """Records the SQL a peewee database runs while it is active"""
+
+    def __init__(self, database):
+        self.database = database
+        self.queries = []
+
+    def __enter__(self):
+        original = self.database.execute_sql
+
+        def execute_sql(sql, params=None):
+            self.queries.append(sql)
+            return original(sql, params)
+
+        self.database.execute_sql = execute_sql
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.database.execute_sql
+
+    def __len__(self):
+        return len(self.queries)
+
+
+@contextlib.contextmanager
+def max_queries(database, limit, label="block"):
+    """Fail with the SQL that ran if the block runs more than limit queries"""
+    with QueryCounter(database) as counter:
+        yield counter
+    if len(counter) > limit:
+        statements = "\n".join(counter.queries)
+        raise AssertionError(f"{label} ran {len(counter)} queries, expected at most {limit}:\n{statements}")
+
+
+# Point the app's models at a new database file for a test
+@contextlib.contextmanager
+def temporary_database(pets, kinds):
+    import app
+
+    path = os.path.join(tempfile.mkdtemp(), "pets.db")
+    app.db.close_all()
+    app.db.init(path)
+    try:
+        with app.db.connection_context():
+            app.db.create_tables([app.Pet, app.Kind])
+        with app.db.connection_context(), app.db.atomic():
+            kind_ids = [
+                app.Kind.create(kind_name=f"kind {i}", food="food", noise="noise").id
+                for i in range(kinds)
+            ]
+            app.Pet.insert_many([
+                {"name": f"pet {i}", "age": i % 20, "owner": "owner", "kind": kind_ids[i % kinds]}
+                for i in range(pets)
+            ]).execute()
+        yield app
+    finally:
+        if not app.db.is_closed():
+            app.db.close()
+        app.db.close_all()
+        app.db.init("pets.db")
+
+
+def test_view_query_counts():
+    print("test view_query_counts")
+    for pets, kinds in [(3, 2), (300, 40)]:
+        with temporary_database(pets, kinds) as app:
+            client = app.app.test_client()
+            for route, limit in VIEW_QUERY_LIMITS.items():
+                path = route.format(pet_id=pets, kind_id=kinds)
+                with max_queries(app.db, limit, f"GET {path} with {pets} pets") as counter:
+                    response = client.get(path)
+                assert response.status_code == 200, path
+                assert len(counter) > 0, path
+
+            html = client.get("/list").get_data(as_text=True)
+            assert html.count("/delete/") == pets
+            assert f"kind {kinds - 1}" in html
+
+
+def test_max_queries_fails_on_lazy_foreign_keys():
+    print("test max_queries_fails_on_lazy_foreign_keys")
+    with temporary_database(10, 3) as app, app.db.connection_context():
+        try:
+            with max_queries(app.db, 1):
+                [pet.kind.kind_name for pet in app.Pet.select()]
+        except AssertionError as e:
+            assert "11 queries" in str(e)
+        else:
+            assert False, "expected the lazy loads to be caught"
+
+
+def test_requests_return_connections_to_the_pool():
+    print("test requests_return_connections_to_the_pool")
+    with temporary_database(50, 5) as app:
+        client = app.app.test_client()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            statuses = list(executor.map(lambda i: client.get("/list").status_code, range(64)))
+        assert statuses == [200] * 64
+        assert app.db.is_closed()
+        assert not app.db._in_use
+        assert 0 < len(app.db._connections) <= app.db._max_connections
+
+        # Pragmas are applied to pooled connections, so the kind still in use is kept
+        html = client.get("/kind/delete/1").get_data(as_text=True)
+        assert "Cannot delete kind" in html
+        with app.db.connection_context():
+            assert app.Kind.get_or_none(app.Kind.id == 1) is not None
+            assert app.db.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+if __name__ == "__main__":
+    test_view_query_counts()
+    test_max_queries_fails_on_lazy_foreign_keys()
+    test_requests_return_connections_to_the_pool()
+    print("done.")
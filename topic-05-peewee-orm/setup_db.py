@@ -1,6 +1,12 @@
 from peewee import *
 
-db = SqliteDatabase('pets.db')
+# Same storage profile as the app's pooled connections, see PRAGMAS in app.py
+db = SqliteDatabase('pets.db', pragmas={
+    "foreign_keys": 1,
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+})
 
 class BaseModel(Model):
     class Meta:
@@ -18,5 +24,5 @@ class Pet(BaseModel):
     kind = ForeignKeyField(Kind, backref='pets')
 
 # Create tables if they don't exist
-db.connect()
-db.create_tables([Pet, Kind])
\ No newline at end of file
+with db:
+    db.create_tables([Pet, Kind])
@@ -1,36 +1,36 @@
 from flask import Flask, render_template, request, redirect, url_for
+import contextlib
+import os
+import sqlite3
+import sys
+import tempfile
 import dataset
 
 # Connect to the SQLite database using dataset
 db = dataset.connect('sqlite:///pets.db')
 
+# Lets the "is this kind in use" check read the index instead of the table
+db['pets'].create_index(['kind_id'])
+
+# Every pet with its kind, joined by SQLite in one query
+LIST_PETS_SQL = """
+    SELECT pets.id, pets.name, pets.age, pets.owner, kind.kind_name, kind.food, kind.noise
+    FROM pets
+    JOIN kind ON pets.kind_id = kind.id
+    ORDER BY pets.id
+"""
+
+KIND_IN_USE_SQL = "SELECT EXISTS (SELECT 1 FROM pets WHERE kind_id = :kind_id) AS in_use"
+
 app = Flask(__name__)
 
 # List of pets, showing related kind information
 @app.route("/")
 @app.route("/list")
 def get_list():
-    # Use dataset to fetch all pets and join kinds
-    pets_table = db['pets']
-    kinds_table = db['kind']
-    
-    pets = pets_table.all()
-    pet_list = []
-    
-    # Create a list of pets with kind information by manually joining
-    for pet in pets:
-        kind = kinds_table.find_one(id=pet['kind_id'])
-        pet_list.append({
-            'id': pet['id'],
-            'name': pet['name'],
-            'age': pet['age'],
-            'owner': pet['owner'],
-            'kind_name': kind['kind_name'],
-            'food': kind['food'],
-            'noise': kind['noise']
-        })
-    
-    return render_template("list.html", pets=pet_list)
+    # One JOIN instead of a find_one on kinds for every pet
+    pets = db.query(LIST_PETS_SQL)
+    return render_template("list.html", pets=pets)
 
 # Create a new pet with a dropdown to select kind
 @app.route("/create", methods=['GET', 'POST'])
@@ -132,9 +132,9 @@ def update_kind(id):
 @app.route("/kind/delete/<id>")
 def delete_kind(id):
     kinds_table = db['kind']
-    pets_table = db['pets']
     
-    if pets_table.find_one(kind_id=id):
+    in_use = next(iter(db.query(KIND_IN_USE_SQL, kind_id=id)))['in_use']
+    if in_use:
         kinds = kinds_table.all()
         error_message = "Cannot delete kind as it is associated with pets. Please delete the pets first."
         return render_template("kind_list.html", kinds=kinds, error_message=error_message)
@@ -142,5 +142,87 @@ def delete_kind(id):
     kinds_table.delete(id=id)
     return redirect(url_for('list_kinds'))
 
+# Tests run the routes against a throwaway copy of create_db.sql, so pets.db
+# is never touched
+@contextlib.contextmanager
+def _test_database():
+    global db
+    path = os.path.join(tempfile.mkdtemp(), "pets.db")
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "create_db.sql")) as script:
+        with sqlite3.connect(path) as connection:
+            connection.executescript(script.read())
+    saved = db
+    db = dataset.connect(f"sqlite:///{path}")
+    try:
+        yield db
+    finally:
+        db.close()
+        db = saved
+
+# SQL statements the database runs inside the with block
+@contextlib.contextmanager
+def _count_queries(database):
+    from sqlalchemy import event
+    statements = []
+
+    def record(connection, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(database.engine, "before_cursor_execute", record)
+
+def test_list_pets():
+    print("test list_pets")
+    with _test_database() as database:
+        rows = [dict(row) for row in database.query(LIST_PETS_SQL)]
+        assert [(row["name"], row["kind_name"], row["food"], row["noise"]) for row in rows] == [
+            ("Suzy", "Dog", "Dog food", "Bark"),
+            ("Sandy", "Cat", "Cat food", "Meow"),
+            ("Dorothy", "Fish", "Fish flakes", "Blub"),
+            ("Heidi", "Dog", "Dog food", "Bark"),
+        ]
+        assert rows[0]["id"] == 1 and rows[0]["age"] == 3 and rows[0]["owner"] == "Greg"
+
+        page = app.test_client().get("/list").get_data(as_text=True)
+        assert "<td>Dorothy</td>" in page and "<td>Fish flakes</td>" in page
+
+def test_list_pets_runs_one_query():
+    print("test list_pets_runs_one_query")
+    with _test_database() as database:
+        database["pets"].insert_many([
+            {"name": f"pet {i}", "age": 1, "owner": "Owner", "kind_id": i % 3 + 1} for i in range(50)
+        ])
+        client = app.test_client()
+        with _count_queries(database) as statements:
+            page = client.get("/list").get_data(as_text=True)
+        assert len(statements) == 1, statements
+        assert page.count("<tr>") == 54 + 1
+
+def test_delete_kind():
+    print("test delete_kind")
+    with _test_database() as database:
+        client = app.test_client()
+
+        # Dogs are still in use, the kind stays
+        response = client.get("/kind/delete/1")
+        assert response.status_code == 200
+        assert "Cannot delete kind" in response.get_data(as_text=True)
+        assert database["kind"].find_one(id=1)["kind_name"] == "Dog"
+
+        kind_id = database["kind"].insert({"kind_name": "Bird", "food": "Seeds", "noise": "Tweet"})
+        response = client.get(f"/kind/delete/{kind_id}")
+        assert response.status_code == 302
+        assert database["kind"].find_one(id=kind_id) is None
+        assert database["kind"].count() == 3
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        test_list_pets()
+        test_list_pets_runs_one_query()
+        test_delete_kind()
+        print("done.")
+    else:
+        app.run(debug=True)
@@ -36,3 +36,5 @@ VALUES ('Dorothy', 1, 3, 'Elizabeth');  -- Fish
 
 INSERT INTO pets (name, age, kind_id, owner)
 VALUES ('Heidi', 4, 1, 'David');  -- Dog
+
+CREATE INDEX idx_pets_kind_id ON pets (kind_id);
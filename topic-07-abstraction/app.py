@@ -2,6 +2,7 @@ from flask import Flask, render_template, request, redirect, url_for
 import database
 
 app = Flask(__name__)
+database.connections.init_app(app)
 
 # List of pets, showing related kind information
 @app.route("/")
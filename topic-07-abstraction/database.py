@@ -1,10 +1,12 @@
 import sqlite3
 from pprint import pprint
+from connections import ConnectionPool
 
-connection = sqlite3.connect("pets.db", check_same_thread=False)
-connection.execute("PRAGMA foreign_keys = 1")
+# Each thread gets a connection of its own, with foreign keys on
+connections = ConnectionPool("pets.db")
 
 def retrieve_list():
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("""
         SELECT pets.id, pets.name, pets.age, pets.owner, kind.kind_name, kind.food, kind.noise 
@@ -20,6 +22,7 @@ def test_retrieve_list():
     assert type(rows) is list
 
 def retrieve_kinds():
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("SELECT id, kind_name FROM kind")
     kinds = list(cursor.fetchall())
@@ -31,6 +34,7 @@ def test_retrieve_kinds():
     assert kinds == [(1, 'Dog'), (2, 'Cat')]
 
 def retrieve_pet(id):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("SELECT * FROM pets WHERE id=?", (id,))
     pet = cursor.fetchone()
@@ -42,6 +46,7 @@ def test_retrieve_pet():
     assert pet == (1, 'Suzy', 3, 1, 'Greg')
 
 def create_pet(data):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("""
             INSERT INTO pets (name, age, kind_id, owner) 
@@ -50,6 +55,7 @@ def create_pet(data):
     connection.commit()
 
 def delete_pet(id):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("DELETE FROM pets WHERE id = ?", (id,))
     connection.commit()
@@ -83,6 +89,7 @@ def test_create_and_delete_pet():
     assert not found
 
 def update_pet(id, data):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("""
             UPDATE pets 
@@ -113,6 +120,7 @@ def test_update_pet():
     assert pet == (1, 'Suzy', 3, 1, 'Greg')
 
 def retrieve_list_kinds():
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("SELECT * FROM kind")
     kinds = cursor.fetchall()
@@ -128,12 +136,14 @@ def test_retrieve_list_kinds():
         assert type(kind[3]) is str
 
 def create_kind(data):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("INSERT INTO kind (kind_name, food, noise) VALUES (?, ?, ?)", 
                        (data["kind_name"], data["food"], data["noise"]))
     connection.commit()
 
 def delete_kind(id):
+    connection = connections.current()
     cursor = connection.cursor()
     try:
         cursor.execute("DELETE FROM kind WHERE id = ?", (id,))
@@ -167,6 +177,7 @@ def test_create_and_delete_kind():
     assert not found
 
 def retrieve_kind(id):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("SELECT * FROM kind WHERE id=?", (id,))
     kind = cursor.fetchone()
@@ -177,6 +188,7 @@ def test_retrieve_kind():
     assert kind == (1, 'Dog', 'Dog food', 'Bark')
 
 def update_kind(id, data):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("""
         UPDATE kind 
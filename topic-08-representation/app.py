@@ -2,12 +2,14 @@ from flask import Flask, render_template, request, redirect, url_for
 import database
 
 app = Flask(__name__)
+database.connections.init_app(app)
+database.metrics.init_app(app)
 
 # List of pets, showing related kind information
 @app.route("/")
 @app.route("/list")
 def get_list():
-    pets = database.retrieve_pets()
+    pets = database.iter_pets()
     return render_template("list.html", pets=pets)
 
 # Create a new pet with a dropdown to select kind
@@ -0,0 +1,308 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free in time"""
+
+
+class ConnectionPool:
+    """SQLite connections for request threads, never shared between them
+
+    current() gives the calling thread a connection of its own, checked out
+    the first time the thread asks and kept until release() hands it back at
+    the end of the request. Every checkout turns foreign keys back on and
+    applies the pool's row_factory again, whatever the last borrower did.
+    """
+
+    def __init__(self, path, size=8, checkout_timeout=30, factory=sqlite3.Connection, row_factory=None):
+        self.path = path
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.factory = factory
+        self.row_factory = row_factory
+        self._lock = threading.Condition()
+        self._idle = []  # most recently returned last
+        self._open = 0
+        self._closed = False
+        self._local = threading.local()
+        self._stats = {"checkouts": 0, "in_use": 0, "created": 0, "waits": 0, "timeouts": 0}
+
+    def _connect(self):
+        # Moves between threads, but only one of them holds it at a time
+        return sqlite3.connect(self.path, check_same_thread=False, factory=self.factory)
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        connection = None
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("connection pool is closed")
+            while not self._idle and self._open >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection free after {self.checkout_timeout}s")
+                self._stats["waits"] += 1
+                self._lock.wait(remaining)
+                if self._closed:
+                    raise RuntimeError("connection pool is closed")
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                # Reserve a slot, the connection is opened outside the lock
+                self._open += 1
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+
+        if connection is None:
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                    self._stats["in_use"] -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self._stats["created"] += 1
+
+        try:
+            connection.execute("PRAGMA foreign_keys = 1")
+        except Exception:
+            self._checkin(connection)
+            raise
+        connection.row_factory = self.row_factory
+        return connection
+
+    def _checkin(self, connection):
+        # Never hand the next borrower a half-finished transaction
+        reusable = True
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except sqlite3.Error:
+            reusable = False
+
+        with self._lock:
+            self._stats["in_use"] -= 1
+            if reusable and not self._closed:
+                self._idle.append(connection)
+            else:
+                connection.close()
+                self._open -= 1
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with block"""
+        connection = self._checkout()
+        try:
+            yield connection
+        finally:
+            self._checkin(connection)
+
+    def current(self):
+        """The calling thread's connection, checked out on first use"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._checkout()
+        return connection
+
+    def release(self, exc=None):
+        """Return the calling thread's connection to the pool, if it has one"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            self._local.connection = None
+            self._checkin(connection)
+
+    def init_app(self, app):
+        """Release each request's connection when the request ends"""
+        app.teardown_request(self.release)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, open=self._open, idle=len(self._idle), size=self.size)
+
+    def close(self):
+        """Close the idle connections, checked out ones close on checkin"""
+        with self._lock:
+            self._closed = True
+            for connection in self._idle:
+                connection.close()
+            self._open -= len(self._idle)
+            self._idle.clear()
+            # Wake waiting checkouts so they fail instead of timing out
+            self._lock.notify_all()
+
+
+def _test_pool(**kwargs):
+    path = os.path.join(tempfile.mkdtemp(), "pets.db")
+    with sqlite3.connect(path) as connection:
+        connection.executescript("""
+            CREATE TABLE kind (id INTEGER PRIMARY KEY, kind_name TEXT);
+            CREATE TABLE pets (id INTEGER PRIMARY KEY, name TEXT, kind_id INTEGER REFERENCES kind (id));
+            INSERT INTO kind (kind_name) VALUES ('Dog');
+        """)
+        connection.executemany("INSERT INTO pets (name, kind_id) VALUES (?, 1)", [(f"pet {i}",) for i in range(500)])
+    return ConnectionPool(path, **kwargs)
+
+
+def test_checkout_settings():
+    print("test checkout_settings")
+    pool = _test_pool(size=1, row_factory=sqlite3.Row)
+    connection = pool.current()
+    assert pool.current() is connection
+    assert connection.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+    try:
+        connection.execute("INSERT INTO pets (name, kind_id) VALUES ('stray', 99)")
+    except sqlite3.IntegrityError:
+        pass
+    else:
+        assert False, "foreign keys should be enforced"
+    connection.row_factory = None
+    connection.execute("PRAGMA foreign_keys = 0")
+    connection.execute("DELETE FROM pets")
+    pool.release()
+
+    # The next borrower gets the row factory and foreign keys back, and none
+    # of the open transaction
+    with pool.connection() as connection:
+        row = connection.execute("SELECT COUNT(*) AS count FROM pets").fetchone()
+        assert row["count"] == 500
+        assert connection.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+    assert pool.stats()["created"] == 1
+
+
+def test_checkout_timeout():
+    print("test checkout_timeout")
+    pool = _test_pool(size=1, checkout_timeout=0.05)
+    pool.current()
+    failed = []
+    thread = threading.Thread(target=lambda: failed.append(_raises_timeout(pool)))
+    thread.start()
+    thread.join()
+    assert failed == [True]
+    pool.release()
+    with pool.connection():
+        pass
+
+
+def _raises_timeout(pool):
+    try:
+        pool.current()
+    except PoolTimeout:
+        return True
+    return False
+
+
+def test_concurrent_threads_never_share_a_connection():
+    print("test concurrent_threads_never_share_a_connection")
+    pool = _test_pool(size=4)
+    in_use = set()
+    in_use_lock = threading.Lock()
+    errors = []
+
+    def worker(number):
+        try:
+            for i in range(25):
+                connection = pool.current()
+                with in_use_lock:
+                    assert id(connection) not in in_use, "connection handed to two threads"
+                    in_use.add(id(connection))
+                # Every borrower turns foreign keys off, checkout turns them back on
+                assert connection.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+                connection.execute("PRAGMA foreign_keys = 0")
+
+                # Read in small batches while the other threads run their own cursors
+                cursor = connection.execute("SELECT id FROM pets WHERE id <= 500 ORDER BY id")
+                ids = []
+                while batch := cursor.fetchmany(50):
+                    ids.extend(row[0] for row in batch)
+                    time.sleep(0)
+                assert ids == list(range(1, 501)), "cursor saw another thread's rows"
+
+                # lastrowid and the transaction belong to this thread alone
+                name = f"thread {number} row {i}"
+                cursor = connection.execute("INSERT INTO pets (name, kind_id) VALUES (?, 1)", (name,))
+                time.sleep(0)
+                assert connection.execute("SELECT name FROM pets WHERE id = ?", (cursor.lastrowid,)).fetchone()[0] == name
+                if i % 2:
+                    connection.commit()
+                else:
+                    connection.rollback()
+
+                with in_use_lock:
+                    in_use.remove(id(connection))
+                pool.release()
+        except Exception as e:
+            errors.append(e)
+            pool.release()
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == [], errors
+    stats = pool.stats()
+    assert stats["in_use"] == 0 and stats["open"] <= 4
+    assert stats["checkouts"] == 16 * 25
+    with pool.connection() as connection:
+        committed = connection.execute("SELECT COUNT(*) FROM pets WHERE name LIKE 'thread %'").fetchone()[0]
+    assert committed == 16 * 12
+
+
+def test_close():
+    print("test close")
+    pool = _test_pool(size=2, checkout_timeout=5)
+    borrowed = pool.current()
+    with pool.connection():
+        pass
+    assert pool.stats()["idle"] == 1
+
+    # A thread already waiting for a connection fails as soon as the pool closes
+    with pool.connection():
+        failed = []
+        thread = threading.Thread(target=lambda: failed.append(_raises_closed(pool)))
+        thread.start()
+        time.sleep(0.05)
+        pool.close()
+        thread.join()
+    assert failed == [True]
+    stats = pool.stats()
+    assert stats["idle"] == 0 and stats["open"] == 1
+
+    # Connections still out close when they come back instead of being reused
+    pool.release()
+    stats = pool.stats()
+    assert stats["idle"] == 0 and stats["open"] == 0 and stats["in_use"] == 0
+    try:
+        borrowed.execute("SELECT 1")
+    except sqlite3.ProgrammingError:
+        pass
+    else:
+        assert False, "connection returned after close was left open"
+    assert _raises_closed(pool)
+
+
+def _raises_closed(pool):
+    try:
+        with pool.connection():
+            pass
+    except RuntimeError:
+        return True
+    return False
+
+
+if __name__ == "__main__":
+    test_checkout_settings()
+    test_checkout_timeout()
+    test_concurrent_threads_never_share_a_connection()
+    test_close()
+    print("done.")
@@ -1,23 +1,54 @@
 import sqlite3
 from pprint import pprint
+from connections import ConnectionPool
+from metrics import Metrics, slow_query_threshold
 
-connection = sqlite3.connect("pets.db", check_same_thread=False)
-connection.execute("PRAGMA foreign_keys = 1")
-connection.row_factory = sqlite3.Row  # Set row factory to return dictionaries
+# Query timings, the app serves them at /metrics with the route timings
+metrics = Metrics(slow_query_seconds=slow_query_threshold())
+
+# Each thread gets a connection of its own
+connections = ConnectionPool("pets.db", factory=metrics.connection_class)
+
+# Rows read at a time by the iter_ functions
+FETCH_BATCH_SIZE = 500
+
+# Ids go to the templates as strings, SQLite converts them as it reads
+PETS_SQL = """
+    SELECT CAST(pets.id AS TEXT) AS id, pets.name, pets.age, pets.owner, kind.kind_name, kind.food, kind.noise
+    FROM pets
+    JOIN kind ON pets.kind_id = kind.id
+"""
+PET_SQL = "SELECT CAST(id AS TEXT) AS id, name, age, CAST(kind_id AS TEXT) AS kind_id, owner FROM pets WHERE id=?"
+KINDS_SQL = "SELECT CAST(id AS TEXT) AS id, kind_name, food, noise FROM kind"
+KIND_SQL = KINDS_SQL + " WHERE id=?"
+
+# Have the cursor build each row straight into the dictionary the templates
+# use, with the column names read once per query rather than once per row
+def dict_rows(cursor):
+    names = [column[0] for column in cursor.description]
+    cursor.row_factory = lambda cursor, row: dict(zip(names, row))
+    return cursor
+
+def test_dict_rows():
+    print("test dict_rows")
+    cursor = dict_rows(connections.current().execute("SELECT 1 AS a, 'x' AS b UNION ALL SELECT 2, 'y'"))
+    assert cursor.fetchall() == [{"a": 1, "b": "x"}, {"a": 2, "b": "y"}]
 
 def retrieve_pets():
+    connection = connections.current()
     cursor = connection.cursor()
-    cursor.execute("""
-        SELECT pets.id, pets.name, pets.age, pets.owner, kind.kind_name, kind.food, kind.noise 
-        FROM pets 
-        JOIN kind ON pets.kind_id = kind.id
-    """)
-    pets = cursor.fetchall()
-    # Convert rows to list of dictionaries
-    pets = [dict(pet) for pet in pets]
-    for pet in pets:
-        pet["id"] = str(pet["id"])
-    return pets
+    cursor.execute(PETS_SQL)
+    return dict_rows(cursor).fetchall()
+
+# The same rows as retrieve_pets, read a batch at a time as they are used so
+# a long listing is never in memory all at once
+def iter_pets():
+    connection = connections.current()
+    cursor = connection.cursor()
+    cursor.execute(PETS_SQL)
+    dict_rows(cursor)
+    while pets := cursor.fetchmany(FETCH_BATCH_SIZE):
+        yield from pets
 
 def test_retrieve_pets():
     print("test retrieve_pets")
@@ -26,14 +57,18 @@ def test_retrieve_pets():
     assert type(pets[0]) is dict
     assert pets[0] == {'id': '1', 'name': 'Suzy', 'age': 3, 'owner': 'Greg', 'kind_name': 'Dog', 'food': 'Dog food', 'noise': 'Bark'}
 
+def test_iter_pets():
+    print("test iter_pets")
+    pets = iter_pets()
+    assert type(pets) is not list
+    assert list(pets) == retrieve_pets()
+
 def retrieve_pet(id):
+    connection = connections.current()
     cursor = connection.cursor()
     id = int(id)
-    cursor.execute("SELECT * FROM pets WHERE id=?", (id,))
-    pet = dict(cursor.fetchone())
-    pet["id"] = str(pet["id"])
-    pet["kind_id"] = str(pet["kind_id"])
-    return pet
+    cursor.execute(PET_SQL, (id,))
+    return dict_rows(cursor).fetchone()
 
 def test_retrieve_pet():
     print("test retrieve_pet")
@@ -41,6 +76,7 @@ def test_retrieve_pet():
     assert pet == {'id': '1', 'name': 'Suzy', 'age': 3, 'kind_id': "1", 'owner': 'Greg'}    
 
 def create_pet(data):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("""
             INSERT INTO pets (name, age, kind_id, owner) 
@@ -49,6 +85,7 @@ def create_pet(data):
     connection.commit()
 
 def delete_pet(id):
+    connection = connections.current()
     cursor = connection.cursor()
     id = int(id)
     cursor.execute("DELETE FROM pets WHERE id = ?", (id,))
@@ -85,6 +122,7 @@ def test_create_and_delete_pet():
     assert not found
 
 def update_pet(id, data):
+    connection = connections.current()
     cursor = connection.cursor()
     id = int(id)
     cursor.execute("""
@@ -119,13 +157,10 @@ def test_update_pet():
 
 
 def retrieve_kinds():
+    connection = connections.current()
     cursor = connection.cursor()
-    cursor.execute("SELECT * FROM kind")
-    kinds = cursor.fetchall()
-    kinds = [dict(kind) for kind in kinds]
-    for kind in kinds:
-        kind["id"] = str(kind["id"])
-    return kinds
+    cursor.execute(KINDS_SQL)
+    return dict_rows(cursor).fetchall()
 
 def test_retrieve_kinds():
     print('test retrieve_kinds')
@@ -135,12 +170,11 @@ def test_retrieve_kinds():
     assert kinds[0] == {'id': '1', 'kind_name': 'Dog', 'food': 'Dog food', 'noise': 'Bark'}
 
 def retrieve_kind(id):
+    connection = connections.current()
     cursor = connection.cursor()
     id = int(id)
-    cursor.execute("SELECT * FROM kind WHERE id=?", (id,))
-    kind = dict(cursor.fetchone())
-    kind["id"] = str(kind["id"])
-    return kind
+    cursor.execute(KIND_SQL, (id,))
+    return dict_rows(cursor).fetchone()
 
 def test_retrieve_kind():
     print('test retrieve_kind')
@@ -148,12 +182,14 @@ def test_retrieve_kind():
     assert kind == {'id': '1', 'kind_name': 'Dog', 'food': 'Dog food', 'noise': 'Bark'}
 
 def create_kind(data):
+    connection = connections.current()
     cursor = connection.cursor()
     cursor.execute("INSERT INTO kind (kind_name, food, noise) VALUES (?, ?, ?)", 
                        (data["kind_name"], data["food"], data["noise"]))
     connection.commit()
 
 def delete_kind(id):
+    connection = connections.current()
     cursor = connection.cursor()
     try:
         cursor.execute("DELETE FROM kind WHERE id = ?", (id,))
@@ -187,6 +223,7 @@ def test_create_and_delete_kind():
     assert not found
 
 def update_kind(id, data):
+    connection = connections.current()
     cursor = connection.cursor()
     id = int(id)
     cursor.execute("""
@@ -219,7 +256,9 @@ def test_update_kind():
 
 
 if __name__ == "__main__":
+    test_dict_rows()
     test_retrieve_pets()
+    test_iter_pets()
     test_retrieve_pet()
     test_create_and_delete_pet()
     test_update_pet()
@@ -0,0 +1,425 @@
+# Request, query and template metrics for the Flask and Quart apps. Each
+# topic folder is its own app, run from inside the folder with "flask --app
+# app run" and not installed as a package, so every app using this module
+# carries a copy of it, one per folder in COPIES. The copies are kept byte
+# for byte the same, test_copies_match fails when they drift, so change
+# them together.
+import contextvars
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from flask import Response, g, request
+from flask.signals import before_render_template, template_rendered
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Longer statements are cut down to this many characters in labels and logs
+STATEMENT_LENGTH = 200
+
+# Rows fetched at a time when a cursor is iterated, each batch is reported
+# to the metrics once rather than row by row
+ITER_BATCH_ROWS = 256
+
+# Folders holding a copy of this module
+COPIES = ("ADSD-Final-Project", "topic-04-foreign-keys", "topic-08-representation")
+
+slow_query_log = logging.getLogger("slow_queries")
+
+# Statements run for the current request, as a one item list. Work a request
+# hands to a thread counts too when run in a copy of the request's context.
+_request_queries = contextvars.ContextVar("request_queries", default=None)
+
+# Start times of a Quart request's renders. A streamed page finishes under a
+# copy of the request context with a g of its own, but in the same task
+_quart_renders = contextvars.ContextVar("quart_renders", default=None)
+
+
+def slow_query_threshold():
+    """SLOW_QUERY_MS from the environment in seconds, None leaves the log off"""
+    value = os.environ.get("SLOW_QUERY_MS")
+    return float(value) / 1000 if value else None
+
+
+def normalize_statement(sql):
+    """One line label for a statement, with runs of placeholders folded so
+    IN lists of any length share a label"""
+    sql = " ".join(sql.split())
+    sql = re.sub(r"\?(\s*,\s*\?)+", "?, ...", sql)
+    return sql[:STATEMENT_LENGTH]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [count per bucket..., sum, count]
+
+    def observe(self, values, amount):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if amount <= bound:
+                series[i] += 1
+        series[-2] += amount
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, values, le)} {count}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labels, values, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, values)} {_number(series[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, values)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}  # label values -> total
+
+    def inc(self, values, amount=1):
+        self.series[values] = self.series.get(values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, total in sorted(self.series.items()):
+            lines.append(f"{self.name}{_labels(self.labels, values)} {_number(total)}")
+        return lines
+
+
+class Metrics:
+    """
+    Request, query and template timings for one app, in Prometheus text
+    format at /metrics.
+
+    init_app() times every request and template render of a Flask app, and
+    init_quart_app() those of a Quart app. Queries are timed by
+    opening connections with factory=metrics.connection_class. A query's
+    time is what execute() took, which covers sorting and the first row;
+    fetching the rest is counted separately since a cursor can be read long
+    after it ran. Statements at or over slow_query_seconds are logged to the
+    "slow_queries" logger.
+    """
+
+    def __init__(self, slow_query_seconds=None):
+        self.slow_query_seconds = slow_query_seconds
+        self._lock = threading.Lock()
+        self.request_seconds = Histogram(
+            "http_request_duration_seconds", "Time to build the response, by route.",
+            ("route", "method", "status"))
+        self.request_queries = Histogram(
+            "http_request_queries", "SQL statements run per request, by route.",
+            ("route", "method"), buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000))
+        self.query_seconds = Histogram(
+            "sqlite_query_duration_seconds", "Time spent in execute(), by statement.",
+            ("statement",))
+        self.fetch_seconds = Counter(
+            "sqlite_fetch_seconds_total", "Time spent fetching result rows, by statement.",
+            ("statement",))
+        self.query_rows = Counter(
+            "sqlite_query_rows_total", "Rows fetched or changed, by statement.",
+            ("statement",))
+        self.template_seconds = Histogram(
+            "template_render_duration_seconds", "Time to render a template, by template.",
+            ("template",))
+        self._renders = threading.local()
+        self.connection_class = _connection_class(self)
+
+    def observe_request(self, route, method, status, seconds, queries):
+        with self._lock:
+            self.request_seconds.observe((route, method, str(status)), seconds)
+            self.request_queries.observe((route, method), queries)
+
+    def observe_query(self, statement, seconds, rows):
+        with self._lock:
+            self.query_seconds.observe((statement,), seconds)
+            if rows > 0:
+                self.query_rows.inc((statement,), rows)
+        queries = _request_queries.get()
+        if queries is not None:
+            queries[0] += 1
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds:
+            slow_query_log.warning("%.1f ms: %s", seconds * 1000, statement)
+
+    def observe_fetch(self, statement, seconds, rows):
+        with self._lock:
+            self.fetch_seconds.inc((statement,), seconds)
+            if rows > 0:
+                self.query_rows.inc((statement,), rows)
+
+    def observe_template(self, name, seconds):
+        with self._lock:
+            self.template_seconds.observe((name,), seconds)
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric in (self.request_seconds, self.request_queries, self.query_seconds,
+                           self.fetch_seconds, self.query_rows, self.template_seconds):
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def init_app(self, app, endpoint="/metrics"):
+        """Time every request and template of app and serve the numbers at endpoint"""
+
+        @app.before_request
+        def start_timer():
+            g._metrics_start = time.perf_counter()
+            g._metrics_queries = [0]
+            _request_queries.set(g._metrics_queries)
+            # Drop anything left over by a render that raised
+            self._renders.stack = []
+
+        @app.after_request
+        def record_request(response):
+            self._record_request(g, request, response)
+            return response
+
+        def render_started(sender, template, context, **extra):
+            stack = getattr(self._renders, "stack", None)
+            if stack is None:
+                stack = self._renders.stack = []
+            stack.append(time.perf_counter())
+
+        def render_finished(sender, template, context, **extra):
+            stack = getattr(self._renders, "stack", None)
+            if stack:
+                self.observe_template(template.name or "<string>", time.perf_counter() - stack.pop())
+
+        before_render_template.connect(render_started, app, weak=False)
+        template_rendered.connect(render_finished, app, weak=False)
+
+        @app.route(endpoint)
+        def metrics():
+            return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+    def init_quart_app(self, app, endpoint="/metrics"):
+        """
+        init_app for a Quart app. Requests interleave on the event loop, so
+        render start times are kept per task rather than per thread. Queries
+        the app runs on threads count towards the request when the thread
+        runs them in contextvars.copy_context() of the request.
+        """
+        import quart
+        from quart.signals import before_render_template, template_rendered
+
+        @app.before_request
+        async def start_timer():
+            quart.g._metrics_start = time.perf_counter()
+            quart.g._metrics_queries = [0]
+            _request_queries.set(quart.g._metrics_queries)
+            _quart_renders.set([])
+
+        @app.after_request
+        async def record_request(response):
+            self._record_request(quart.g, quart.request, response)
+            return response
+
+        # Async receivers, Quart would run plain functions on a thread
+        async def render_started(sender, template, context, **extra):
+            stack = _quart_renders.get()
+            if stack is None:
+                stack = []
+                _quart_renders.set(stack)
+            stack.append(time.perf_counter())
+
+        async def render_finished(sender, template, context, **extra):
+            stack = _quart_renders.get()
+            if stack:
+                self.observe_template(template.name or "<string>", time.perf_counter() - stack.pop())
+
+        before_render_template.connect(render_started, app, weak=False)
+        template_rendered.connect(render_finished, app, weak=False)
+
+        @app.route(endpoint)
+        async def metrics():
+            return quart.Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+    def _record_request(self, g, request, response):
+        start = g.pop("_metrics_start", None)
+        if start is not None:
+            # The URL rule, not the path, so /update/1 and /update/2 share a series
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            queries = g.pop("_metrics_queries", [0])
+            _request_queries.set(None)
+            self.observe_request(route, request.method, response.status_code,
+                                 time.perf_counter() - start, queries[0])
+
+
+def _connection_class(metrics):
+    """sqlite3 connection and cursor classes that report to metrics"""
+
+    class InstrumentedCursor(sqlite3.Cursor):
+        _statement = None
+
+        def _run(self, method, sql, parameters):
+            self._statement = normalize_statement(sql)
+            start = time.perf_counter()
+            try:
+                return method(sql, parameters)
+            finally:
+                # rowcount is -1 for SELECT, whose rows are counted as fetched
+                metrics.observe_query(self._statement, time.perf_counter() - start, self.rowcount)
+
+        def execute(self, sql, parameters=()):
+            return self._run(super().execute, sql, parameters)
+
+        def executemany(self, sql, parameters):
+            return self._run(super().executemany, sql, parameters)
+
+        def _fetch(self, method, *args):
+            start = time.perf_counter()
+            rows = method(*args)
+            if self._statement is not None:
+                count = len(rows) if isinstance(rows, list) else int(rows is not None)
+                metrics.observe_fetch(self._statement, time.perf_counter() - start, count)
+            return rows
+
+        def fetchone(self):
+            return self._fetch(super().fetchone)
+
+        def fetchmany(self, size=None):
+            return self._fetch(super().fetchmany, self.arraysize if size is None else size)
+
+        def fetchall(self):
+            return self._fetch(super().fetchall)
+
+        def __iter__(self):
+            while rows := self.fetchmany(ITER_BATCH_ROWS):
+                yield from rows
+
+    class InstrumentedConnection(sqlite3.Connection):
+        def cursor(self, factory=None):
+            return super().cursor(factory or InstrumentedCursor)
+
+        # The C shortcuts on Connection don't go through cursor()
+        def execute(self, sql, parameters=()):
+            return self.cursor().execute(sql, parameters)
+
+        def executemany(self, sql, parameters):
+            return self.cursor().executemany(sql, parameters)
+
+    return InstrumentedConnection
+
+
+def test_normalize_statement():
+    print("test normalize_statement")
+    assert normalize_statement("""
+        SELECT id
+        FROM vehicles WHERE id IN (?, ?,?)
+    """) == "SELECT id FROM vehicles WHERE id IN (?, ...)"
+    assert len(normalize_statement("SELECT " + "x, " * 500)) == STATEMENT_LENGTH
+
+def test_query_metrics():
+    print("test query_metrics")
+    metrics = Metrics(slow_query_seconds=0)
+    connection = sqlite3.connect(":memory:", factory=metrics.connection_class)
+    connection.execute("CREATE TABLE pets (name TEXT)")
+    connection.executemany("INSERT INTO pets VALUES (?)", [("a",), ("b",), ("c",)])
+    assert connection.execute("SELECT name FROM pets").fetchall() == [("a",), ("b",), ("c",)]
+    cursor = connection.cursor()
+    cursor.execute("SELECT name FROM pets WHERE name > ?", ("a",))
+    assert [row for row in cursor] == [("b",), ("c",)]
+
+    text = metrics.render()
+    assert 'sqlite_query_rows_total{statement="INSERT INTO pets VALUES (?)"} 3' in text
+    assert 'sqlite_query_rows_total{statement="SELECT name FROM pets"} 3' in text
+    assert 'sqlite_query_rows_total{statement="SELECT name FROM pets WHERE name > ?"} 2' in text
+    assert 'sqlite_query_duration_seconds_count{statement="SELECT name FROM pets"} 1' in text
+    assert 'sqlite_query_duration_seconds_bucket{statement="CREATE TABLE pets (name TEXT)",le="+Inf"} 1' in text
+
+def test_iteration_reports_batches():
+    print("test iteration_reports_batches")
+    metrics = Metrics()
+    connection = sqlite3.connect(":memory:", factory=metrics.connection_class)
+    connection.execute("CREATE TABLE numbers (n INTEGER)")
+    connection.executemany("INSERT INTO numbers VALUES (?)", [(n,) for n in range(1000)])
+    fetches = []
+    observe_fetch = metrics.observe_fetch
+
+    def counting_fetch(statement, seconds, rows):
+        fetches.append(rows)
+        observe_fetch(statement, seconds, rows)
+
+    metrics.observe_fetch = counting_fetch
+    assert [row[0] for row in connection.execute("SELECT n FROM numbers ORDER BY n")] == list(range(1000))
+    assert fetches == [256, 256, 256, 232, 0]
+    assert 'sqlite_query_rows_total{statement="SELECT n FROM numbers ORDER BY n"} 1000' in metrics.render()
+
+def test_copies_match():
+    print("test copies_match")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(__file__, "rb") as f:
+        source = f.read()
+    for folder in COPIES:
+        path = os.path.join(root, folder, "metrics.py")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                assert f.read() == source, f"{path} differs from {__file__}"
+
+def test_request_metrics():
+    print("test request_metrics")
+    from flask import Flask, render_template_string
+
+    app = Flask(__name__)
+    metrics = Metrics()
+    metrics.init_app(app)
+    connection = sqlite3.connect(":memory:", factory=metrics.connection_class, check_same_thread=False)
+
+    @app.route("/pet/<id>")
+    def pet(id):
+        connection.execute("SELECT ?", (id,)).fetchone()
+        connection.execute("SELECT ?", (id,)).fetchone()
+        return render_template_string("{{ id }}", id=id)
+
+    client = app.test_client()
+    assert client.get("/pet/1").data == b"1"
+    assert client.get("/pet/2").data == b"2"
+    assert client.get("/missing").status_code == 404
+
+    response = client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{route="/pet/<id>",method="GET",status="200"} 2' in text
+    assert 'http_request_duration_seconds_count{route="unmatched",method="GET",status="404"} 1' in text
+    assert 'http_request_queries_bucket{route="/pet/<id>",method="GET",le="1"} 0' in text
+    assert 'http_request_queries_bucket{route="/pet/<id>",method="GET",le="2"} 2' in text
+    assert 'template_render_duration_seconds_count{template="<string>"} 2' in text
+
+
+if __name__ == "__main__":
+    test_normalize_statement()
+    test_query_metrics()
+    test_iteration_reports_batches()
+    test_request_metrics()
+    test_copies_match()
+    print("done.")
@@ -0,0 +1,76 @@
+# How retrieve_pets scales with the number of pets, against the old join
+# that ran one find_one per pet. Works on a throwaway Mongita store:
+#
+#     python benchmark.py                # 10 to 1M pets
+#     python benchmark.py 10 1000 100000
+#     python benchmark.py --kind-ratio 10 1000 10000   # many more kinds
+import random
+import sys
+import tempfile
+import time
+
+from mongita import MongitaClientDisk
+
+import database
+
+SIZES = [10, 100, 1_000, 10_000, 100_000, 1_000_000]
+
+# The per-row join gets too slow to wait for beyond this many pets
+MAX_PER_ROW = 10_000
+
+# One kind for this many pets
+KIND_RATIO = 1000
+
+
+def retrieve_pets_per_row():
+    """retrieve_pets as it was, one kind lookup per pet"""
+    pet_collection = database.pets_db.pet_collection
+    kind_collection = database.pets_db.kind_collection
+    pets = list(pet_collection.find())
+    for pet in pets:
+        pet["id"] = str(pet["_id"])
+        del pet["_id"]
+        kind = kind_collection.find_one({"_id": pet["kind_id"]})
+        for tag in ["kind_name", "noise", "food"]:
+            pet[tag] = kind[tag]
+        del pet["kind_id"]
+    return pets
+
+
+def seed(pets_db, pets):
+    rng = random.Random(0)
+    kinds = pets_db.kind_collection.insert_many([
+        {"kind_name": f"Kind {i}", "food": "Food", "noise": "Noise"} for i in range(max(3, pets // KIND_RATIO))
+    ]).inserted_ids
+    for start in range(0, pets, 50_000):
+        pets_db.pet_collection.insert_many([
+            {"name": "Pet", "age": rng.randrange(20), "kind_id": rng.choice(kinds), "owner": "Owner"}
+            for _ in range(start, min(pets, start + 50_000))
+        ])
+
+
+def timed(function):
+    start = time.perf_counter()
+    rows = function()
+    return time.perf_counter() - start, len(rows)
+
+
+if __name__ == "__main__":
+    if "--kind-ratio" in sys.argv:
+        index = sys.argv.index("--kind-ratio")
+        KIND_RATIO = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    print(f"{'pets':>10}{'batched s':>12}{'per row s':>12}{'speedup':>10}")
+    for size in sizes:
+        database.client = MongitaClientDisk(tempfile.mkdtemp())
+        database.pets_db = database.client.pets_db
+        seed(database.pets_db, size)
+
+        batched, rows = timed(database.retrieve_pets)
+        assert rows == size
+        if size <= MAX_PER_ROW:
+            per_row, _ = timed(retrieve_pets_per_row)
+            print(f"{size:>10}{batched:>12.3f}{per_row:>12.3f}{per_row / batched:>9.1f}x")
+        else:
+            print(f"{size:>10}{batched:>12.3f}{'-':>12}{'-':>10}")
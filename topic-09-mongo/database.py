@@ -9,19 +9,53 @@ client = MongitaClientDisk()
 pets_db = client.pets_db
 
 
+# Pets with their kind joined in, done by the server where the client has
+# aggregate. Every pet field but _id and kind_id is kept, as in the Mongita
+# join below, and pets whose kind is gone are left out by $unwind.
+RETRIEVE_PETS_PIPELINE = [
+    {"$lookup": {"from": "kind_collection", "localField": "kind_id", "foreignField": "_id", "as": "kind"}},
+    {"$unwind": "$kind"},
+    {"$addFields": {
+        "id": {"$toString": "$_id"},
+        "kind_name": "$kind.kind_name",
+        "food": "$kind.food",
+        "noise": "$kind.noise",
+    }},
+    {"$project": {"_id": 0, "kind_id": 0, "kind": 0}},
+]
+
+def _is_mongita(collection):
+    # Mongita collections raise on aggregate rather than lack it
+    return type(collection).__module__.startswith("mongita")
+
 def retrieve_pets():
-    pet_collection = pets_db.pet_collection
-    kind_collection = pets_db.kind_collection
+    return join_pets(pets_db)
+
+def join_pets(database):
+    pet_collection = database.pet_collection
+    kind_collection = database.kind_collection
+    if not _is_mongita(pet_collection):
+        return list(pet_collection.aggregate(RETRIEVE_PETS_PIPELINE))
+
+    # Mongita has no aggregate, so join in memory, looking each kind up
+    # once instead of once per pet. By _id rather than with one $in query:
+    # Mongita checks $in by comparing every kind with every id, while an
+    # _id lookup goes straight to the document.
     pets = list(pet_collection.find())
+    kinds = {kind_id: kind_collection.find_one({"_id": kind_id})
+             for kind_id in {pet["kind_id"] for pet in pets}}
+    joined = []
     for pet in pets:
+        kind = kinds[pet["kind_id"]]
+        if kind is None:
+            continue
         pet["id"] = str(pet["_id"])
         del pet["_id"]
-        kind = kind_collection.find_one({"_id":pet["kind_id"]})
         for tag in ["kind_name","noise","food"]:
             pet[tag] = kind[tag]
         del pet["kind_id"]
-        # pet["_id"] = ObjectId(pet["id"])
-    return pets
+        joined.append(pet)
+    return joined
 
 def test_retrieve_pets():
     print("test retrieve_pets")
@@ -32,6 +66,27 @@ def test_retrieve_pets():
     pets[0]['id'] = '1'
     assert pets[0] == {'id': '1', 'name': 'Suzy', 'age': 3, 'owner': 'Greg', 'kind_name': 'Dog', 'food': 'Dog food', 'noise': 'Bark'}
 
+def test_join_pets():
+    print("test join_pets")
+    import mongomock
+    from mongita import MongitaClientMemory
+    joined = []
+    # The $lookup pipeline on mongomock, the in-memory join on Mongita
+    for test_client in [mongomock.MongoClient(), MongitaClientMemory()]:
+        create_sample_database(test_client)
+        test_db = test_client.pets_db
+        dog = test_db.kind_collection.find_one({"kind_name":"Dog"})
+        test_db.pet_collection.insert_one({"name":"Rex", "age":5, "kind_id":dog["_id"], "owner":"Ann", "chip":"123"})
+        test_db.pet_collection.insert_one({"name":"Ghost", "age":1, "kind_id":ObjectId(), "owner":"Ann"})
+        pets = join_pets(test_db)
+        for pet in pets:
+            assert type(pet["id"]) is str
+            del pet["id"]
+        joined.append(sorted(pets, key=lambda pet: pet["name"]))
+    assert joined[0] == joined[1]
+    assert [pet["name"] for pet in joined[0]] == ['Dorothy', 'Heidi', 'Rex', 'Sandy', 'Suzy']
+    assert joined[0][2] == {'name': 'Rex', 'age': 5, 'owner': 'Ann', 'chip': '123', 'kind_name': 'Dog', 'food': 'Dog food', 'noise': 'Bark'}
+
 def retrieve_pet(id):
     pet_collection = pets_db.pet_collection
     id = ObjectId(id)
@@ -208,7 +263,7 @@ def test_update_kind():
     assert kind == kind_save
 
 
-def create_sample_database():
+def create_sample_database(client=client):
     pets_db = client.pets_db
     pets_db.drop_collection("kind_collection")
     kind_collection = pets_db.kind_collection
@@ -250,6 +305,7 @@ def create_sample_database():
 if __name__ == "__main__":
     create_sample_database()
     test_retrieve_pets()
+    test_join_pets()
     test_retrieve_pet()
     test_create_and_delete_pet()
     test_update_pet()
@@ -0,0 +1,315 @@
+# Multi-resolution county boundaries. Each boundary gets Douglas-Peucker
+# simplified copies of its geometry and a bbox, stored on the feature next
+# to the full geometry:
+#
+#     python boundaries.py Cuyahoga_County_Boundary.geojson Franklin_County_Boundary.geojson --output-dir multires
+#     python geojson_loader.py boundaries multires/*.geojson --drop
+#
+# Containment is then tested in two phases, the bbox and the simplified
+# geometry first, the full geometry only for points close to the edge. With
+# MongoDB that means the full geometry stays on the server unless a city is
+# near the county line, see cities_within_county.
+#
+# assign_counties joins every city to every county in one go instead, with
+# one query per collection, and can write the county names onto the cities:
+#
+#     python boundaries.py --assign-counties
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from geojson_loader import BATCH_SIZE, atlas_uri, batched, iter_features, open_client
+from spatial import MultiResolutionPolygon, SpatialIndex
+
+# Simplification tolerances in degrees, coarsest first. 0.01 degrees of
+# latitude is about 0.7 miles, 0.001 about 370 feet
+TOLERANCES = (0.01, 0.001)
+
+
+def _segment_distances(points, start, end):
+    # Distance from each point to the segment from start to end
+    direction = end - start
+    length = direction @ direction
+    if length == 0:
+        return np.hypot(*(points - start).T)
+    t = np.clip((points - start) @ direction / length, 0.0, 1.0)
+    return np.hypot(*(points - start - t[:, None] * direction).T)
+
+
+def douglas_peucker(points, tolerance):
+    """Indices of the points Douglas-Peucker keeps from an open polyline
+
+    Every dropped point is within tolerance of the segment that replaces it.
+    """
+    points = np.asarray(points, dtype=float)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = _segment_distances(points[first + 1:last], points[first], points[last])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return np.flatnonzero(keep)
+
+
+def simplify_ring(ring, tolerance):
+    """A closed ring with fewer points
+
+    A ring no wider than about the tolerance collapses to the segment from
+    its start to its farthest point and back. That encloses nothing but
+    keeps the ring's edges within tolerance, so points near it still go on
+    to the finer levels.
+    """
+    points = np.asarray(ring, dtype=float)[:, :2]
+    # A closed ring starts and ends on the same point, so split it at the
+    # point farthest from the start and simplify the two halves
+    split = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    if split == 0:
+        return points[[0, 0, 0, 0]].tolist()
+    first = douglas_peucker(points[:split + 1], tolerance)
+    second = douglas_peucker(points[split:], tolerance) + split
+    kept = np.concatenate([first, second[1:]])
+    if len(kept) < 4:
+        kept = [0, split, split, len(points) - 1]
+    return points[kept].tolist()
+
+
+def simplify_geometry(geometry, tolerance):
+    if geometry["type"] == "Polygon":
+        coordinates = [simplify_ring(ring, tolerance) for ring in geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        coordinates = [[simplify_ring(ring, tolerance) for ring in polygon] for polygon in geometry["coordinates"]]
+    else:
+        raise ValueError(f"Not a polygon: {geometry['type']}")
+    return {"type": geometry["type"], "coordinates": coordinates}
+
+
+def geometry_bbox(geometry):
+    rings = geometry["coordinates"] if geometry["type"] == "Polygon" else [
+        ring for polygon in geometry["coordinates"] for ring in polygon
+    ]
+    points = np.concatenate([np.asarray(ring, dtype=float)[:, :2] for ring in rings])
+    return [*points.min(axis=0).tolist(), *points.max(axis=0).tolist()]
+
+
+def add_resolutions(feature, tolerances=TOLERANCES):
+    """Add bbox and resolutions, the simplified geometries coarsest first"""
+    geometry = feature["geometry"]
+    feature["bbox"] = geometry_bbox(geometry)
+    feature["resolutions"] = [
+        {"tolerance": tolerance, "geometry": simplify_geometry(geometry, tolerance)}
+        for tolerance in sorted(tolerances, reverse=True)
+    ]
+    return feature
+
+
+def cities_within_county(cities_collection, boundaries_collection, county_name):
+    """City documents inside a county, without shipping its full geometry
+
+    Fetches the boundary's bbox and simplified geometries, the cities in the
+    bbox with a plain range query, and the full geometry only if a city is
+    close to the county line. Needs projections, so MongoDB or mongomock.
+    """
+    boundary = boundaries_collection.find_one({"properties.name": county_name}, {"geometry": 0})
+    if boundary is None:
+        return None
+    if "resolutions" not in boundary:
+        raise ValueError(f"{county_name} has no simplified boundary, load it through boundaries.py")
+
+    minx, miny, maxx, maxy = boundary["bbox"]
+    cities = list(cities_collection.find({
+        "geometry.coordinates.0": {"$gte": minx, "$lte": maxx},
+        "geometry.coordinates.1": {"$gte": miny, "$lte": maxy},
+    }))
+    if not cities:
+        return []
+
+    def full_geometry():
+        return boundaries_collection.find_one({"_id": boundary["_id"]}, {"geometry": 1})["geometry"]
+
+    polygon = MultiResolutionPolygon.from_feature(dict(boundary, geometry=full_geometry))
+    coordinates = np.array([city["geometry"]["coordinates"][:2] for city in cities], dtype=float)
+    inside = polygon.contains(coordinates[:, 0], coordinates[:, 1])
+    return [city for city, keep in zip(cities, inside.tolist()) if keep]
+
+
+def assign_counties(cities_collection, boundaries_collection, field=None, batch_size=BATCH_SIZE):
+    """Join every city to the counties that contain it, returns the table
+
+    Reads each collection once and joins them locally through
+    SpatialIndex.join, rather than a find_one and a $geoWithin query per
+    county. Rows are {"city", "boundary"} as in SpatialIndex.join_table. If
+    field is given, each city document gets the list of its county names
+    set there, with one update_many per distinct list of up to batch_size
+    cities, so about one write per county rather than per city.
+    """
+    cities = list(cities_collection.find({}, {"geometry": 1, "properties": 1}))
+    index = SpatialIndex(cities, boundaries_collection.find({}))
+    if field is not None:
+        names = [[] for _ in cities]
+        for city_number, boundary_number in zip(*(numbers.tolist() for numbers in index.join())):
+            names[city_number].append(index.boundaries[boundary_number]["properties"]["name"])
+        groups = {}
+        for city, counties in zip(cities, names):
+            groups.setdefault(tuple(counties), []).append(city["_id"])
+        for counties, ids in groups.items():
+            for batch in batched(ids, batch_size):
+                cities_collection.update_many({"_id": {"$in": batch}}, {"$set": {field: list(counties)}})
+    return index.join_table()
+
+
+def _size(value):
+    return len(json.dumps(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add simplified geometries and a bbox to boundary features")
+    parser.add_argument("paths", nargs="*", help="boundary FeatureCollections")
+    parser.add_argument("--output-dir")
+    parser.add_argument("--tolerance", type=float, action="append",
+                        help=f"degrees, repeat for more levels (default {' '.join(map(str, TOLERANCES))})")
+    parser.add_argument("--assign-counties", action="store_true",
+                        help="join the loaded cities to the loaded boundaries instead")
+    parser.add_argument("--field", default="counties", help="city field the county names are written to")
+    parser.add_argument("--uri", help="default MONGO_ATLAS_URI from private.json")
+    parser.add_argument("--database", default="ohio_db")
+    args = parser.parse_args()
+
+    if args.assign_counties:
+        database = open_client(args.uri or atlas_uri())[args.database]
+        for row in assign_counties(database.cities, database.boundaries, args.field):
+            print(f"{row['city']}\t{row['boundary'] or ''}")
+        return
+    if not args.paths or not args.output_dir:
+        parser.error("paths and --output-dir are needed unless --assign-counties")
+    os.makedirs(args.output_dir, exist_ok=True)
+    for path in args.paths:
+        features = [add_resolutions(feature, args.tolerance or TOLERANCES) for feature in iter_features(path)]
+        with open(os.path.join(args.output_dir, os.path.basename(path)), "w") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+        for feature in features:
+            sizes = ", ".join(
+                f"{level['tolerance']}: {_size(level['geometry'])} bytes" for level in feature["resolutions"]
+            )
+            print(f"{feature['properties'].get('name')}: full {_size(feature['geometry'])} bytes, {sizes}",
+                  file=sys.stderr)
+
+
+def _county(path):
+    return next(iter_features(path))
+
+
+def test_douglas_peucker():
+    print("test douglas_peucker")
+    line = [[0, 0], [1, 0.05], [2, -0.05], [3, 0], [4, 5], [5, 0]]
+    assert list(douglas_peucker(line, 0.1)) == [0, 3, 4, 5]
+    assert list(douglas_peucker(line, 10)) == [0, 5]
+
+    # Every dropped point stays within tolerance of the simplified ring
+    ring = _county("Franklin_County_Boundary.geojson")["geometry"]["coordinates"][0]
+    for tolerance in TOLERANCES:
+        simplified = np.array(simplify_ring(ring, tolerance))
+        assert simplified[0].tolist() == simplified[-1].tolist()
+        assert 4 <= len(simplified) < len(ring)
+        for point in np.asarray(ring):
+            nearest = min(
+                _segment_distances(point[None, :], start, end)[0] for start, end in zip(simplified, simplified[1:])
+            )
+            assert nearest <= tolerance * (1 + 1e-9)
+
+    tiny = [[0, 0], [1e-4, 0], [1e-4, 1e-4], [0, 0]]
+    assert simplify_ring(tiny, 0.01) == [[0, 0], [1e-4, 1e-4], [1e-4, 1e-4], [0, 0]]
+
+
+def test_two_phase_contains():
+    print("test two_phase_contains")
+    from spatial import Polygon
+    for path in ["Franklin_County_Boundary.geojson", "Cuyahoga_County_Boundary.geojson"]:
+        feature = add_resolutions(_county(path))
+        full = Polygon(feature["geometry"])
+        fetches = []
+        geometry = feature["geometry"]
+        polygon = MultiResolutionPolygon.from_feature(dict(feature, geometry=lambda: fetches.append(1) or geometry))
+
+        minx, miny, maxx, maxy = feature["bbox"]
+        rng = np.random.default_rng(4)
+        x, y = rng.uniform(minx - 0.1, maxx + 0.1, 20000), rng.uniform(miny - 0.1, maxy + 0.1, 20000)
+        assert (polygon.contains(x, y) == full.contains(x, y)).all()
+        assert fetches == [1]
+        assert 0 < polygon.full_tests < 20000 // 10
+
+        # Close around the small rings, which the coarse levels flatten
+        for ring in geometry["coordinates"][1:]:
+            ring = np.asarray(ring)
+            (rminx, rminy), (rmaxx, rmaxy) = ring.min(axis=0), ring.max(axis=0)
+            x, y = rng.uniform(rminx - 1e-4, rmaxx + 1e-4, 200), rng.uniform(rminy - 1e-4, rmaxy + 1e-4, 200)
+            assert (polygon.contains(x, y) == full.contains(x, y)).all()
+
+        # Points well inside never need the full geometry
+        polygon = MultiResolutionPolygon.from_feature(dict(feature, geometry=lambda: fetches.append(1) or geometry))
+        center = [(minx + maxx) / 2], [(miny + maxy) / 2]
+        polygon.contains(*center)
+        assert polygon.full_tests == 0 and fetches == [1]
+
+
+def test_cities_within_county():
+    print("test cities_within_county")
+    import mongomock
+    from geojson_loader import load_files
+    from spatial import SpatialIndex
+
+    database = mongomock.MongoClient().ohio_db
+    load_files(database.cities, ["ohio-100-largest-cities.geojson"])
+    paths = ["Franklin_County_Boundary.geojson", "Cuyahoga_County_Boundary.geojson"]
+    database.boundaries.insert_many([add_resolutions(feature) for path in paths for feature in iter_features(path)])
+
+    index = SpatialIndex.from_files("ohio-100-largest-cities.geojson", *paths)
+    for county in ["Franklin County", "Cuyahoga County"]:
+        cities = cities_within_county(database.cities, database.boundaries, county)
+        assert [city["properties"]["City"] for city in cities] == index.cities_within(county)
+    assert cities_within_county(database.cities, database.boundaries, "Nowhere County") is None
+
+
+def test_assign_counties():
+    print("test assign_counties")
+    import mongomock
+    from geojson_loader import load_files
+
+    database = mongomock.MongoClient().ohio_db
+    load_files(database.cities, ["ohio-100-largest-cities.geojson"])
+    paths = ["Franklin_County_Boundary.geojson", "Cuyahoga_County_Boundary.geojson"]
+    features = [feature for path in paths for feature in iter_features(path)]
+    database.boundaries.insert_many([add_resolutions(features[0]), features[1]])
+
+    # Boundaries with and without simplified levels join alike
+    index = SpatialIndex.from_files("ohio-100-largest-cities.geojson", *paths)
+    assert assign_counties(database.cities, database.boundaries) == index.join_table()
+    assert database.cities.count_documents({"counties": {"$exists": True}}) == 0
+
+    assign_counties(database.cities, database.boundaries, "counties", batch_size=7)
+    assert database.cities.count_documents({"counties": {"$exists": True}}) == 20
+    for county in ["Franklin County", "Cuyahoga County"]:
+        cities = database.cities.find({"counties": county})
+        assert [city["properties"]["City"] for city in cities] == index.cities_within(county)
+    assert database.cities.find_one({"properties.City": "Cincinnati"})["counties"] == []
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test_douglas_peucker()
+        test_two_phase_contains()
+        test_cities_within_county()
+        test_assign_counties()
+        print("done.")
@@ -0,0 +1,262 @@
+# Convert city CSV files to GeoJSON in one pass, without the intermediate
+# JSON file prepare_city_data.ipynb writes:
+#
+#     python csv_to_geojson.py ohio-100-largest-cities.csv
+#     python csv_to_geojson.py places/*.csv --format ndjson --output-dir out --workers 8
+#
+# Rows are read a chunk at a time and each column of a chunk is parsed as a
+# whole with numpy, "$66,990" money columns included. Features are written
+# as they are made, so the size of the input doesn't matter, and several
+# input files are converted side by side in a process pool.
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from geojson_loader import batched
+
+# Rows parsed at a time
+CHUNK_ROWS = 10_000
+
+# Features encoded to JSON at a time
+ENCODE_BATCH = 1000
+
+LONGITUDE = "Longitude"
+LATITUDE = "Latitude"
+
+# Columns parsed into numbers, every other column stays text
+MONEY_COLUMNS = ("Median Household Income", "Average Home Price")
+INTEGER_COLUMNS = ("Population",)
+
+FORMATS = {".geojson": "geojson", ".json": "geojson", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+
+def _to_numbers(text, dtype):
+    # Blank cells come out as None, everything else as a Python number
+    text = np.strings.strip(text)
+    blank = text == ""
+    numbers = np.where(blank, "0", text).astype(dtype).tolist()
+    if blank.any():
+        for i in np.flatnonzero(blank).tolist():
+            numbers[i] = None
+    return numbers
+
+
+def parse_money(values):
+    """Floats from strings like "$66,990", for a whole column at once"""
+    text = np.asarray(values, dtype=str)
+    text = np.strings.replace(np.strings.replace(text, "$", ""), ",", "")
+    return _to_numbers(text, float)
+
+
+def parse_integers(values):
+    return _to_numbers(np.asarray(values, dtype=str), np.int64)
+
+
+def iter_chunks(path, chunk_rows=CHUNK_ROWS):
+    """Yield the header, then lists of up to chunk_rows rows
+
+    Blank lines are skipped, like csv.DictReader does. A row with more or
+    fewer fields than the header is a ValueError, a chunk is parsed column
+    by column and can't line its fields up with the header otherwise.
+    """
+    with open(path, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        yield header
+        chunk = []
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != len(header):
+                raise ValueError(f"{path} line {reader.line_num}: {len(row)} fields, the header has {len(header)}")
+            chunk.append(row)
+            if len(chunk) == chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def chunk_features(header, rows, money_columns=MONEY_COLUMNS, integer_columns=INTEGER_COLUMNS):
+    """GeoJSON Point features for one chunk of CSV rows"""
+    # zip would cut every column to the shortest row
+    if any(len(row) != len(header) for row in rows):
+        raise ValueError(f"Every row needs the header's {len(header)} fields")
+    columns = dict(zip(header, (list(column) for column in zip(*rows))))
+    longitudes = np.asarray(columns.pop(LONGITUDE), dtype=float).tolist()
+    latitudes = np.asarray(columns.pop(LATITUDE), dtype=float).tolist()
+    for name in columns:
+        if name in money_columns:
+            columns[name] = parse_money(columns[name])
+        elif name in integer_columns:
+            columns[name] = parse_integers(columns[name])
+
+    names = list(columns)
+    return [
+        {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+            "properties": dict(zip(names, values)),
+        }
+        for longitude, latitude, *values in zip(longitudes, latitudes, *columns.values())
+    ]
+
+
+def iter_features(path, chunk_rows=CHUNK_ROWS, **columns):
+    chunks = iter_chunks(path, chunk_rows)
+    header = next(chunks)
+    for rows in chunks:
+        yield from chunk_features(header, rows, **columns)
+
+
+def write_features(features, f, fmt="geojson"):
+    """Write features as they come, returns how many were written"""
+    # One encode call per batch rather than per feature, the encoder's own
+    # overhead is most of the cost of a small feature
+    encoder = json.JSONEncoder(check_circular=False)
+    count = 0
+    if fmt != "ndjson":
+        f.write('{"type": "FeatureCollection", "features": [')
+    for batch in batched(features, ENCODE_BATCH):
+        if fmt == "ndjson":
+            f.write("".join([encoder.encode(feature) + "\n" for feature in batch]))
+        else:
+            f.write(("," if count else "") + "\n" + encoder.encode(batch)[1:-1])
+        count += len(batch)
+    if fmt != "ndjson":
+        f.write("\n]}\n")
+    return count
+
+
+def output_format(path):
+    return FORMATS.get(os.path.splitext(path)[1].lower(), "geojson")
+
+
+def convert_file(path, output, chunk_rows=CHUNK_ROWS, **columns):
+    """Convert one CSV file, the format follows output's extension"""
+    with open(output, "w") as f:
+        return write_features(iter_features(path, chunk_rows, **columns), f, output_format(output))
+
+
+def _convert(job):
+    path, output, chunk_rows = job
+    return convert_file(path, output, chunk_rows)
+
+
+def convert_files(paths, output_dir=None, fmt="geojson", workers=None, chunk_rows=CHUNK_ROWS):
+    """Convert each CSV file to a file of the same name in output_dir, one
+    process per file, returns {output: features written}"""
+    extension = ".ndjson" if fmt == "ndjson" else ".geojson"
+    jobs = []
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        jobs.append((path, os.path.join(output_dir or os.path.dirname(path), stem + extension), chunk_rows))
+
+    if workers == 1 or len(jobs) == 1:
+        counts = map(_convert, jobs)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            counts = list(executor.map(_convert, jobs))
+    return dict(zip((output for _, output, _ in jobs), counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert city CSV files to GeoJSON")
+    parser.add_argument("paths", nargs="+", help="CSV files with Latitude and Longitude columns")
+    parser.add_argument("--format", choices=["geojson", "ndjson"], default="geojson")
+    parser.add_argument("--output-dir", help="default next to each input")
+    parser.add_argument("--workers", type=int, help="processes (default one per core)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    started = time.perf_counter()
+    counts = convert_files(args.paths, args.output_dir, args.format, args.workers, args.chunk_rows)
+    for output, count in counts.items():
+        print(f"{count} features written to {output}", file=sys.stderr)
+    print(f"{sum(counts.values())} features in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+def test_parse_money():
+    print("test parse_money")
+    assert parse_money(["$66,990", "$1,234.50", " $0 ", ""]) == [66990.0, 1234.5, 0.0, None]
+    assert parse_integers(["913175", "", "7"]) == [913175, None, 7]
+
+
+def test_convert_file():
+    print("test convert_file")
+    import tempfile
+    directory = tempfile.mkdtemp()
+    with open("ohio-100-largest-cities.geojson", "r") as f:
+        expected = json.load(f)
+
+    output = os.path.join(directory, "cities.geojson")
+    assert convert_file("ohio-100-largest-cities.csv", output, chunk_rows=3) == 20
+    with open(output, "r") as f:
+        assert json.load(f) == expected
+
+    output = os.path.join(directory, "cities.ndjson")
+    assert convert_file("ohio-100-largest-cities.csv", output) == 20
+    with open(output, "r") as f:
+        assert [json.loads(line) for line in f] == expected["features"]
+
+
+def test_ragged_rows():
+    print("test ragged_rows")
+    import tempfile
+    header = ["City", "Longitude", "Latitude", "Population", "Extra"]
+    try:
+        chunk_features(header, [["A", "1", "1", "2", "x"], ["B", "2", "1", "2"]])
+    except ValueError:
+        pass
+    else:
+        assert False, "a short row should not cut the Extra column"
+
+    path = _write_csv(tempfile.mkdtemp(), "A,1,1,2,x\r\n\r\nB,2,1,2,y\r\nC,3,1,2\r\n", header)
+    try:
+        list(iter_features(path))
+    except ValueError as e:
+        assert f"{path} line 5" in str(e), e
+    else:
+        assert False, "expected a ValueError"
+
+    # Blank lines are skipped, not short rows
+    path = _write_csv(tempfile.mkdtemp(), "A,1,1,2,x\r\n\r\nB,2,1,2,y\r\n", header)
+    assert [feature["properties"]["Extra"] for feature in iter_features(path)] == ["x", "y"]
+
+
+def _write_csv(directory, rows, header):
+    path = os.path.join(directory, "cities.csv")
+    with open(path, "w", newline="") as f:
+        f.write(",".join(header) + "\r\n" + rows)
+    return path
+
+
+def test_convert_files():
+    print("test convert_files")
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    paths = []
+    for name in ("a", "b", "c"):
+        paths.append(shutil.copy("ohio-100-largest-cities.csv", os.path.join(directory, f"{name}.csv")))
+    counts = convert_files(paths, fmt="ndjson", workers=2, chunk_rows=7)
+    assert counts == {os.path.join(directory, f"{name}.ndjson"): 20 for name in ("a", "b", "c")}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test_parse_money()
+        test_convert_file()
+        test_ragged_rows()
+        test_convert_files()
+        print("done.")
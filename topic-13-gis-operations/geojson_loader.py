@@ -0,0 +1,323 @@
+# Bulk load GeoJSON into MongoDB, the job the load_*_to_mongo notebooks do
+# with one insert_one round trip per feature:
+#
+#     python geojson_loader.py boundaries Franklin_County_Boundary.geojson Cuyahoga_County_Boundary.geojson --drop
+#     python geojson_loader.py cities ohio-100-largest-cities.geojson --drop
+#     python geojson_loader.py cities cities.ndjson --uri mongomock://
+#
+# Files are parsed one feature at a time, so a statewide parcel file is never
+# in memory all at once, and features go to the server in unordered
+# insert_many batches. Indexes are built once the data is in. The URI
+# defaults to MONGO_ATLAS_URI in private.json, like the notebooks;
+# mongita:DIR loads a local Mongita store and mongomock:// an in-memory one.
+import argparse
+import json
+import os
+import sys
+import time
+
+# Features per insert_many call
+BATCH_SIZE = 1000
+
+# Characters read from a file at a time
+CHUNK_SIZE = 1 << 16
+
+# Files with one feature per line rather than a FeatureCollection
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl", ".geojsonl")
+
+
+class _Reader:
+    """A text file read in chunks, with JSON values decoded off the front"""
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        # Drop what has been consumed, then read at least one more chunk
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        chunk = self.file.read(max(self.chunk_size, len(self.buffer)))
+        self.eof = not chunk
+        self.buffer += chunk
+        return not self.eof
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of GeoJSON")
+
+    def expect(self, *characters):
+        character = self.peek()
+        if character not in characters:
+            raise ValueError(f"Expected {' or '.join(characters)} in GeoJSON, found {character!r}")
+        self.pos += 1
+        return character
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_features(path, chunk_size=CHUNK_SIZE):
+    """Yield the features of a FeatureCollection or NDJSON file one at a time"""
+    with open(path, "r") as f:
+        if path.endswith(NDJSON_EXTENSIONS):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        reader = _Reader(f, chunk_size)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            key = reader.decode()
+            reader.expect(":")
+            if key == "features":
+                reader.expect("[")
+                if reader.peek() == "]":
+                    reader.pos += 1
+                else:
+                    while True:
+                        yield reader.decode()
+                        if reader.expect(",", "]") == "]":
+                            break
+            elif key == "type":
+                kind = reader.decode()
+                if kind != "FeatureCollection":
+                    raise ValueError(f"{path} is a {kind}, not a FeatureCollection")
+            else:
+                reader.decode()
+            if reader.expect(",", "}") == "}":
+                return
+
+
+def check_boundary(feature):
+    """The checks read_county_data_file made in load_county_data_to_mongo"""
+    if not isinstance(feature["properties"]["name"], str):
+        raise ValueError("Boundary has no name")
+    if feature["geometry"]["type"] not in ("Polygon", "MultiPolygon"):
+        raise ValueError(f"Boundary {feature['properties']['name']} is a {feature['geometry']['type']}")
+    if not isinstance(feature["geometry"]["coordinates"], list):
+        raise ValueError(f"Boundary {feature['properties']['name']} has no coordinates")
+
+
+def check_city(feature):
+    if feature["geometry"]["type"] != "Point":
+        raise ValueError(f"City {feature['properties'].get('City')} is not a Point")
+
+
+# What each kind of file is loaded into: collection, check, indexes to build
+DATASETS = {
+    "cities": ("cities", check_city, [[("geometry", "2dsphere")]]),
+    "boundaries": ("boundaries", check_boundary, [[("geometry", "2dsphere")], [("properties.name", 1)]]),
+}
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_features(collection, features, batch_size=BATCH_SIZE, check=None):
+    """Insert features with unordered insert_many calls, returns the count
+
+    Unordered batches let the server keep going past a bad document and
+    report them all at the end instead of stopping at the first.
+    """
+    count = 0
+    for batch in batched(features, batch_size):
+        if check is not None:
+            for feature in batch:
+                check(feature)
+        collection.insert_many(batch, ordered=False)
+        count += len(batch)
+    return count
+
+
+def _is_mongita(collection):
+    return type(collection).__module__.startswith("mongita")
+
+
+def create_indexes(collection, indexes):
+    """Build indexes once the data is loaded, returns the names built
+
+    Mongita has no geospatial indexes, so 2dsphere ones are left out there.
+    """
+    names = []
+    for keys in indexes:
+        if _is_mongita(collection) and any(direction == "2dsphere" for _, direction in keys):
+            continue
+        names.append(collection.create_index(keys))
+    return names
+
+
+def load_files(collection, paths, batch_size=BATCH_SIZE, check=None, indexes=(), chunk_size=CHUNK_SIZE):
+    """Load every feature in paths into collection, then build its indexes"""
+    count = 0
+    for path in paths:
+        count += insert_features(collection, iter_features(path, chunk_size), batch_size, check)
+    create_indexes(collection, indexes)
+    return count
+
+
+def atlas_uri(path="private.json"):
+    with open(path, "r") as f:
+        return json.load(f)["MONGO_ATLAS_URI"]
+
+
+def open_client(uri):
+    """A client for mongodb URIs, a Mongita store for mongita:DIR, or an
+    in-memory stand-in for mongomock://"""
+    if uri.startswith("mongomock://"):
+        import mongomock
+        return mongomock.MongoClient()
+    if uri.startswith("mongita:"):
+        from mongita import MongitaClientDisk
+        return MongitaClientDisk(uri[len("mongita:"):] or None)
+    from pymongo.mongo_client import MongoClient
+    from pymongo.server_api import ServerApi
+    return MongoClient(uri, server_api=ServerApi("1"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load GeoJSON features into MongoDB")
+    parser.add_argument("dataset", choices=sorted(DATASETS))
+    parser.add_argument("paths", nargs="+", help="FeatureCollection or NDJSON files")
+    parser.add_argument("--uri", help="default MONGO_ATLAS_URI from private.json")
+    parser.add_argument("--database", default="ohio_db")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--drop", action="store_true", help="drop the collection first")
+    args = parser.parse_args()
+
+    name, check, indexes = DATASETS[args.dataset]
+    database = open_client(args.uri or atlas_uri())[args.database]
+    if args.drop:
+        database.drop_collection(name)
+
+    started = time.perf_counter()
+    count = load_files(database[name], args.paths, args.batch_size, check, indexes)
+    print(f"{count} features loaded into '{name}' in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+def _write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+def test_iter_features():
+    print("test iter_features")
+    import tempfile
+    directory = tempfile.mkdtemp()
+    features = [
+        {"type": "Feature", "properties": {"name": 'a "quoted" ] }, name', "n": 1234567890123},
+         "geometry": {"type": "Point", "coordinates": [-82.9988, 39.9612]}},
+        {"type": "Feature", "properties": {}, "geometry": {"type": "Point", "coordinates": [1e-7, -12345.678]}},
+    ] * 20
+    collection = {"bbox": [1, 2, 3, 4], "features": features, "type": "FeatureCollection", "crs": {"n": 10}}
+    for indent in (None, 4):
+        path = _write(os.path.join(directory, "features.geojson"), json.dumps(collection, indent=indent))
+        for chunk_size in (1, 7, 4096):
+            assert list(iter_features(path, chunk_size)) == features
+
+    path = _write(os.path.join(directory, "empty.geojson"), '{"type": "FeatureCollection", "features": [ ]}')
+    assert list(iter_features(path, 3)) == []
+    path = _write(os.path.join(directory, "features.ndjson"), "".join(json.dumps(f) + "\n" for f in features))
+    assert list(iter_features(path)) == features
+
+    real = "Cuyahoga_County_Boundary.geojson"
+    with open(real, "r") as f:
+        assert list(iter_features(real, 1000)) == json.load(f)["features"]
+
+    path = _write(os.path.join(directory, "point.geojson"), '{"type": "Point", "coordinates": [0, 0]}')
+    try:
+        list(iter_features(path))
+    except ValueError:
+        pass
+    else:
+        assert False, "expected a ValueError"
+
+
+class _CountingCollection:
+    def __init__(self, collection):
+        self.collection = collection
+        self.calls = []
+
+    def insert_many(self, documents, ordered=True):
+        self.calls.append((len(documents), ordered))
+        return self.collection.insert_many(documents, ordered=ordered)
+
+    def create_index(self, keys):
+        return self.collection.create_index(keys)
+
+
+def test_load_files():
+    print("test load_files")
+    import mongomock
+    database = mongomock.MongoClient().ohio_db
+    name, check, indexes = DATASETS["cities"]
+    cities = _CountingCollection(database[name])
+    assert load_files(cities, ["ohio-100-largest-cities.geojson"], 8, check, indexes) == 20
+    assert cities.calls == [(8, False), (8, False), (4, False)]
+    assert database.cities.count_documents({}) == 20
+    assert "geometry_2dsphere" in database.cities.index_information()
+
+    name, check, indexes = DATASETS["boundaries"]
+    paths = ["Franklin_County_Boundary.geojson", "Cuyahoga_County_Boundary.geojson"]
+    assert load_files(database[name], paths, check=check, indexes=indexes) == 2
+    assert database.boundaries.find_one({"properties.name": "Cuyahoga County"})["geometry"]["type"] == "Polygon"
+    assert "properties.name_1" in database.boundaries.index_information()
+
+    try:
+        load_files(database.other, ["ohio-100-largest-cities.geojson"], check=check_boundary)
+    except (KeyError, ValueError):
+        pass
+    else:
+        assert False, "cities are not boundaries"
+
+
+def test_load_files_mongita():
+    print("test load_files mongita")
+    import tempfile
+    collection = open_client(f"mongita:{tempfile.mkdtemp()}").ohio_db.boundaries
+    name, check, indexes = DATASETS["boundaries"]
+    assert load_files(collection, ["Franklin_County_Boundary.geojson"], check=check, indexes=indexes) == 1
+    assert collection.find_one({"properties.name": "Franklin County"}) is not None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test_iter_features()
+        test_load_files()
+        test_load_files_mongita()
+        print("done.")
@@ -0,0 +1,562 @@
+# Offline answers to the questions the notebooks ask Atlas with $geoWithin
+# and a 2dsphere index. Loads the city points and county boundaries from the
+# GeoJSON files and keeps them in memory behind an STR-tree:
+#
+#     index = SpatialIndex.from_files("ohio-100-largest-cities.geojson",
+#                                     "Franklin_County_Boundary.geojson",
+#                                     "Cuyahoga_County_Boundary.geojson")
+#     index.cities_within("Cuyahoga County")
+#     index.nearest(-81.6944, 41.4993, k=5)
+#
+# Coordinates are [longitude, latitude] as in GeoJSON. Containment is tested
+# on the plane, which is what $geoWithin does for boundaries this size to
+# well within the precision of the data.
+import json
+import math
+
+import numpy as np
+
+# Earth's radius in miles, as the notebooks use for $centerSphere
+EARTH_RADIUS_MILES = 3963.2
+
+# Children per node of the STR-tree
+NODE_CAPACITY = 16
+
+# Simplified levels classify big batches of points with a grid of at most
+# this many cells, built the first time a batch has GRID_MIN_POINTS points
+MAX_GRID_CELLS = 1 << 16
+GRID_MIN_POINTS = 256
+
+OUTSIDE, INSIDE, NEAR_EDGE = 0, 1, 2
+
+# Polygons sort their edges into as many horizontal bands as they have
+# edges divided by this, a point is only tested against its own band's edges
+EDGES_PER_BAND = 1
+
+
+def read_features(path):
+    with open(path, "r") as f:
+        data = json.load(f)
+    assert data["type"] == "FeatureCollection"
+    return data["features"]
+
+
+def haversine_miles(x0, y0, x1, y1):
+    """Great circle distance in miles, any argument can be an array"""
+    x0, y0, x1, y1 = (np.radians(value) for value in (x0, y0, x1, y1))
+    a = np.sin((y1 - y0) / 2) ** 2 + np.cos(y0) * np.cos(y1) * np.sin((x1 - x0) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+
+def box_around(x, y, miles):
+    """A box that holds every point within miles of (x, y)"""
+    dlat = math.degrees(miles / EARTH_RADIUS_MILES)
+    widest = min(abs(y) + dlat, 89.9)
+    dlon = min(dlat / math.cos(math.radians(widest)), 180.0)
+    return x - dlon, y - dlat, x + dlon, y + dlat
+
+
+class STRtree:
+    """Packed R-tree over boxes, built once with Sort-Tile-Recursive
+
+    boxes is an (n, 4) array of minx, miny, maxx, maxy, a point is a box with
+    no area. Node i of a level covers nodes i * NODE_CAPACITY onwards of the
+    level below, so queries walk the levels with array operations only.
+    """
+
+    def __init__(self, boxes, capacity=NODE_CAPACITY):
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        self.capacity = capacity
+        self.order = self._sort_tile(boxes)
+        level = boxes[self.order]
+        self.levels = [level]
+        while len(level) > 1:
+            level = self._parents(level)
+            self.levels.append(level)
+        self.levels.reverse()  # root first
+
+    def _sort_tile(self, boxes):
+        # Slice the boxes into vertical strips by x center, then sort each
+        # strip by y center so every run of capacity boxes is a compact tile
+        count = len(boxes)
+        if count == 0:
+            return np.zeros(0, dtype=np.intp)
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        leaves = math.ceil(count / self.capacity)
+        strip_size = math.ceil(math.sqrt(leaves)) * self.capacity
+        by_x = np.argsort(centers[:, 0], kind="stable")
+        strips = [by_x[start:start + strip_size] for start in range(0, count, strip_size)]
+        return np.concatenate([strip[np.argsort(centers[strip, 1], kind="stable")] for strip in strips])
+
+    def _parents(self, level):
+        padding = -len(level) % self.capacity
+        groups = np.concatenate([level, np.repeat(level[-1:], padding, axis=0)])
+        groups = groups.reshape(-1, self.capacity, 4)
+        return np.column_stack([
+            groups[:, :, 0].min(axis=1), groups[:, :, 1].min(axis=1),
+            groups[:, :, 2].max(axis=1), groups[:, :, 3].max(axis=1),
+        ])
+
+    def __len__(self):
+        return len(self.order)
+
+    def query(self, minx, miny, maxx, maxy):
+        """Indices of the boxes that touch the query box, in input order"""
+        if len(self.order) == 0:
+            return np.zeros(0, dtype=np.intp)
+        nodes = np.zeros(1, dtype=np.intp)
+        for depth, level in enumerate(self.levels):
+            boxes = level[nodes]
+            hits = (boxes[:, 0] <= maxx) & (boxes[:, 2] >= minx) & (boxes[:, 1] <= maxy) & (boxes[:, 3] >= miny)
+            nodes = nodes[hits]
+            if depth + 1 < len(self.levels):
+                nodes = (nodes[:, None] * self.capacity + np.arange(self.capacity)).ravel()
+                nodes = nodes[nodes < len(self.levels[depth + 1])]
+        return np.sort(self.order[nodes])
+
+
+class Polygon:
+    """A GeoJSON Polygon or MultiPolygon ready for point in polygon tests
+
+    Holes and separate parts both fall out of the even-odd rule, so every
+    ring is kept as one flat list of edges.
+    """
+
+    def __init__(self, geometry, min_band_height=0.0):
+        if geometry["type"] == "Polygon":
+            rings = geometry["coordinates"]
+        elif geometry["type"] == "MultiPolygon":
+            rings = [ring for polygon in geometry["coordinates"] for ring in polygon]
+        else:
+            raise ValueError(f"Not a polygon: {geometry['type']}")
+
+        starts, ends = [], []
+        for ring in rings:
+            ring = np.asarray(ring, dtype=float)[:, :2]
+            starts.append(ring[:-1])
+            ends.append(ring[1:])
+        starts, ends = np.concatenate(starts), np.concatenate(ends)
+        self.x0, self.y0 = starts[:, 0], starts[:, 1]
+        self.x1, self.y1 = ends[:, 0], ends[:, 1]
+        self.bbox = (
+            float(starts[:, 0].min()), float(starts[:, 1].min()),
+            float(starts[:, 0].max()), float(starts[:, 1].max()),
+        )
+        self._build_bands(min_band_height)
+
+    def _build_bands(self, min_band_height):
+        edges = len(self.x0)
+        height = self.bbox[3] - self.bbox[1]
+        bands = max(1, edges // EDGES_PER_BAND)
+        if min_band_height > 0:
+            bands = max(1, min(bands, int(height / min_band_height)))
+        self.bands = bands
+        self.band_height = height / bands or 1.0
+
+        first = self._band_of(np.minimum(self.y0, self.y1))
+        last = self._band_of(np.maximum(self.y0, self.y1))
+        spans = last - first + 1
+        edge = np.repeat(np.arange(edges), spans)
+        band = first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(spans) - spans, spans)
+
+        order = np.argsort(band, kind="stable")
+        self.band_edges = edge[order]
+        self.band_starts = np.searchsorted(band[order], np.arange(self.bands + 1))
+
+    def _band_of(self, y):
+        band = np.floor((y - self.bbox[1]) / self.band_height).astype(np.intp)
+        return np.clip(band, 0, self.bands - 1)
+
+    def _pairs(self, first_band, last_band):
+        # (point, edge) pairs of each point with every edge in its bands,
+        # bands are stored in order so a run of them is one slice
+        start = self.band_starts[first_band]
+        count = self.band_starts[last_band + 1] - start
+        point = np.repeat(np.arange(len(start)), count)
+        offset = np.arange(len(point)) - np.repeat(np.cumsum(count) - count, count)
+        return point, self.band_edges[np.repeat(start, count) + offset]
+
+    def contains(self, x, y):
+        """Boolean array, True for each point inside the polygon"""
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        minx, miny, maxx, maxy = self.bbox
+        inside = np.zeros(len(x), dtype=bool)
+        candidates = np.flatnonzero((x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+        if len(candidates) == 0:
+            return inside
+
+        # Pair every candidate with the edges of its band
+        px, py = x[candidates], y[candidates]
+        band = self._band_of(py)
+        point, edge = self._pairs(band, band)
+
+        # Count the edges a ray from each point towards +x crosses
+        x0, y0, x1, y1 = self.x0[edge], self.y0[edge], self.x1[edge], self.y1[edge]
+        py = py[point]
+        straddles = (y0 > py) != (y1 > py)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing_x = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+        crosses = straddles & (px[point] < crossing_x)
+        inside[candidates] = np.bincount(point[crosses], minlength=len(candidates)) % 2 == 1
+        return inside
+
+    def near_boundary(self, x, y, distance):
+        """Boolean array, True for each point within distance of an edge"""
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        minx, miny, maxx, maxy = self.bbox
+        near = np.zeros(len(x), dtype=bool)
+        candidates = np.flatnonzero(
+            (x >= minx - distance) & (x <= maxx + distance) & (y >= miny - distance) & (y <= maxy + distance)
+        )
+        if len(candidates) == 0:
+            return near
+
+        px, py = x[candidates], y[candidates]
+        point, edge = self._pairs(self._band_of(py - distance), self._band_of(py + distance))
+        x0, y0 = self.x0[edge], self.y0[edge]
+        dx, dy = self.x1[edge] - x0, self.y1[edge] - y0
+        px, py = px[point], py[point]
+        length = dx * dx + dy * dy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(length > 0, ((px - x0) * dx + (py - y0) * dy) / length, 0.0)
+        t = np.clip(t, 0.0, 1.0)
+        close = (px - x0 - t * dx) ** 2 + (py - y0 - t * dy) ** 2 <= distance * distance
+        near[candidates[point[close]]] = True
+        return near
+
+
+class MultiResolutionPolygon:
+    """A boundary tested against its simplified versions first
+
+    levels holds (tolerance, geometry) pairs, coarsest first, made by
+    boundaries.simplify_geometry. Every edge of the full boundary lies
+    within tolerance of the simplified one, so a point farther than that
+    from the simplified edges is on the same side of both. Only points near
+    the edges go on to the next level, and only the ones near the finest
+    level's edges are tested against the full geometry. full can be the
+    geometry or a function that fetches it, it is only called if needed.
+
+    Batches of GRID_MIN_POINTS or more are classified from a grid per level
+    instead, built on first use, whose cells are decided ahead of time
+    wherever the whole cell is that far from the simplified edges.
+    """
+
+    def __init__(self, bbox, levels, full):
+        self.bbox = tuple(bbox)
+        # Bands at least a tolerance high, so the edge test looks at 3 at most
+        self.levels = [(tolerance, Polygon(geometry, tolerance)) for tolerance, geometry in levels]
+        self._grids = {}
+        self._full = full
+        self.full_tests = 0  # points that needed the full geometry
+
+    @classmethod
+    def from_feature(cls, feature):
+        """A feature with the bbox and resolutions members boundaries.py adds"""
+        levels = [(level["tolerance"], level["geometry"]) for level in feature["resolutions"]]
+        return cls(feature["bbox"], levels, feature.get("geometry"))
+
+    @property
+    def full(self):
+        if not isinstance(self._full, Polygon):
+            geometry = self._full() if callable(self._full) else self._full
+            self._full = Polygon(geometry)
+        return self._full
+
+    def _grid(self, level):
+        # Cells of about the tolerance, each marked INSIDE or OUTSIDE if the
+        # whole cell is on that side of the level's band, else NEAR_EDGE
+        if level not in self._grids:
+            tolerance, polygon = self.levels[level]
+            minx, miny, maxx, maxy = self.bbox
+            cell = max(tolerance, math.sqrt((maxx - minx) * (maxy - miny) / MAX_GRID_CELLS))
+            columns, rows = int((maxx - minx) // cell) + 1, int((maxy - miny) // cell) + 1
+            x, y = np.meshgrid(minx + (np.arange(columns) + 0.5) * cell, miny + (np.arange(rows) + 0.5) * cell)
+            x, y = x.ravel(), y.ravel()
+            states = np.where(polygon.contains(x, y), INSIDE, OUTSIDE).astype(np.int8)
+            reach = tolerance * (1 + 1e-9) + cell * math.sqrt(0.5)
+            states[polygon.near_boundary(x, y, reach)] = NEAR_EDGE
+            self._grids[level] = (cell, columns, rows, states)
+        return self._grids[level]
+
+    def _classify(self, level, x, y):
+        """INSIDE, OUTSIDE or NEAR_EDGE for each point at one level"""
+        tolerance, polygon = self.levels[level]
+        if len(x) >= GRID_MIN_POINTS:
+            cell, columns, rows, states = self._grid(level)
+            column = np.clip(((x - self.bbox[0]) // cell).astype(np.intp), 0, columns - 1)
+            row = np.clip(((y - self.bbox[1]) // cell).astype(np.intp), 0, rows - 1)
+            return states[row * columns + column]
+        # A little slack so rounding never decides a point on the band's edge
+        near = polygon.near_boundary(x, y, tolerance * (1 + 1e-9))
+        states = np.where(near, NEAR_EDGE, OUTSIDE).astype(np.int8)
+        states[~near] = np.where(polygon.contains(x[~near], y[~near]), INSIDE, OUTSIDE)
+        return states
+
+    def contains(self, x, y):
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        minx, miny, maxx, maxy = self.bbox
+        inside = np.zeros(len(x), dtype=bool)
+        undecided = np.flatnonzero((x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+        for level in range(len(self.levels)):
+            if len(undecided) == 0:
+                return inside
+            states = self._classify(level, x[undecided], y[undecided])
+            inside[undecided[states == INSIDE]] = True
+            undecided = undecided[states == NEAR_EDGE]
+        if len(undecided):
+            self.full_tests += len(undecided)
+            inside[undecided] = self.full.contains(x[undecided], y[undecided])
+        return inside
+
+
+class SpatialIndex:
+    """City points and boundary polygons, each behind an STR-tree"""
+
+    def __init__(self, cities, boundaries):
+        self.cities = list(cities)
+        self.boundaries = list(boundaries)
+
+        coordinates = np.array([city["geometry"]["coordinates"][:2] for city in self.cities], dtype=float)
+        coordinates = coordinates.reshape(-1, 2)
+        self.x, self.y = coordinates[:, 0], coordinates[:, 1]
+        self.city_tree = STRtree(np.column_stack([self.x, self.y, self.x, self.y]))
+
+        self.polygons = [
+            MultiResolutionPolygon.from_feature(boundary) if "resolutions" in boundary else Polygon(boundary["geometry"])
+            for boundary in self.boundaries
+        ]
+        self.boundary_tree = STRtree([polygon.bbox for polygon in self.polygons])
+        self.boundary_names = {
+            boundary["properties"].get("name"): number for number, boundary in enumerate(self.boundaries)
+        }
+
+    @classmethod
+    def from_files(cls, cities_path, *boundary_paths):
+        boundaries = [feature for path in boundary_paths for feature in read_features(path)]
+        return cls(read_features(cities_path), boundaries)
+
+    def _boundary_number(self, boundary):
+        if isinstance(boundary, str):
+            if boundary not in self.boundary_names:
+                raise KeyError(f"No boundary named {boundary!r}")
+            return self.boundary_names[boundary]
+        return boundary
+
+    def city_numbers_within(self, boundary):
+        """Positions in self.cities of the cities inside a boundary, given
+        by name or position"""
+        polygon = self.polygons[self._boundary_number(boundary)]
+        candidates = self.city_tree.query(*polygon.bbox)
+        return candidates[polygon.contains(self.x[candidates], self.y[candidates])]
+
+    def join(self):
+        """Every (city, boundary) pair where the boundary contains the city
+
+        Returns two arrays of positions in self.cities and self.boundaries,
+        ordered by city then boundary. A city in overlapping boundaries gets
+        a pair for each, a city in none gets no pair.
+        """
+        city_numbers = [np.zeros(0, dtype=np.intp)]
+        boundary_numbers = [np.zeros(0, dtype=np.intp)]
+        for number in range(len(self.polygons)):
+            inside = self.city_numbers_within(number)
+            city_numbers.append(inside)
+            boundary_numbers.append(np.full(len(inside), number, dtype=np.intp))
+        city_numbers, boundary_numbers = np.concatenate(city_numbers), np.concatenate(boundary_numbers)
+        order = np.lexsort((boundary_numbers, city_numbers))
+        return city_numbers[order], boundary_numbers[order]
+
+    def join_table(self, city_property="City", boundary_property="name", unmatched=True):
+        """The join as rows of {"city": ..., "boundary": ...} property values,
+        with a None boundary row for each city outside them all if unmatched"""
+        city_numbers, boundary_numbers = self.join()
+        rows = []
+        pairs = iter(zip(city_numbers.tolist(), boundary_numbers.tolist()))
+        pair = next(pairs, None)
+        for number, city in enumerate(self.cities):
+            name = city["properties"].get(city_property)
+            matched = False
+            while pair is not None and pair[0] == number:
+                rows.append({"city": name, "boundary": self.boundaries[pair[1]]["properties"].get(boundary_property)})
+                matched = True
+                pair = next(pairs, None)
+            if unmatched and not matched:
+                rows.append({"city": name, "boundary": None})
+        return rows
+
+    def within(self, boundary):
+        """City features inside a boundary, like a $geoWithin $geometry query"""
+        return [self.cities[number] for number in self.city_numbers_within(boundary)]
+
+    def cities_within(self, county_name):
+        return [city["properties"]["City"] for city in self.within(county_name)]
+
+    def containing(self, x, y):
+        """Boundary features that contain the point"""
+        return [
+            self.boundaries[number] for number in self.boundary_tree.query(x, y, x, y)
+            if self.polygons[number].contains(x, y)[0]
+        ]
+
+    def bbox(self, minx, miny, maxx, maxy):
+        """City features inside a longitude/latitude box"""
+        return [self.cities[number] for number in self.city_tree.query(minx, miny, maxx, maxy)]
+
+    def within_radius(self, x, y, miles):
+        """City features within miles of a point, like $centerSphere"""
+        candidates = self.city_tree.query(*box_around(x, y, miles))
+        distances = haversine_miles(x, y, self.x[candidates], self.y[candidates])
+        return [self.cities[number] for number in candidates[distances <= miles]]
+
+    def nearest(self, x, y, k=1):
+        """The k city features closest to a point, nearest first"""
+        k = min(k, len(self.cities))
+        if k == 0:
+            return []
+        # Widen a box until it holds k cities, then take every city that
+        # could be closer than the farthest of those
+        miles = 10.0
+        while len(candidates := self.city_tree.query(*box_around(x, y, miles))) < k:
+            miles *= 4
+        distances = haversine_miles(x, y, self.x[candidates], self.y[candidates])
+        reach = np.partition(distances, k - 1)[k - 1]
+        candidates = self.city_tree.query(*box_around(x, y, reach))
+        distances = haversine_miles(x, y, self.x[candidates], self.y[candidates])
+        closest = candidates[np.argsort(distances, kind="stable")[:k]]
+        return [self.cities[number] for number in closest]
+
+
+def _point_in_polygon(x, y, rings):
+    # Plain even-odd rule, one point at a time, to check the vectorized one
+    inside = False
+    for ring in rings:
+        for (x0, y0), (x1, y1) in zip(ring, ring[1:]):
+            if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                inside = not inside
+    return inside
+
+
+def _random_points(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-85, -80, count), rng.uniform(38, 42, count)
+
+
+def _ohio_index():
+    return SpatialIndex.from_files(
+        "ohio-100-largest-cities.geojson",
+        "Franklin_County_Boundary.geojson",
+        "Cuyahoga_County_Boundary.geojson",
+    )
+
+
+def test_strtree_query():
+    print("test strtree_query")
+    rng = np.random.default_rng(1)
+    corners = rng.uniform(0, 100, (1000, 2))
+    boxes = np.column_stack([corners, corners + rng.uniform(0, 5, (1000, 2))])
+    tree = STRtree(boxes)
+    for _ in range(50):
+        minx, miny = rng.uniform(0, 100, 2)
+        maxx, maxy = minx + rng.uniform(0, 20), miny + rng.uniform(0, 20)
+        expected = np.flatnonzero(
+            (boxes[:, 0] <= maxx) & (boxes[:, 2] >= minx) & (boxes[:, 1] <= maxy) & (boxes[:, 3] >= miny)
+        )
+        assert list(tree.query(minx, miny, maxx, maxy)) == list(expected)
+    assert list(STRtree(np.zeros((0, 4))).query(0, 0, 1, 1)) == []
+
+
+def test_polygon_contains():
+    print("test polygon_contains")
+    # A square with a square hole, and a separate triangle
+    square = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+    hole = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+    triangle = [[20, 0], [30, 0], [25, 10], [20, 0]]
+    polygon = Polygon({"type": "MultiPolygon", "coordinates": [[square, hole], [triangle]]})
+    x = np.array([1, 5, 9.9, 25, 21, 15, -1])
+    y = np.array([1, 5, 9.9, 5, 9, 5, 5])
+    assert list(polygon.contains(x, y)) == [True, False, True, True, False, False, False]
+
+    for path in ["Franklin_County_Boundary.geojson", "Cuyahoga_County_Boundary.geojson"]:
+        geometry = read_features(path)[0]["geometry"]
+        polygon = Polygon(geometry)
+        minx, miny, maxx, maxy = polygon.bbox
+        rng = np.random.default_rng(2)
+        x, y = rng.uniform(minx, maxx, 500), rng.uniform(miny, maxy, 500)
+        expected = [_point_in_polygon(px, py, geometry["coordinates"]) for px, py in zip(x, y)]
+        assert list(polygon.contains(x, y)) == expected
+        assert 0 < sum(expected) < 500
+
+
+def test_cities_within_county():
+    print("test cities_within_county")
+    index = _ohio_index()
+    franklin = index.cities_within("Franklin County")
+    cuyahoga = index.cities_within("Cuyahoga County")
+    assert "Columbus" in franklin and "Cleveland" not in franklin
+    assert "Cleveland" in cuyahoga and "Columbus" not in cuyahoga
+    for county, names in [("Franklin County", franklin), ("Cuyahoga County", cuyahoga)]:
+        geometry = index.boundaries[index.boundary_names[county]]["geometry"]
+        expected = [
+            city["properties"]["City"] for city in index.cities
+            if _point_in_polygon(*city["geometry"]["coordinates"], geometry["coordinates"])
+        ]
+        assert names == expected
+
+    columbus = [-82.9988, 39.9612]
+    assert [boundary["properties"]["name"] for boundary in index.containing(*columbus)] == ["Franklin County"]
+    assert index.containing(-84.512, 39.1031) == []
+
+
+def test_join():
+    print("test join")
+    index = _ohio_index()
+    rows = index.join_table()
+    assert len(rows) == len(index.cities)
+    for county in ["Franklin County", "Cuyahoga County"]:
+        assert [row["city"] for row in rows if row["boundary"] == county] == index.cities_within(county)
+    assert {"city": "Cincinnati", "boundary": None} in rows
+    matched = index.cities_within("Franklin County") + index.cities_within("Cuyahoga County")
+    assert len(index.join_table(unmatched=False)) == len(matched)
+
+    # A box over both counties overlaps them, so their cities join twice
+    box = [[-84, 39], [-81, 39], [-81, 42], [-84, 42], [-84, 39]]
+    state = {"type": "Feature", "properties": {"name": "Box"}, "geometry": {"type": "Polygon", "coordinates": [box]}}
+    index = SpatialIndex(index.cities, index.boundaries + [state])
+    city_numbers, boundary_numbers = index.join()
+    for number, city in enumerate(index.cities):
+        expected = [boundary["properties"]["name"] for boundary in index.containing(*city["geometry"]["coordinates"])]
+        assert [index.boundaries[b]["properties"]["name"] for b in boundary_numbers[city_numbers == number]] == expected
+    columbus = [row["boundary"] for row in index.join_table() if row["city"] == "Columbus"]
+    assert columbus == ["Franklin County", "Box"]
+    assert SpatialIndex(index.cities, []).join_table(unmatched=False) == []
+
+
+def test_nearest_and_radius():
+    print("test nearest_and_radius")
+    x, y = _random_points(3000)
+    cities = [{"geometry": {"type": "Point", "coordinates": [px, py]}, "properties": {"City": str(i)}}
+              for i, (px, py) in enumerate(zip(x, y))]
+    index = SpatialIndex(cities, [])
+    for qx, qy in zip(*_random_points(20, seed=3)):
+        distances = haversine_miles(qx, qy, x, y)
+        nearest = [int(city["properties"]["City"]) for city in index.nearest(qx, qy, k=7)]
+        assert nearest == list(np.argsort(distances, kind="stable")[:7])
+        near = sorted(int(city["properties"]["City"]) for city in index.within_radius(qx, qy, 25))
+        assert near == list(np.flatnonzero(distances <= 25))
+    assert len(index.bbox(-85, 38, -80, 42)) == 3000
+    assert index.bbox(0, 0, 1, 1) == []
+
+    cleveland = _ohio_index().nearest(-81.6944, 41.4993, k=2)
+    assert cleveland[0]["properties"]["City"] == "Cleveland"
+
+
+if __name__ == "__main__":
+    test_strtree_query()
+    test_polygon_contains()
+    test_cities_within_county()
+    test_join()
+    test_nearest_and_radius()
+    print("done.")